@@ -0,0 +1,136 @@
+"""
+Micro-benchmarks for the per-request Python work that does not wait on I/O.
+
+Compares building the search statement and tool schema from scratch on every call (as the code did before they
+were cached) with the cached versions, and encoding and decoding vectors in pgvector's text form (as the code did
+before the binary codec was registered) with the binary form, and decoding embedding responses into Python float
+lists (as the OpenAI SDK does by default) with decoding them into float32 arrays, without needing a database or an
+OpenAI endpoint:
+
+    python -m benchmarks.cpu_profile
+"""
+
+import argparse
+import base64
+import json
+import timeit
+import tracemalloc
+
+import numpy as np
+from pgvector.utils import from_db, from_db_binary, to_db, to_db_binary
+
+from fastapi_app.embeddings import decode_embedding
+from fastapi_app.postgres_searcher import build_search_statement, filter_shape
+from fastapi_app.query_rewriter import build_search_function, search_function_schema
+
+FILTERS = [
+    {"column": "price", "comparison_operator": "<", "value": 30},
+    {"column": "start_date_typed", "comparison_operator": ">", "value": "2024-07-25"},
+]
+QUERY_VECTOR = np.random.default_rng(0).standard_normal(1536, dtype=np.float32)
+# What Postgres sends back for a stored embedding in each format
+TEXT_ROW = to_db(QUERY_VECTOR)
+BINARY_ROW = to_db_binary(QUERY_VECTOR)
+# An embeddings response item as sent by the API
+BASE64_EMBEDDING = base64.b64encode(QUERY_VECTOR.astype("<f4").tobytes()).decode()
+# /similar reads the event's embedding, sends it back as the query vector and reads n=5 neighbors
+SIMILAR_ROWS = 6
+
+
+def statement_uncached():
+    # Build a fresh statement, as every search did before statements were cached. SQLAlchemy's compiled cache
+    # handles compilation the same way in both cases, so it is left out.
+    build_search_statement.__wrapped__("hybrid", filter_shape(FILTERS))
+
+
+def statement_cached():
+    build_search_statement("hybrid", filter_shape(FILTERS))
+
+
+def tool_schema_uncached():
+    # Evaluate the nested schema literal, as every advanced request did before the schema was built once
+    search_function_schema()
+
+
+def tool_schema_cached():
+    build_search_function()
+
+
+def search_vector_text():
+    # The query embedding as a Python list, formatted as text
+    to_db(QUERY_VECTOR.tolist())
+
+
+def search_vector_binary():
+    to_db_binary(QUERY_VECTOR)
+
+
+def similar_vectors_text():
+    rows = [from_db(TEXT_ROW) for _ in range(SIMILAR_ROWS)]
+    to_db(rows[0])
+
+
+def similar_vectors_binary():
+    rows = [from_db_binary(BINARY_ROW) for _ in range(SIMILAR_ROWS)]
+    to_db_binary(rows[0])
+
+
+def embeddings_as_lists(batch_size: int):
+    # What the SDK does without an explicit encoding_format, followed by the conversion to an array for SQL
+    lists = [np.frombuffer(base64.b64decode(BASE64_EMBEDDING), dtype="float32").tolist() for _ in range(batch_size)]
+    return [np.asarray(embedding, dtype=np.float32) for embedding in lists]
+
+
+def embeddings_as_arrays(batch_size: int):
+    return np.stack([decode_embedding(BASE64_EMBEDDING) for _ in range(batch_size)])
+
+
+def peak_allocation_kb(function) -> float:
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return round(peak / 1024, 1)
+
+
+def measure(function, number: int) -> float:
+    """Best-of-5 CPU microseconds per call."""
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1_000_000
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure per-request CPU spent building SQL and tool schemas")
+    parser.add_argument("--number", type=int, default=2000)
+    args = parser.parse_args()
+
+    report = {
+        "search_statement_us": {
+            "uncached": round(measure(statement_uncached, args.number), 2),
+            "cached": round(measure(statement_cached, args.number), 2),
+        },
+        "tool_schema_us": {
+            "uncached": round(measure(tool_schema_uncached, args.number), 2),
+            "cached": round(measure(tool_schema_cached, args.number), 2),
+        },
+        "search_vector_us": {
+            "text": round(measure(search_vector_text, args.number), 2),
+            "binary": round(measure(search_vector_binary, args.number), 2),
+        },
+        "similar_vectors_us": {
+            "text": round(measure(similar_vectors_text, args.number), 2),
+            "binary": round(measure(similar_vectors_binary, args.number), 2),
+        },
+    }
+    for batch_size in (1, 16):
+        report[f"embedding_decode_batch_{batch_size}"] = {
+            name: {
+                "us": round(measure(lambda: function(batch_size), max(1, args.number // batch_size)), 2),
+                "peak_kb": peak_allocation_kb(lambda: function(batch_size)),
+            }
+            for name, function in (("lists", embeddings_as_lists), ("arrays", embeddings_as_arrays))
+        }
+    print(json.dumps(report, indent=2))
+
+
+if __name__ == "__main__":
+    main()
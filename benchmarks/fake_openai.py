@@ -0,0 +1,185 @@
+"""
+A fake OpenAI-compatible server for benchmarks.
+
+Serves /v1/chat/completions (streaming and non-streaming, with a search_database tool call whenever tools are
+offered) and /v1/embeddings (float or base64 encoding). Every response waits for a configurable latency so that
+the app sees realistic provider round trips without spending tokens.
+
+Run it standalone with:
+
+    python -m benchmarks.fake_openai --port 8100 --chat-latency-ms 400 --embed-latency-ms 50
+"""
+
+import argparse
+import asyncio
+import base64
+import hashlib
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+
+import numpy as np
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+
+
+@dataclass
+class FakeOpenAIConfig:
+    chat_latency_ms: float = 300.0
+    embed_latency_ms: float = 40.0
+    token_latency_ms: float = 10.0
+    jitter: float = 0.2
+    answer_tokens: int = 60
+    dimensions: int = 1536
+
+
+def fake_embedding(text: str, dimensions: int) -> np.ndarray:
+    """A deterministic unit vector per input text, so repeated queries hit the same neighbours."""
+    seed = int.from_bytes(hashlib.sha256(text.encode()).digest()[:8], "little")
+    vector = np.random.default_rng(seed).standard_normal(dimensions, dtype=np.float32)
+    return vector / np.linalg.norm(vector)
+
+
+def create_fake_openai_app(config: FakeOpenAIConfig | None = None) -> FastAPI:
+    config = config or FakeOpenAIConfig()
+    app = FastAPI()
+    app.state.requests = {"chat": 0, "embeddings": 0, "embedding_inputs": 0}
+
+    async def sleep_ms(latency_ms: float):
+        if latency_ms > 0:
+            await asyncio.sleep(latency_ms * random.uniform(1 - config.jitter, 1 + config.jitter) / 1000)
+
+    @app.post("/v1/embeddings")
+    async def embeddings(request: Request):
+        body = await request.json()
+        inputs = body["input"] if isinstance(body["input"], list) else [body["input"]]
+        app.state.requests["embeddings"] += 1
+        app.state.requests["embedding_inputs"] += len(inputs)
+        await sleep_ms(config.embed_latency_ms)
+        dimensions = body.get("dimensions") or config.dimensions
+        data = []
+        for index, text in enumerate(inputs):
+            vector = fake_embedding(str(text), int(dimensions))
+            if body.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.tobytes()).decode()
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": index, "embedding": embedding})
+        tokens = sum(len(str(text).split()) for text in inputs)
+        return {
+            "object": "list",
+            "data": data,
+            "model": body["model"],
+            "usage": {"prompt_tokens": tokens, "total_tokens": tokens},
+        }
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        app.state.requests["chat"] += 1
+        prompt_tokens = sum(len(str(message.get("content", "")).split()) for message in body["messages"])
+        user_content = next((m["content"] for m in reversed(body["messages"]) if m["role"] == "user"), "").split(
+            "\n\nSources:"
+        )[0]
+        completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+        created = int(time.time())
+
+        if body.get("tools"):
+            await sleep_ms(config.chat_latency_ms)
+            tool_call = {
+                "id": f"call_{uuid.uuid4().hex[:12]}",
+                "type": "function",
+                "function": {"name": "search_database", "arguments": json.dumps({"search_query": user_content})},
+            }
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": body["model"],
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": None, "tool_calls": [tool_call]},
+                        "finish_reason": "tool_calls",
+                    }
+                ],
+                "usage": {"prompt_tokens": prompt_tokens, "completion_tokens": 12, "total_tokens": prompt_tokens + 12},
+            }
+
+        answer_tokens = min(config.answer_tokens, body.get("max_tokens") or config.answer_tokens)
+        words = [f"word{i}" for i in range(answer_tokens)]
+
+        if body.get("stream"):
+
+            async def stream():
+                await sleep_ms(config.chat_latency_ms)
+                for word in words:
+                    chunk = {
+                        "id": completion_id,
+                        "object": "chat.completion.chunk",
+                        "created": created,
+                        "model": body["model"],
+                        "choices": [{"index": 0, "delta": {"role": "assistant", "content": word + " "}}],
+                    }
+                    yield f"data: {json.dumps(chunk)}\n\n"
+                    await sleep_ms(config.token_latency_ms)
+                done = {
+                    "id": completion_id,
+                    "object": "chat.completion.chunk",
+                    "created": created,
+                    "model": body["model"],
+                    "choices": [{"index": 0, "delta": {}, "finish_reason": "stop"}],
+                }
+                yield f"data: {json.dumps(done)}\n\n"
+                yield "data: [DONE]\n\n"
+
+            return StreamingResponse(stream(), media_type="text/event-stream")
+
+        await sleep_ms(config.chat_latency_ms + config.token_latency_ms * answer_tokens)
+        return {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": created,
+            "model": body["model"],
+            "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}
+            ],
+            "usage": {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": answer_tokens,
+                "total_tokens": prompt_tokens + answer_tokens,
+            },
+        }
+
+    return app
+
+
+def add_config_arguments(parser: argparse.ArgumentParser):
+    parser.add_argument("--chat-latency-ms", type=float, default=FakeOpenAIConfig.chat_latency_ms)
+    parser.add_argument("--embed-latency-ms", type=float, default=FakeOpenAIConfig.embed_latency_ms)
+    parser.add_argument("--token-latency-ms", type=float, default=FakeOpenAIConfig.token_latency_ms)
+    parser.add_argument("--jitter", type=float, default=FakeOpenAIConfig.jitter)
+    parser.add_argument("--answer-tokens", type=int, default=FakeOpenAIConfig.answer_tokens)
+
+
+def config_from_args(args) -> FakeOpenAIConfig:
+    return FakeOpenAIConfig(
+        chat_latency_ms=args.chat_latency_ms,
+        embed_latency_ms=args.embed_latency_ms,
+        token_latency_ms=args.token_latency_ms,
+        jitter=args.jitter,
+        answer_tokens=args.answer_tokens,
+    )
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Run a fake OpenAI-compatible server")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    add_config_arguments(parser)
+    args = parser.parse_args()
+    uvicorn.run(create_fake_openai_app(config_from_args(args)), host=args.host, port=args.port, log_level="warning")
@@ -0,0 +1,166 @@
+"""
+Recall and latency of filtered vector search across filter selectivities.
+
+Loads synthetic events, then runs the vector leg of PostgresSearcher for a range of price and date filters, from
+one that matches every row to one that matches a fraction of a percent. For each filter it compares:
+
+* index: the plain HNSW scan with the default ef_search, as searches ran before the planner
+* planner: the strategy FilteredSearchPlanner picks from the table statistics
+* exact: ranking every filtered row, which is also the ground truth for recall@20
+
+    python -m benchmarks.filtered_search --rows 100000
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+import os
+import statistics
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from benchmarks.local_postgres import local_postgres
+from benchmarks.synthetic_events import load_events
+from fastapi_app.postgres_engine import create_postgres_engine_from_env
+from fastapi_app.postgres_searcher import build_filter_clause, build_search_statement, filter_params, filter_shape
+from fastapi_app.search_planner import FilteredSearchPlanner, SearchPlan
+from fastapi_app.setup_postgres_database import create_db_schema
+
+logger = logging.getLogger("ragapp")
+
+
+def filter_cases() -> dict[str, list[dict]]:
+    today = datetime.date.today()
+
+    def date_window(days: int) -> dict:
+        end = today + datetime.timedelta(days=days)
+        return {
+            "column": "start_date_typed",
+            "comparison_operator": "BETWEEN",
+            "value": [today.isoformat(), end.isoformat()],
+        }
+
+    return {
+        "price < 1000": [{"column": "price", "comparison_operator": "<", "value": 1000}],
+        "price < 30": [{"column": "price", "comparison_operator": "<", "value": 30}],
+        "price = 0": [{"column": "price", "comparison_operator": "=", "value": 0}],
+        "next 30 days": [date_window(30)],
+        "next 7 days": [date_window(7)],
+        "free, next 7 days": [{"column": "price", "comparison_operator": "=", "value": 0}, date_window(7)],
+        "tomorrow": [date_window(1)],
+    }
+
+
+async def ranked_ids(session, filters: list[dict], plan: SearchPlan, vector: np.ndarray) -> tuple[list[int], float]:
+    start = time.perf_counter()
+    async with session.begin():
+        await FilteredSearchPlanner.apply(session, plan)
+        sql = build_search_statement("vector", filter_shape(filters), plan.vector_strategy, plan.index_predicate)
+        rows = (await session.execute(sql, {"embedding": vector} | filter_params(filters))).fetchall()
+    return [row.id for row in rows], (time.perf_counter() - start) * 1000
+
+
+async def benchmark_filter(session_maker, planner, name: str, filters: list[dict], vectors: np.ndarray) -> dict:
+    where, _ = build_filter_clause(filter_shape(filters))
+    async with session_maker() as session, session.begin():
+        matching = (
+            await session.execute(text(f"SELECT count(*) FROM kefi_events {where}"), filter_params(filters))
+        ).scalar()
+        planned = await planner.plan(session, filters)
+
+    strategies = {"index": SearchPlan(strategy="index"), "planner": planned, "exact": SearchPlan(strategy="exact")}
+    latencies: dict[str, list[float]] = {name: [] for name in strategies}
+    recalls: dict[str, list[float]] = {name: [] for name in strategies}
+    returned: dict[str, list[int]] = {name: [] for name in strategies}
+    async with session_maker() as session:
+        for vector in vectors:
+            results = {}
+            for strategy, plan in strategies.items():
+                results[strategy], elapsed = await ranked_ids(session, filters, plan, vector)
+                latencies[strategy].append(elapsed)
+                returned[strategy].append(len(results[strategy]))
+            truth = set(results["exact"])
+            for strategy, ids in results.items():
+                recalls[strategy].append(len(truth & set(ids)) / len(truth) if truth else 1.0)
+
+    return {
+        "filter": name,
+        "matching_rows": matching,
+        "plan": planned.to_dict(),
+        "strategies": {
+            strategy: {
+                "recall_at_20": round(statistics.mean(recalls[strategy]), 4),
+                "mean_rows_returned": round(statistics.mean(returned[strategy]), 1),
+                "latency_ms_p50": round(statistics.median(latencies[strategy]), 2),
+                "latency_ms_p95": round(float(np.percentile(latencies[strategy], 95)), 2),
+            }
+            for strategy in strategies
+        },
+    }
+
+
+async def run(args) -> list[dict]:
+    engine = await create_postgres_engine_from_env()
+    if not args.skip_load:
+        await create_db_schema(engine)
+        await load_events(engine, args.rows, args.dimensions)
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+    planner = FilteredSearchPlanner(exact_scan_max_rows=args.exact_scan_max_rows)
+
+    rng = np.random.default_rng(7)
+    vectors = rng.standard_normal((args.queries, args.dimensions), dtype=np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+
+    results = []
+    for name, filters in filter_cases().items():
+        result = await benchmark_filter(session_maker, planner, name, filters, vectors)
+        logger.info("%s", json.dumps(result))
+        results.append(result)
+    await engine.dispose()
+    return results
+
+
+def print_table(results: list[dict]):
+    header = "".join(f"{strategy + ' recall/p50':>22}" for strategy in results[0]["strategies"])
+    print(f"{'filter':<20}{'rows':>9}{'plan':>16}  {header}")
+    for result in results:
+        cells = "".join(
+            f"{stats['recall_at_20']:>12.3f}{stats['latency_ms_p50']:>8.1f}ms"
+            for stats in result["strategies"].values()
+        )
+        print(f"{result['filter']:<20}{result['matching_rows']:>9}{result['plan']['strategy']:>16}  {cells}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark filtered vector search strategies")
+    parser.add_argument("--rows", type=int, default=100_000, help="Synthetic events to load")
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=50, help="Query vectors per filter")
+    parser.add_argument("--exact-scan-max-rows", type=int, default=5000)
+    parser.add_argument("--postgres-from-env", action="store_true", help="Use POSTGRES_* instead of a local server")
+    parser.add_argument("--skip-load", action="store_true", help="Reuse the events already in the database")
+    parser.add_argument("--output", type=str, default="filtered_search_results.json")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        if not args.postgres_from_env:
+            os.environ.update(stack.enter_context(local_postgres()))
+        results = await run(args)
+
+    with open(args.output, "w") as f:
+        json.dump({"config": vars(args), "results": results}, f, indent=2)
+    print_table(results)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    load_dotenv(override=True)
+    asyncio.run(main())
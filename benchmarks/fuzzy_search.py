@@ -0,0 +1,172 @@
+"""
+Hit rate and latency of typo-tolerant text search.
+
+Loads synthetic events, then searches for event names with one or two typos (a dropped, doubled, swapped or
+substituted letter), and for the names spelled correctly as a control. For each query set it compares:
+
+* text: the full-text leg alone, as retrieval_mode="text" ran before the trigram leg
+* fuzzy@T: the full-text and trigram legs fused with RRF, at pg_trgm.word_similarity_threshold T
+
+A query hits when one of its top k results is an event generated from the misspelled name. No vector leg runs,
+as the synthetic embeddings are random.
+
+    python -m benchmarks.fuzzy_search --rows 100000 --thresholds 0.3 0.4 0.5 0.6
+"""
+
+import argparse
+import asyncio
+import contextlib
+import json
+import logging
+import os
+import random
+import re
+import statistics
+import string
+import time
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import async_sessionmaker
+
+from benchmarks.local_postgres import local_postgres
+from benchmarks.synthetic_events import load_events, load_templates
+from fastapi_app.postgres_engine import create_postgres_engine_from_env
+from fastapi_app.postgres_searcher import build_search_statement
+from fastapi_app.setup_postgres_database import create_db_schema
+
+logger = logging.getLogger("ragapp")
+
+TYPOS = ["drop", "double", "swap", "substitute"]
+
+
+def misspell(query: str, typos: int, randomizer: random.Random) -> str:
+    """Apply typos to distinct words of at least four letters, leaving the first letter of each word alone."""
+    words = query.split()
+    candidates = [i for i, word in enumerate(words) if len(word) >= 4 and word.isalpha()]
+    for i in randomizer.sample(candidates, min(typos, len(candidates))):
+        word = words[i]
+        position = randomizer.randrange(1, len(word) - 1)
+        typo = randomizer.choice(TYPOS)
+        if typo == "drop":
+            word = word[:position] + word[position + 1 :]
+        elif typo == "double":
+            word = word[:position] + word[position] + word[position:]
+        elif typo == "swap":
+            word = word[:position] + word[position + 1] + word[position] + word[position + 2 :]
+        else:
+            replacement = randomizer.choice([c for c in string.ascii_lowercase if c != word[position].lower()])
+            word = word[:position] + replacement + word[position + 1 :]
+        words[i] = word
+    return " ".join(words)
+
+
+def query_sets(names: list[str], queries: int, seed: int = 7) -> dict[str, list[tuple[str, str]]]:
+    """(query, intended name) pairs for each query set."""
+    randomizer = random.Random(seed)
+    targets = [randomizer.choice(names) for _ in range(queries)]
+    return {
+        "correct": [(name, name) for name in targets],
+        "1 typo": [(misspell(name, 1, randomizer), name) for name in targets],
+        "2 typos": [(misspell(name, 2, randomizer), name) for name in targets],
+    }
+
+
+def template_name(name: str) -> str:
+    # Synthetic events are named after their template, with a " #<id>" suffix
+    return re.sub(r" #\d+$", "", name)
+
+
+async def ranked_names(session, query: str, threshold: float | None) -> tuple[list[str], float]:
+    start = time.perf_counter()
+    async with session.begin():
+        if threshold is not None:
+            await session.execute(
+                text("SELECT set_config('pg_trgm.word_similarity_threshold', :threshold, true)"),
+                {"threshold": str(threshold)},
+            )
+        sql = build_search_statement("text", (), fuzzy=threshold is not None)
+        ids = [row.id for row in (await session.execute(sql, {"query": query, "k": 60})).fetchall()]
+        names = dict(
+            (await session.execute(text("SELECT id, name FROM kefi_events WHERE id = ANY(:ids)"), {"ids": ids})).all()
+        )
+    elapsed = (time.perf_counter() - start) * 1000
+    return [template_name(names[id]) for id in ids], elapsed
+
+
+async def benchmark_queries(session_maker, name: str, pairs: list[tuple[str, str]], thresholds: list[float]) -> dict:
+    strategies: dict[str, float | None] = {"text": None} | {f"fuzzy@{threshold}": threshold for threshold in thresholds}
+    stats = {}
+    async with session_maker() as session:
+        for strategy, threshold in strategies.items():
+            latencies, hits_at_1, hits_at_5, returned = [], [], [], []
+            for query, intended in pairs:
+                names, elapsed = await ranked_names(session, query, threshold)
+                latencies.append(elapsed)
+                hits_at_1.append(intended in names[:1])
+                hits_at_5.append(intended in names[:5])
+                returned.append(len(names))
+            stats[strategy] = {
+                "hit_at_1": round(statistics.mean(hits_at_1), 4),
+                "hit_at_5": round(statistics.mean(hits_at_5), 4),
+                "mean_rows_returned": round(statistics.mean(returned), 1),
+                "latency_ms_p50": round(statistics.median(latencies), 2),
+                "latency_ms_p95": round(float(np.percentile(latencies, 95)), 2),
+            }
+    return {"queries": name, "examples": [query for query, _ in pairs[:3]], "strategies": stats}
+
+
+async def run(args) -> list[dict]:
+    engine = await create_postgres_engine_from_env()
+    if not args.skip_load:
+        await create_db_schema(engine)
+        await load_events(engine, args.rows, args.dimensions)
+    session_maker = async_sessionmaker(engine, expire_on_commit=False)
+
+    names = sorted({template["name"] for template in load_templates()})
+    results = []
+    for name, pairs in query_sets(names, args.queries).items():
+        result = await benchmark_queries(session_maker, name, pairs, args.thresholds)
+        logger.info("%s", json.dumps(result))
+        results.append(result)
+    await engine.dispose()
+    return results
+
+
+def print_table(results: list[dict]):
+    header = "".join(f"{strategy + ' hit@5/p50':>24}" for strategy in results[0]["strategies"])
+    print(f"{'queries':<12}{header}")
+    for result in results:
+        cells = "".join(
+            f"{stats['hit_at_5']:>14.3f}{stats['latency_ms_p50']:>8.1f}ms" for stats in result["strategies"].values()
+        )
+        print(f"{result['queries']:<12}{cells}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Benchmark typo-tolerant text search")
+    parser.add_argument("--rows", type=int, default=100_000, help="Synthetic events to load")
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--queries", type=int, default=200, help="Queries per query set")
+    parser.add_argument("--thresholds", type=float, nargs="+", default=[0.3, 0.4, 0.5, 0.6])
+    parser.add_argument("--postgres-from-env", action="store_true", help="Use POSTGRES_* instead of a local server")
+    parser.add_argument("--skip-load", action="store_true", help="Reuse the events already in the database")
+    parser.add_argument("--output", type=str, default="fuzzy_search_results.json")
+    args = parser.parse_args()
+
+    with contextlib.ExitStack() as stack:
+        if not args.postgres_from_env:
+            os.environ.update(stack.enter_context(local_postgres()))
+        results = await run(args)
+
+    with open(args.output, "w") as f:
+        json.dump({"config": vars(args), "results": results}, f, indent=2)
+    print_table(results)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    load_dotenv(override=True)
+    asyncio.run(main())
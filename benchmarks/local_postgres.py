@@ -0,0 +1,80 @@
+"""
+A throwaway local Postgres+pgvector instance for benchmarks, without Docker.
+
+Uses the initdb/pg_ctl binaries of a local PostgreSQL install (found on PATH or via pg_config) that has the
+pgvector extension available, e.g. after running .github/workflows/install-pgvector.sh.
+"""
+
+import contextlib
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+
+logger = logging.getLogger("ragapp")
+
+
+def find_postgres_bindir() -> str:
+    if initdb := shutil.which("initdb"):
+        return os.path.dirname(initdb)
+    if pg_config := shutil.which("pg_config"):
+        return subprocess.check_output([pg_config, "--bindir"], text=True).strip()
+    raise RuntimeError("Could not find initdb; install PostgreSQL or put its bin directory on PATH")
+
+
+def free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextlib.contextmanager
+def local_postgres(username: str = "admin", password: str = "postgres", database: str = "postgres"):
+    """
+    Start a temporary Postgres server and yield the POSTGRES_* environment variables to connect to it.
+    The data directory is deleted when the context exits.
+    """
+    bindir = find_postgres_bindir()
+    port = free_port()
+    with tempfile.TemporaryDirectory(prefix="ragapp-pg-") as tmpdir:
+        datadir = os.path.join(tmpdir, "data")
+        pwfile = os.path.join(tmpdir, "pwfile")
+        with open(pwfile, "w") as f:
+            f.write(password)
+        subprocess.run(
+            [os.path.join(bindir, "initdb"), "-D", datadir, "-U", username, "--pwfile", pwfile, "-A", "md5"],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        logger.info("Starting local Postgres on port %d", port)
+        subprocess.run(
+            [
+                os.path.join(bindir, "pg_ctl"),
+                "-D",
+                datadir,
+                "-l",
+                os.path.join(tmpdir, "postgres.log"),
+                "-o",
+                f"-p {port} -k {tmpdir} -c listen_addresses=127.0.0.1 -c shared_buffers=256MB",
+                "-w",
+                "start",
+            ],
+            check=True,
+            stdout=subprocess.DEVNULL,
+        )
+        try:
+            yield {
+                "POSTGRES_HOST": f"127.0.0.1:{port}",
+                "POSTGRES_USERNAME": username,
+                "POSTGRES_PASSWORD": password,
+                "POSTGRES_DATABASE": database,
+                "POSTGRES_SSL": "disable",
+            }
+        finally:
+            subprocess.run(
+                [os.path.join(bindir, "pg_ctl"), "-D", datadir, "-m", "fast", "-w", "stop"],
+                check=False,
+                stdout=subprocess.DEVNULL,
+            )
@@ -0,0 +1,245 @@
+"""
+Run load-test scenarios against the app and write the results as JSON.
+
+By default the app runs in-process against the fake OpenAI server, and against a throwaway local Postgres loaded
+with synthetic events. Pass --postgres-from-env to use the POSTGRES_* variables instead (e.g. the devcontainer
+database), or --target-url to load-test an app that is already running.
+
+    python -m benchmarks.run --rows 10000 --concurrency 1 8 32 --output results.json
+    python -m benchmarks.run --compare baseline.json --output results.json
+"""
+
+import argparse
+import asyncio
+import contextlib
+import datetime
+import json
+import logging
+import os
+import random
+import subprocess
+import threading
+import time
+
+import httpx
+import numpy as np
+import uvicorn
+
+from .fake_openai import add_config_arguments, config_from_args, create_fake_openai_app
+from .local_postgres import local_postgres
+from .synthetic_events import load_events
+
+logger = logging.getLogger("ragapp")
+
+QUERIES = [
+    "live jazz this weekend",
+    "cheap comedy shows",
+    "family friendly festivals in Miami",
+    "wine tasting",
+    "salsa party downtown",
+    "outdoor concerts under $30",
+    "art walk",
+    "late night DJ set",
+]
+
+
+def build_request(scenario: str, rows: int) -> tuple[str, str, dict]:
+    query = random.choice(QUERIES)
+    if scenario == "search":
+        return "GET", "/search", {"params": {"query": query, "top": 5}}
+    if scenario == "similar":
+        return "GET", "/similar", {"params": {"id": random.randint(1, rows), "n": 5}}
+    if scenario in ("chat_simple", "chat_advanced"):
+        return (
+            "POST",
+            "/chat",
+            {
+                "json": {
+                    "messages": [{"content": query, "role": "user"}],
+                    "context": {"overrides": {"use_advanced_flow": scenario == "chat_advanced", "top": 3}},
+                }
+            },
+        )
+    raise ValueError(f"Unknown scenario: {scenario}")
+
+
+async def run_scenario(client: httpx.AsyncClient, scenario: str, concurrency: int, requests: int, rows: int) -> dict:
+    latencies: list[float] = []
+    errors = 0
+    remaining = requests
+
+    async def worker():
+        nonlocal remaining, errors
+        while remaining > 0:
+            remaining -= 1
+            method, url, kwargs = build_request(scenario, rows)
+            start = time.perf_counter()
+            try:
+                response = await client.request(method, url, **kwargs)
+                response.raise_for_status()
+                latencies.append(time.perf_counter() - start)
+            except httpx.HTTPError as e:
+                logger.debug("Request failed: %s", e)
+                errors += 1
+
+    start = time.perf_counter()
+    # The app and the load generator share this thread (the fake OpenAI server runs in its own thread), so thread
+    # CPU time approximates the Python work per request spent outside I/O waits when running in-process
+    cpu_start = time.thread_time()
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    cpu_elapsed = time.thread_time() - cpu_start
+    elapsed = time.perf_counter() - start
+    latencies_ms = np.array(latencies) * 1000 if latencies else np.array([np.nan])
+    return {
+        "scenario": scenario,
+        "concurrency": concurrency,
+        "requests": requests,
+        "errors": errors,
+        "throughput_rps": round(len(latencies) / elapsed, 2),
+        "cpu_ms_per_request": round(cpu_elapsed * 1000 / requests, 3),
+        "latency_ms": {
+            "mean": round(float(np.mean(latencies_ms)), 2),
+            "p50": round(float(np.percentile(latencies_ms, 50)), 2),
+            "p90": round(float(np.percentile(latencies_ms, 90)), 2),
+            "p99": round(float(np.percentile(latencies_ms, 99)), 2),
+            "max": round(float(np.max(latencies_ms)), 2),
+        },
+    }
+
+
+@contextlib.contextmanager
+def fake_openai_server(config, port: int = 8100):
+    server = uvicorn.Server(
+        uvicorn.Config(create_fake_openai_app(config), host="127.0.0.1", port=port, log_level="warning")
+    )
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+    try:
+        yield f"http://127.0.0.1:{port}/v1"
+    finally:
+        server.should_exit = True
+        thread.join()
+
+
+@contextlib.asynccontextmanager
+async def in_process_app():
+    from fastapi_app import create_app
+
+    app = create_app()
+    async with app.router.lifespan_context(app):
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://benchmark", timeout=120) as client:
+            yield client
+
+
+async def prepare_database(rows: int):
+    from fastapi_app.postgres_engine import create_postgres_engine_from_env
+    from fastapi_app.setup_postgres_database import create_db_schema
+
+    engine = await create_postgres_engine_from_env()
+    await create_db_schema(engine)
+    await load_events(engine, rows)
+    await engine.dispose()
+
+
+def git_revision() -> str | None:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(results: list[dict], baseline_path: str):
+    with open(baseline_path) as f:
+        baseline = {(r["scenario"], r["concurrency"]): r for r in json.load(f)["results"]}
+    print(f"{'scenario':<16}{'conc':>6}{'p50 ms':>12}{'Δ':>9}{'p99 ms':>12}{'Δ':>9}{'rps':>10}{'Δ':>9}")
+    for result in results:
+        before = baseline.get((result["scenario"], result["concurrency"]))
+        if before is None:
+            continue
+
+        def delta(after, prior):
+            return f"{(after - prior) / prior * 100:+.1f}%" if prior else "n/a"
+
+        p50, p99 = result["latency_ms"]["p50"], result["latency_ms"]["p99"]
+        print(
+            f"{result['scenario']:<16}{result['concurrency']:>6}"
+            f"{p50:>12}{delta(p50, before['latency_ms']['p50']):>9}"
+            f"{p99:>12}{delta(p99, before['latency_ms']['p99']):>9}"
+            f"{result['throughput_rps']:>10}{delta(result['throughput_rps'], before['throughput_rps']):>9}"
+        )
+
+
+async def run_all(args, client: httpx.AsyncClient) -> list[dict]:
+    results = []
+    for scenario in args.scenarios:
+        # Warm up connections and caches so the first measured request is not an outlier
+        await run_scenario(client, scenario, 1, args.warmup, args.rows)
+        for concurrency in args.concurrency:
+            result = await run_scenario(client, scenario, concurrency, args.requests, args.rows)
+            logger.info("%s", json.dumps(result))
+            results.append(result)
+    return results
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Run benchmark scenarios against the app")
+    parser.add_argument("--scenarios", nargs="+", default=["search", "similar", "chat_simple", "chat_advanced"])
+    parser.add_argument("--concurrency", nargs="+", type=int, default=[1, 8, 32])
+    parser.add_argument("--requests", type=int, default=200, help="Requests per scenario and concurrency level")
+    parser.add_argument("--warmup", type=int, default=10)
+    parser.add_argument("--rows", type=int, default=10_000, help="Synthetic events to load")
+    parser.add_argument("--target-url", type=str, help="Benchmark an already running app instead")
+    parser.add_argument("--postgres-from-env", action="store_true", help="Use POSTGRES_* instead of a local server")
+    parser.add_argument("--fake-openai-port", type=int, default=8100)
+    parser.add_argument("--output", type=str, default="bench_results.json")
+    parser.add_argument("--compare", type=str, help="Baseline results JSON to compare against")
+    add_config_arguments(parser)
+    args = parser.parse_args()
+
+    if args.target_url:
+        async with httpx.AsyncClient(base_url=args.target_url, timeout=120) as client:
+            results = await run_all(args, client)
+    else:
+        if os.path.exists(dotenv_path := os.path.join(os.path.dirname(__file__), "..", ".env")):
+            logger.warning("The app lifespan loads %s, which may override the benchmark settings", dotenv_path)
+        with contextlib.ExitStack() as stack:
+            if not args.postgres_from_env:
+                os.environ.update(stack.enter_context(local_postgres()))
+            base_url = stack.enter_context(fake_openai_server(config_from_args(args), args.fake_openai_port))
+            os.environ.update(
+                {
+                    "OPENAI_BASE_URL": base_url,
+                    "OPENAI_CHAT_HOST": "openai",
+                    "OPENAI_EMBED_HOST": "openai",
+                    "OPENAICOM_KEY": "fake",
+                    "OPENAICOM_CHAT_MODEL": "gpt-3.5-turbo",
+                    "OPENAICOM_EMBED_MODEL": "text-embedding-ada-002",
+                    "OPENAICOM_EMBED_DIMENSIONS": "1536",
+                    "RUNNING_IN_PRODUCTION": "1",
+                }
+            )
+            await prepare_database(args.rows)
+            async with in_process_app() as client:
+                results = await run_all(args, client)
+
+    report = {
+        "timestamp": datetime.datetime.now(datetime.UTC).isoformat(),
+        "git_revision": git_revision(),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output", "compare")},
+        "results": results,
+    }
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    logger.info("Wrote results to %s", args.output)
+
+    if args.compare:
+        compare(results, args.compare)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    asyncio.run(main())
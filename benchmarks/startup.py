@@ -0,0 +1,94 @@
+"""
+Measure worker startup cost: module import time and memory.
+
+Imports the app in a fresh interpreter with -X importtime, reports the slowest top-level imports and the RSS
+after import, and exits non-zero when the total import time exceeds the budget, so it can gate CI:
+
+    python -m benchmarks.startup --budget-ms 1500
+
+With --gunicorn-pid, also reports RSS and PSS (proportional set size, which splits shared pages between the
+processes that map them) for each worker of a running gunicorn master, to show what preload_app shares:
+
+    python -m benchmarks.startup --gunicorn-pid $(pgrep -f "gunicorn: master" | head -1)
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+IMPORT_SNIPPET = """
+import json, resource, time
+start = time.perf_counter()
+import fastapi_app
+fastapi_app.create_app()
+elapsed = time.perf_counter() - start
+print(json.dumps({"seconds": elapsed, "max_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss}))
+"""
+
+
+def profile_imports() -> dict:
+    completed = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", IMPORT_SNIPPET],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=os.environ | {"RUNNING_IN_PRODUCTION": "1"},
+    )
+    modules = []
+    for line in completed.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        self_us, cumulative_us, name = line.removeprefix("import time:").split("|")
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        modules.append({"module": name.strip(), "depth": depth, "cumulative_us": int(cumulative_us)})
+
+    measured = json.loads(completed.stdout.strip().splitlines()[-1])
+    return {
+        "total_import_ms": round(measured["seconds"] * 1000, 1),
+        "max_rss_kb": measured["max_rss_kb"],
+        "slowest_imports": [
+            {"module": m["module"], "cumulative_ms": round(m["cumulative_us"] / 1000, 1)}
+            for m in sorted(modules, key=lambda m: m["cumulative_us"], reverse=True)
+            if m["depth"] <= 1
+        ][:15],
+    }
+
+
+def worker_memory(master_pid: int) -> list[dict]:
+    children = subprocess.check_output(["pgrep", "-P", str(master_pid)], text=True).split()
+    workers = []
+    for pid in children:
+        stats = {}
+        with open(f"/proc/{pid}/smaps_rollup") as f:
+            for line in f:
+                key, _, value = line.partition(":")
+                if key in ("Rss", "Pss", "Shared_Clean", "Private_Dirty"):
+                    stats[key.lower() + "_kb"] = int(value.split()[0])
+        workers.append({"pid": int(pid)} | stats)
+    return workers
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Profile app import time and worker memory")
+    parser.add_argument("--budget-ms", type=float, help="Fail if total import time exceeds this many milliseconds")
+    parser.add_argument("--gunicorn-pid", type=int, help="Also report memory for the workers of this gunicorn master")
+    parser.add_argument("--output", type=str, help="Write the report as JSON to this file")
+    args = parser.parse_args()
+
+    report = profile_imports()
+    if args.gunicorn_pid:
+        report["workers"] = worker_memory(args.gunicorn_pid)
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+    if args.budget_ms and report["total_import_ms"] > args.budget_ms:
+        print(f"Import time {report['total_import_ms']}ms exceeds budget of {args.budget_ms}ms", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
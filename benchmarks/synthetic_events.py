@@ -0,0 +1,166 @@
+"""
+Scale the event catalog up for benchmarks.
+
+Generates N kefi_events rows by cycling through the templates in seed_data_events.json (or a built-in vocabulary
+when the seed file is not available), with varied names, prices and dates and random unit embeddings.
+Rows are streamed into Postgres with COPY, so 1M rows load in minutes rather than hours. They can also be written
+as a seed bundle (see fastapi_app.seed_bundle) and loaded from it later, memory-mapped.
+
+    python -m benchmarks.synthetic_events --rows 100000
+    python -m benchmarks.synthetic_events --rows 1000000 --write-bundle events_1m
+    python -m benchmarks.synthetic_events --from-bundle events_1m
+"""
+
+import argparse
+import asyncio
+import datetime
+import json
+import logging
+import os
+import random
+from collections.abc import Iterator
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import text
+
+from fastapi_app.postgres_engine import create_postgres_engine_from_env
+from fastapi_app.seed_bundle import copy_records, read_seed_bundle, write_seed_bundle
+
+logger = logging.getLogger("ragapp")
+
+SEED_DATA_PATH = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "..", "src", "fastapi_app", "seed_data_events.json"
+)
+CATEGORIES = ["Concert", "Festival", "Comedy", "Theatre", "Food & Drink", "Sports", "Art", "Nightlife", "Family"]
+ADJECTIVES = ["Live", "Open-Air", "Late Night", "Sunset", "Downtown", "Beachfront", "Acoustic", "Annual", "Pop-Up"]
+NOUNS = ["Jazz Night", "Salsa Party", "Wine Tasting", "Stand-Up Show", "Art Walk", "Food Market", "DJ Set", "Gala"]
+COLUMNS = ["id", "name", "description", "category", "price", "start_date", "start_date_typed", "embedding"]
+
+
+def load_templates(path: str = SEED_DATA_PATH) -> list[dict]:
+    if os.path.exists(path):
+        with open(path, encoding="utf-8") as f:
+            return [
+                {"name": e["Name"], "description": e["Description"], "category": e["Category"]} for e in json.load(f)
+            ]
+    logger.info("No seed data at %s, using built-in vocabulary", path)
+    return [
+        {
+            "name": f"{adjective} {noun}",
+            "description": f"A {adjective.lower()} {noun.lower()} in Miami. Tickets, drinks and music all evening.",
+            "category": category,
+        }
+        for adjective in ADJECTIVES
+        for noun in NOUNS
+        for category in CATEGORIES[:2]
+    ]
+
+
+def generate_events(
+    rows: int, dimensions: int = 1536, seed: int = 42, start_id: int = 1, templates: list[dict] | None = None
+) -> Iterator[tuple]:
+    """Yield kefi_events records in COPY column order."""
+    templates = templates or load_templates()
+    rng = np.random.default_rng(seed)
+    randomizer = random.Random(seed)
+    today = datetime.date.today()
+    batch_size = 10_000
+    for batch_start in range(0, rows, batch_size):
+        count = min(batch_size, rows - batch_start)
+        embeddings = rng.standard_normal((count, dimensions), dtype=np.float32)
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        for offset in range(count):
+            row_id = start_id + batch_start + offset
+            template = templates[row_id % len(templates)]
+            start_date = today + datetime.timedelta(days=randomizer.randint(-365, 365))
+            yield (
+                row_id,
+                f"{template['name']} #{row_id}",
+                template["description"],
+                template["category"],
+                round(randomizer.choice([0, 0, 10, 15, 20, 25, 35, 50, 75, 120]) * randomizer.uniform(0.8, 1.2), 2),
+                start_date.isoformat(),
+                start_date,
+                embeddings[offset],
+            )
+
+
+def bundle_records(bundle_dir: str) -> Iterator[tuple]:
+    metadata, embeddings = read_seed_bundle(bundle_dir)
+    for row, event in enumerate(metadata):
+        start_date = datetime.date.fromisoformat(event["Start Date"])
+        yield (
+            event["Id"],
+            event["Name"],
+            event["Description"],
+            event["Category"],
+            event["Price"],
+            event["Start Date"],
+            start_date,
+            embeddings[row],
+        )
+
+
+def write_bundle(bundle_dir: str, rows: int, dimensions: int = 1536, seed: int = 42, start_id: int = 1):
+    write_seed_bundle(
+        bundle_dir,
+        (
+            {
+                "Id": row_id,
+                "Name": name,
+                "Description": description,
+                "Category": category,
+                "Price": price,
+                "Start Date": start_date,
+                "Embedding": embedding,
+            }
+            for row_id, name, description, category, price, start_date, _, embedding in generate_events(
+                rows, dimensions, seed, start_id
+            )
+        ),
+    )
+
+
+async def load_records(engine, records: Iterator[tuple], truncate: bool = True):
+    if truncate:
+        async with engine.begin() as conn:
+            await conn.execute(text("TRUNCATE kefi_events"))
+    await copy_records(engine, "kefi_events", COLUMNS, records, on_conflict_skip=not truncate)
+
+
+async def load_events(
+    engine, rows: int, dimensions: int = 1536, seed: int = 42, start_id: int = 1, truncate: bool = True
+):
+    await load_records(engine, generate_events(rows, dimensions, seed, start_id), truncate)
+    logger.info("Loaded %d synthetic events", rows)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Load synthetic events into the kefi_events table")
+    parser.add_argument("--rows", type=int, default=10_000)
+    parser.add_argument("--dimensions", type=int, default=1536)
+    parser.add_argument("--seed", type=int, default=42)
+    parser.add_argument("--start-id", type=int, default=1)
+    parser.add_argument("--append", action="store_true", help="Do not truncate the table first")
+    parser.add_argument("--write-bundle", type=str, help="Write a seed bundle to this directory instead of loading")
+    parser.add_argument("--from-bundle", type=str, help="Load events from this seed bundle directory")
+    args = parser.parse_args()
+
+    if args.write_bundle:
+        write_bundle(args.write_bundle, args.rows, args.dimensions, args.seed, args.start_id)
+        return
+
+    engine = await create_postgres_engine_from_env()
+    if args.from_bundle:
+        await load_records(engine, bundle_records(args.from_bundle), truncate=not args.append)
+    else:
+        await load_events(engine, args.rows, args.dimensions, args.seed, args.start_id, truncate=not args.append)
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    load_dotenv(override=True)
+    asyncio.run(main())
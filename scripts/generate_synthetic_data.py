@@ -1,45 +1,26 @@
-import csv
-import json
-
-from openai import OpenAI
-
-# Set up your OpenAI API key
-client = OpenAI(api_key="sk-proj-Zhm6xQUqTCg3omqOws2QT3BlbkFJMzG65F1LwKDNzzZWyxFE")
-
+"""
+Generate seed events with embeddings from the Miami events CSV.
 
-def generate_embedding(text):
-    response = client.embeddings.create(input=text, model="text-embedding-ada-002")
-    return response.data[0].embedding
+Rows are streamed from the CSV and embedded in batches, with a bounded number of requests in flight. Each event is
+written as one JSON line as soon as its batch returns, with the embedding kept as the base64 float32 payload that
+the API sends back, so nothing is held in memory and the seeder can load the file directly. Re-running the script
+skips the row ids that are already in the output file.
 
+    python generate_synthetic_data.py --output ../src/fastapi_app/seed_data_events.jsonl
+"""
 
-def process_csv(file_path, max_rows):
-    events = []
-    row_count = 0
-
-    with open(file_path) as csvfile:
-        reader = csv.DictReader(csvfile)
-        for row in reader:
-            if row_count >= max_rows:
-                break
-
-            event = {
-                "Id": row_count + 1,
-                "Name": row["title"],
-                "Description": row["summary"],
-                "Category": row["tags"],
-                "Price": parsed_price(row["min_price"]),
-                "Start Date": row["start_date"],
-                "Embedding": [],
-            }
-
-            # Generate embedding
-            embedding_text = f"{row['title']} {row['summary']} {row['tags']}"
-            event["Embedding"] = generate_embedding(embedding_text)
+import argparse
+import asyncio
+import csv
+import json
+import logging
+import os
+from collections.abc import Iterator
 
-            events.append(event)
-            row_count += 1
+import openai
+from dotenv import load_dotenv
 
-    return events
+logger = logging.getLogger("ragapp")
 
 
 def parsed_price(value, default=0.00):
@@ -56,12 +37,107 @@ def parsed_price(value, default=0.00):
     return None
 
 
-# Process the CSV and generate JSON
-csv_file_path = "miami_download.csv"
-events_data = process_csv(csv_file_path, max_rows=2365)
-
-# Save to JSON file
-with open("events_with_embeddings.json", "w") as jsonfile:
-    json.dump(events_data, jsonfile, indent=2)
-
-print(f"Processed {len(events_data)} events and saved to events_with_embeddings.json")
+def read_events(file_path: str, max_rows: int, done_ids: set[int]) -> Iterator[tuple[dict, str]]:
+    with open(file_path, newline="", encoding="utf-8") as csvfile:
+        reader = csv.DictReader(csvfile)
+        for row_count, row in enumerate(reader):
+            if row_count >= max_rows:
+                break
+            event_id = row_count + 1
+            if event_id in done_ids:
+                continue
+            event = {
+                "Id": event_id,
+                "Name": row["title"],
+                "Description": row["summary"],
+                "Category": row["tags"],
+                "Price": parsed_price(row["min_price"]),
+                "Start Date": row["start_date"],
+            }
+            yield event, f"{row['title']} {row['summary']} {row['tags']}"
+
+
+def read_done_ids(output_path: str) -> set[int]:
+    done_ids = set()
+    if os.path.exists(output_path):
+        with open(output_path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    done_ids.add(json.loads(line)["Id"])
+                except (json.JSONDecodeError, KeyError):
+                    # A partial last line from an interrupted run; that row is generated again
+                    continue
+    return done_ids
+
+
+def batched(items: Iterator, batch_size: int) -> Iterator[list]:
+    batch = []
+    for item in items:
+        batch.append(item)
+        if len(batch) == batch_size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+async def embed_batch(client: openai.AsyncOpenAI, texts: list[str], model: str, retries: int) -> list[str]:
+    for attempt in range(retries + 1):
+        try:
+            response = await client.embeddings.create(input=texts, model=model, encoding_format="base64")
+            return [data.embedding for data in sorted(response.data, key=lambda data: data.index)]
+        except (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError) as e:
+            if attempt == retries:
+                raise
+            delay = 2**attempt
+            logger.warning("Embedding batch failed (%s), retrying in %ds", e, delay)
+            await asyncio.sleep(delay)
+
+
+async def generate(args):
+    client = openai.AsyncOpenAI(api_key=os.getenv("OPENAICOM_KEY"), max_retries=0)
+    done_ids = read_done_ids(args.output)
+    if done_ids:
+        logger.info("Resuming, %d events already in %s", len(done_ids), args.output)
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    written = 0
+
+    with open(args.output, "a", encoding="utf-8") as output:
+
+        async def process(batch: list[tuple[dict, str]]):
+            nonlocal written
+            try:
+                embeddings = await embed_batch(client, [text for _, text in batch], args.model, args.retries)
+                for (event, _), embedding in zip(batch, embeddings):
+                    output.write(json.dumps(event | {"Embedding": embedding}, separators=(",", ":")) + "\n")
+                output.flush()
+                written += len(batch)
+            finally:
+                semaphore.release()
+
+        # A batch that fails after its retries cancels the batches in flight, which finish before the file is
+        # closed, and stops new batches from being scheduled
+        async with asyncio.TaskGroup() as task_group:
+            for batch in batched(read_events(args.input, args.max_rows, done_ids), args.batch_size):
+                # Acquire before creating the task so that at most `concurrency` batches are read ahead of the API
+                await semaphore.acquire()
+                task_group.create_task(process(batch))
+
+    logger.info("Wrote %d events to %s", written, args.output)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    load_dotenv(override=True)
+
+    parser = argparse.ArgumentParser(description="Generate seed events with embeddings from a CSV")
+    parser.add_argument("--input", type=str, default="miami_download.csv")
+    parser.add_argument("--output", type=str, default="events_with_embeddings.jsonl")
+    parser.add_argument("--max-rows", type=int, default=2365)
+    parser.add_argument("--model", type=str, default="text-embedding-ada-002")
+    parser.add_argument("--batch-size", type=int, default=100, help="Inputs per embeddings request")
+    parser.add_argument("--concurrency", type=int, default=4, help="Embeddings requests in flight")
+    parser.add_argument("--retries", type=int, default=5)
+    asyncio.run(generate(parser.parse_args()))
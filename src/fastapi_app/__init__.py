@@ -2,25 +2,65 @@ import contextlib
 import logging
 import os
 
-import azure.identity
 from dotenv import load_dotenv
-from environs import Env
-from fastapi import FastAPI
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
+from sqlalchemy.ext.asyncio import async_sessionmaker
 
+from .catalog_changes import CatalogChangeListener, CatalogChanges, ensure_change_notifications
+from .chat_jobs import ChatJobRunner, MemoryJobStore, PostgresJobStore
+from .chat_routing import ChatBackend, create_routing_client_from_env
+from .chat_sessions import ChatSessionStore, install_session_expiry
+from .concurrency import LimitedOpenAIClient, UpstreamOverloadedError, create_limiter_from_env
+from .embedding_batcher import EmbeddingBatcher
+from .event_partitions import is_partitioned
 from .globals import global_storage
+from .http_clients import close_shared_http_clients
+from .model_router import ChatModel, create_model_router_from_env
 from .openai_clients import create_openai_chat_client, create_openai_embed_client
-from .postgres_engine import create_postgres_engine_from_env
+from .postgres_engine import (
+    create_postgres_engine_from_env,
+    create_postgres_replica_engines_from_env,
+    create_postgres_shard_engines_from_env,
+)
+from .postgres_replicas import ReadReplicas, Replica
+from .search_cache import EventRowCache, SearchResultCache
+from .search_planner import FilteredSearchPlanner
+from .sharded_searcher import Shard
+from .suggest_index import SuggestIndex
+from .warmup import warm_up
 
 logger = logging.getLogger("ragapp")
 
 
+def chat_backend_hosts() -> list[str]:
+    # OPENAI_CHAT_BACKENDS lists several hosts to route chat requests across, in order of preference
+    if backends := os.getenv("OPENAI_CHAT_BACKENDS"):
+        return [host.strip() for host in backends.split(",") if host.strip()]
+    return [os.getenv("OPENAI_CHAT_HOST")]
+
+
+def uses_azure_identity() -> bool:
+    # azure.identity is slow to import, so only load it when a configured service authenticates with it
+    azure_openai_with_token = (
+        "azure" in chat_backend_hosts() or os.getenv("OPENAI_EMBED_HOST") == "azure"
+    ) and not os.getenv("AZURE_OPENAI_KEY")
+    postgres_hosts = [os.getenv("POSTGRES_HOST", ""), *os.getenv("POSTGRES_REPLICA_HOSTS", "").split(",")]
+    azure_postgres = any(host.strip().endswith(".database.azure.com") for host in postgres_hosts)
+    return azure_openai_with_token or azure_postgres
+
+
 @contextlib.asynccontextmanager
 async def lifespan(app: FastAPI):
     load_dotenv(override=True)
 
     azure_credential = None
     try:
-        if client_id := os.getenv("APP_IDENTITY_ID"):
+        if not uses_azure_identity():
+            logger.info("No Azure services use token authentication, skipping Azure credential")
+        elif client_id := os.getenv("APP_IDENTITY_ID"):
+            import azure.identity
+
             # Authenticate using a user-assigned managed identity on Azure
             # See web.bicep for value of APP_IDENTITY_ID
             logger.info(
@@ -29,30 +69,245 @@ async def lifespan(app: FastAPI):
             )
             azure_credential = azure.identity.ManagedIdentityCredential(client_id=client_id)
         else:
+            import azure.identity
+
             azure_credential = azure.identity.DefaultAzureCredential()
     except Exception as e:
         logger.warning("Failed to authenticate to Azure: %s", e)
 
     engine = await create_postgres_engine_from_env(azure_credential)
     global_storage.engine = engine
+    # Databases set up before events were versioned get the columns that Kefi_Event now maps
+    async with engine.begin() as conn:
+        await ensure_change_notifications(conn)
 
-    openai_chat_client, openai_chat_model = await create_openai_chat_client(azure_credential)
+    chat_hosts = chat_backend_hosts()
+    if len(chat_hosts) == 1:
+        openai_chat_client, openai_chat_model = await create_openai_chat_client(azure_credential, max_retries=0)
+        openai_chat_client = LimitedOpenAIClient(
+            openai_chat_client, chat_limiter=create_limiter_from_env("chat", "OPENAI_CHAT")
+        )
+    else:
+        # Hedge slow requests and fail over across the backends, each with its own concurrency limit
+        chat_backends = []
+        for host in chat_hosts:
+            client, model = await create_openai_chat_client(azure_credential, host, max_retries=0)
+            # No retries on a backend: failing over to the next one is faster
+            limiter = create_limiter_from_env(f"chat:{host}", "OPENAI_CHAT", max_retries=0)
+            client = LimitedOpenAIClient(client, chat_limiter=limiter)
+            chat_backends.append(ChatBackend(name=host, client=client, model=model))
+        openai_chat_client = create_routing_client_from_env(chat_backends)
+        openai_chat_model = chat_backends[0].model
+        logger.info("Routing chat requests across %s", ", ".join(chat_hosts))
     global_storage.openai_chat_client = openai_chat_client
     global_storage.openai_chat_model = openai_chat_model
 
+    # With a small chat model configured for the primary host, easy questions are answered by it (see model_router)
+    small_chat_client, small_chat_model = await create_openai_chat_client(
+        azure_credential, chat_hosts[0], small=True, max_retries=0
+    )
+    if small_chat_model:
+        small_chat_client = LimitedOpenAIClient(
+            small_chat_client, chat_limiter=create_limiter_from_env("chat:small", "OPENAI_CHAT")
+        )
+        global_storage.model_router = create_model_router_from_env(
+            small=ChatModel(small_chat_client, small_chat_model),
+            large=ChatModel(openai_chat_client, openai_chat_model),
+        )
+        logger.info("Routing easy chat steps to %s and the rest to %s", small_chat_model, openai_chat_model)
+
+    # Server-side conversation history for clients that send a session_id (set CHAT_SESSIONS_ENABLED=false to disable)
+    if os.getenv("CHAT_SESSIONS_ENABLED", "true").lower() == "true":
+        summarizer = global_storage.model_router.small if global_storage.model_router else None
+        session_ttl = float(os.getenv("CHAT_SESSION_TTL_SECONDS", str(7 * 24 * 3600)))
+        # Tables created before sessions expired have no expires_at yet
+        async with engine.begin() as conn:
+            await install_session_expiry(conn, session_ttl)
+        global_storage.chat_session_store = ChatSessionStore(
+            engine,
+            token_model=openai_chat_model,
+            summary_client=summarizer.client if summarizer else openai_chat_client,
+            summary_model=summarizer.model if summarizer else openai_chat_model,
+            history_token_limit=int(os.getenv("CHAT_SESSION_HISTORY_TOKENS", "2000")),
+            keep_recent_messages=int(os.getenv("CHAT_SESSION_KEEP_MESSAGES", "4")),
+            ttl=session_ttl,
+        )
+        global_storage.chat_session_store.start()
+
     openai_embed_client, openai_embed_model, openai_embed_dimensions = await create_openai_embed_client(
-        azure_credential
+        azure_credential, max_retries=0
+    )
+    openai_embed_client = LimitedOpenAIClient(
+        openai_embed_client, embed_limiter=create_limiter_from_env("embeddings", "OPENAI_EMBED")
     )
     global_storage.openai_embed_client = openai_embed_client
     global_storage.openai_embed_model = openai_embed_model
     global_storage.openai_embed_dimensions = openai_embed_dimensions
+    # OpenAI embeddings are already unit length; normalize those of other models so inner product search is valid
+    global_storage.openai_embed_normalize = os.getenv("OPENAI_EMBED_NORMALIZE", "false").lower() == "true"
+
+    # Coalesce embedding calls from concurrent requests into batched API calls (set the window to 0 to disable)
+    if (embed_batch_window_ms := float(os.getenv("EMBED_BATCH_WINDOW_MS", "5"))) > 0:
+        embedding_batcher = EmbeddingBatcher(
+            openai_embed_client,
+            openai_embed_model,
+            global_storage.openai_embed_deployment,
+            openai_embed_dimensions,
+            max_batch_size=int(os.getenv("EMBED_BATCH_MAX_SIZE", "16")),
+            max_wait_ms=embed_batch_window_ms,
+            normalize=global_storage.openai_embed_normalize,
+        )
+        embedding_batcher.start()
+        global_storage.embedding_batcher = embedding_batcher
+
+    # Choose how filtered vector searches run from the table statistics (set SEARCH_PLANNER_ENABLED=false to disable)
+    if os.getenv("SEARCH_PLANNER_ENABLED", "true").lower() == "true":
+        global_storage.search_planner = FilteredSearchPlanner(
+            exact_scan_max_rows=int(os.getenv("SEARCH_EXACT_SCAN_MAX_ROWS", "5000")),
+            max_ef_search=int(os.getenv("SEARCH_MAX_EF_SEARCH", "1000")),
+        )
+
+    # Typo tolerant trigram leg for searches (needs pg_trgm and the trigram indexes from setup_postgres_database)
+    global_storage.fuzzy_search = os.getenv("SEARCH_FUZZY_ENABLED", "false").lower() == "true"
+    global_storage.fuzzy_threshold = float(os.getenv("SEARCH_FUZZY_THRESHOLD", "0.5"))
+    # Skip the embedding and vector leg when full text results are decisive (for retrieval_mode unset)
+    global_storage.adaptive_retrieval = os.getenv("SEARCH_ADAPTIVE_ENABLED", "false").lower() == "true"
+    global_storage.adaptive_min_margin = float(os.getenv("SEARCH_ADAPTIVE_MIN_MARGIN", "2.0"))
+
+    # Caches of event data register with catalog_changes, which every worker keeps current from NOTIFY messages
+    global_storage.catalog_changes = CatalogChanges()
+    if os.getenv("CATALOG_LISTENER_ENABLED", "true").lower() == "true":
+        global_storage.catalog_change_listener = CatalogChangeListener(engine, global_storage.catalog_changes)
+        global_storage.catalog_change_listener.start()
+
+        # Repeated searches reuse ranked ids and event rows. Only safe while changes are being listened for.
+        if os.getenv("SEARCH_CACHE_ENABLED", "true").lower() == "true":
+            global_storage.search_result_cache = SearchResultCache(
+                global_storage.catalog_changes, max_bytes=int(float(os.getenv("SEARCH_CACHE_MAX_MB", "16")) * 2**20)
+            )
+            global_storage.event_row_cache = EventRowCache(
+                global_storage.catalog_changes, max_bytes=int(float(os.getenv("EVENT_ROW_CACHE_MAX_MB", "64")) * 2**20)
+            )
+
+    # Searches and item lookups read from replicas when POSTGRES_REPLICA_HOSTS lists any (see postgres_replicas)
+    if replica_engines := await create_postgres_replica_engines_from_env(azure_credential):
+        global_storage.read_replicas = ReadReplicas(
+            engine,
+            [Replica(host, replica_engine) for host, replica_engine in replica_engines.items()],
+            max_lag_seconds=float(os.getenv("POSTGRES_REPLICA_MAX_LAG_SECONDS", "5")),
+            check_interval=float(os.getenv("POSTGRES_REPLICA_CHECK_INTERVAL_SECONDS", "5")),
+        )
+        global_storage.catalog_changes.register(global_storage.read_replicas.on_catalog_change)
+        global_storage.read_replicas.start()
+        logger.info("Reading events from replicas %s", ", ".join(replica_engines))
+
+    # With POSTGRES_SHARDS, searches scatter to every shard and merge their results (see sharded_searcher)
+    if shard_engines := await create_postgres_shard_engines_from_env(azure_credential):
+        global_storage.search_shard_candidates = int(os.getenv("SEARCH_SHARD_CANDIDATES", "20"))
+        global_storage.search_shard_timeout = float(os.getenv("SEARCH_SHARD_TIMEOUT_MS", "2000")) / 1000
+        for name, shard_engine in shard_engines.items():
+            async with shard_engine.begin() as conn:
+                await ensure_change_notifications(conn)
+            shard_planner = None
+            if global_storage.search_planner is not None:
+                shard_planner = FilteredSearchPlanner(
+                    exact_scan_max_rows=global_storage.search_planner.exact_scan_max_rows,
+                    max_ef_search=global_storage.search_planner.max_ef_search,
+                )
+            global_storage.search_shards.append(Shard(name, shard_engine, shard_planner))
+            if global_storage.catalog_change_listener is not None:
+                # Each shard's triggers notify on its own connection
+                listener = CatalogChangeListener(shard_engine, global_storage.catalog_changes)
+                listener.start()
+                global_storage.shard_change_listeners.append(listener)
+        logger.info("Searching events across shards %s", ", ".join(shard_engines))
+
+    # Typeahead suggestions for GET /suggest, served from memory (see suggest_index)
+    if os.getenv("SUGGEST_ENABLED", "true").lower() == "true":
+        if global_storage.search_shards:
+            suggest_sources = [shard.session_maker for shard in global_storage.search_shards]
+        elif global_storage.read_replicas is not None:
+            suggest_sources = [global_storage.read_replicas.session]
+        else:
+            suggest_sources = [async_sessionmaker(engine, expire_on_commit=False)]
+        global_storage.suggest_index = SuggestIndex(
+            suggest_sources,
+            refresh_interval=float(os.getenv("SUGGEST_REFRESH_SECONDS", "5")),
+            rebuild_interval=float(os.getenv("SUGGEST_REBUILD_SECONDS", "3600")),
+        )
+        global_storage.catalog_changes.register(global_storage.suggest_index.on_catalog_change)
+        global_storage.suggest_index.start()
+
+    # When kefi_events is partitioned by month (see event_partitions), undated searches only cover upcoming events
+    try:
+        async with engine.connect() as conn:
+            global_storage.events_partitioned = await is_partitioned(conn)
+    except Exception as e:
+        logger.warning("Could not check whether kefi_events is partitioned: %s", e)
+
+    # Background chat jobs (POST /chat/jobs). The memory store only suits a single worker process.
+    if os.getenv("CHAT_JOBS_ENABLED", "true").lower() == "true":
+        from .api_routes import run_chat
+
+        job_store = MemoryJobStore() if os.getenv("CHAT_JOBS_STORE") == "memory" else PostgresJobStore(engine)
+        global_storage.chat_job_runner = ChatJobRunner(
+            job_store,
+            run_chat,
+            workers=int(os.getenv("CHAT_JOBS_WORKERS", "4")),
+            max_queue=int(os.getenv("CHAT_JOBS_MAX_QUEUE", "100")),
+            ttl=float(os.getenv("CHAT_JOBS_TTL_SECONDS", "3600")),
+            deadline_seconds=float(os.getenv("CHAT_JOBS_DEADLINE_MS", "120000")) / 1000,
+        )
+        global_storage.chat_job_runner.start()
+
+    if os.getenv("WARMUP_ENABLED", "true").lower() == "true":
+        await warm_up(
+            engine=engine,
+            openai_chat_client=openai_chat_client,
+            openai_chat_model=openai_chat_model,
+            openai_embed_client=openai_embed_client,
+            openai_embed_model=openai_embed_model,
+            openai_embed_dimensions=openai_embed_dimensions,
+            connections=int(os.getenv("WARMUP_POSTGRES_CONNECTIONS", "2")),
+            prewarm_indexes=os.getenv("WARMUP_PREWARM_INDEXES", "false").lower() == "true",
+            timeout=float(os.getenv("WARMUP_TIMEOUT_SECONDS", "30")),
+        )
+    global_storage.ready = True
 
     yield
 
+    global_storage.ready = False
+    if global_storage.catalog_change_listener is not None:
+        await global_storage.catalog_change_listener.stop()
+        global_storage.catalog_change_listener = None
+    if global_storage.chat_job_runner is not None:
+        await global_storage.chat_job_runner.stop()
+        global_storage.chat_job_runner = None
+    if global_storage.chat_session_store is not None:
+        await global_storage.chat_session_store.stop()
+        global_storage.chat_session_store = None
+    if global_storage.suggest_index is not None:
+        await global_storage.suggest_index.stop()
+        global_storage.suggest_index = None
+    for listener in global_storage.shard_change_listeners:
+        await listener.stop()
+    global_storage.shard_change_listeners = []
+    for shard in global_storage.search_shards:
+        await shard.engine.dispose()
+    global_storage.search_shards = []
+    if global_storage.read_replicas is not None:
+        await global_storage.read_replicas.stop()
+        global_storage.read_replicas = None
+    if global_storage.embedding_batcher is not None:
+        await global_storage.embedding_batcher.stop()
+        global_storage.embedding_batcher = None
+    await close_shared_http_clients()
     await engine.dispose()
 
 
 def create_app():
+    from environs import Env
+
     env = Env()
 
     if not os.getenv("RUNNING_IN_PRODUCTION"):
@@ -63,6 +318,19 @@ def create_app():
 
     app = FastAPI(docs_url="/docs", lifespan=lifespan)
 
+    @app.exception_handler(UpstreamOverloadedError)
+    async def upstream_overloaded_handler(request: Request, exc: UpstreamOverloadedError):
+        return JSONResponse(
+            status_code=503,
+            content={"detail": str(exc)},
+            headers={"Retry-After": str(exc.retry_after)},
+        )
+
+    @app.exception_handler(TimeoutError)
+    async def deadline_exceeded_handler(request: Request, exc: TimeoutError):
+        # A stage ran out of its deadline budget with no fallback left
+        return JSONResponse(status_code=504, content={"detail": str(exc) or "The request ran out of time"})
+
     from . import api_routes  # noqa
     from . import frontend_routes  # noqa
 
@@ -0,0 +1,74 @@
+"""
+Adaptive retrieval: rank by full text search first, and only embed the query and run the hybrid search when the
+full text results aren't decisive. Lookups of an event by name are then answered without an embedding call or
+the vector leg.
+
+Full text results are decisive when the top result is the only one whose name has every word of the query, or
+when its ts_rank_cd is at least min_margin times the runner-up's. A lone full text match that isn't a name match is
+not decisive, as the vector leg may find related events that share none of the query's words.
+"""
+
+import logging
+import math
+from dataclasses import dataclass
+
+from .metrics import ADAPTIVE_RETRIEVALS
+
+logger = logging.getLogger("ragapp")
+
+
+@dataclass
+class LexicalHit:
+    id: int
+    score: float  # ts_rank_cd of the description
+    name_match: bool  # Every word of the query is in the event's name
+
+
+@dataclass
+class RetrievalDecision:
+    """Which legs ranked an adaptive search, and why. Reported in the search ThoughtStep."""
+
+    mode: str  # "text" when the full text results were decisive and the embedding was skipped, else "hybrid"
+    reason: str
+    top_score: float | None = None
+    margin: float | None = None  # Top ts_rank_cd over the runner-up's
+
+    @property
+    def embedding_skipped(self) -> bool:
+        return self.mode == "text"
+
+    def to_dict(self):
+        return {
+            "mode": self.mode,
+            "reason": self.reason,
+            "top_score": round(self.top_score, 5) if self.top_score is not None else None,
+            # None too when the runner-up scored 0, as JSON has no infinity
+            "margin": round(self.margin, 3) if self.margin is not None and math.isfinite(self.margin) else None,
+            "embedding_skipped": self.embedding_skipped,
+        }
+
+
+def decide(hits: list[LexicalHit], min_margin: float) -> RetrievalDecision:
+    """Whether the full text hits, best first, are decisive enough to skip the vector leg."""
+    if not hits:
+        return RetrievalDecision("hybrid", "no text matches")
+    top = hits[0]
+    if len(hits) == 1:
+        if top.name_match:
+            return RetrievalDecision("text", "name match", top.score)
+        return RetrievalDecision("hybrid", "one text match", top.score)
+    runner_up = hits[1]
+    margin = top.score / runner_up.score if runner_up.score > 0 else math.inf
+    if top.name_match and not any(hit.name_match for hit in hits[1:]):
+        return RetrievalDecision("text", "name match", top.score, margin)
+    if margin >= min_margin:
+        return RetrievalDecision("text", "score margin", top.score, margin)
+    if top.name_match:
+        return RetrievalDecision("hybrid", "several name matches", top.score, margin)
+    return RetrievalDecision("hybrid", "close scores", top.score, margin)
+
+
+def record_decision(decision: RetrievalDecision) -> None:
+    # The count of mode="text" decisions is the number of embedding calls saved
+    ADAPTIVE_RETRIEVALS.labels(decision.mode, decision.reason).inc()
+    logger.debug("Adaptive retrieval ranked by %s: %s", decision.mode, decision.reason)
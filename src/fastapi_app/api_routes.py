@@ -1,21 +1,68 @@
+import asyncio
+from collections.abc import Callable
+from typing import Any
+
 import fastapi
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
 from fastapi_app.api_models import ChatRequest
+from fastapi_app.chat_jobs import IdempotencyConflictError
+from fastapi_app.chat_sessions import ChatSessionNotFoundError
+from fastapi_app.deadlines import Deadline, cancel_on_disconnect, deadline_from_headers, request_deadline
 from fastapi_app.globals import global_storage
+from fastapi_app.metrics import render_latest, request_timings, stage
 from fastapi_app.postgres_models import Kefi_Event
 from fastapi_app.postgres_searcher import PostgresSearcher
 from fastapi_app.rag_advanced import AdvancedRAGChat
 from fastapi_app.rag_simple import SimpleRAGChat
+from fastapi_app.sharded_searcher import ShardedSearcher
 
 router = fastapi.APIRouter()
 
 
+def read_session_maker():
+    """Sessions for read-only lookups, on a read replica when there is one."""
+    if global_storage.read_replicas is not None:
+        return global_storage.read_replicas.session
+    return async_sessionmaker(global_storage.engine, expire_on_commit=False)
+
+
+def create_searcher() -> PostgresSearcher:
+    searcher_args = dict(
+        openai_embed_client=global_storage.openai_embed_client,
+        embed_deployment=global_storage.openai_embed_deployment,
+        embed_model=global_storage.openai_embed_model,
+        embed_dimensions=global_storage.openai_embed_dimensions,
+        embed_normalize=global_storage.openai_embed_normalize,
+        embedding_batcher=global_storage.embedding_batcher,
+        upcoming_only=global_storage.events_partitioned,
+        result_cache=global_storage.search_result_cache,
+        row_cache=global_storage.event_row_cache,
+        fuzzy_search=global_storage.fuzzy_search,
+        fuzzy_threshold=global_storage.fuzzy_threshold,
+        adaptive_retrieval=global_storage.adaptive_retrieval,
+        adaptive_min_margin=global_storage.adaptive_min_margin,
+    )
+    if global_storage.search_shards:
+        return ShardedSearcher(
+            global_storage.search_shards,
+            candidate_depth=global_storage.search_shard_candidates,
+            shard_timeout=global_storage.search_shard_timeout,
+            **searcher_args,
+        )
+    return PostgresSearcher(
+        global_storage.engine,
+        search_planner=global_storage.search_planner,
+        read_replicas=global_storage.read_replicas,
+        **searcher_args,
+    )
+
+
 @router.get("/items/{id}")
 async def item_handler(id: int):
     """A simple API to get an item by ID."""
-    async_session_maker = async_sessionmaker(global_storage.engine, expire_on_commit=False)
+    async_session_maker = read_session_maker()
     async with async_session_maker() as session:
         item = (await session.scalars(select(Kefi_Event).where(Kefi_Event.id == id))).first()
         return item.to_dict()
@@ -24,7 +71,7 @@ async def item_handler(id: int):
 @router.get("/similar")
 async def similar_handler(id: int, n: int = 5):
     """A similarity API to find events similar to events with given ID."""
-    async_session_maker = async_sessionmaker(global_storage.engine, expire_on_commit=False)
+    async_session_maker = read_session_maker()
     async with async_session_maker() as session:
         item = (await session.scalars(select(Kefi_Event).where(Kefi_Event.id == id))).first()
         closest = await session.execute(
@@ -37,47 +84,190 @@ async def similar_handler(id: int, n: int = 5):
 
 
 @router.get("/search")
-async def search_handler(query: str, top: int = 5, enable_vector_search: bool = True, enable_text_search: bool = True):
-    """A search API to find events based on a query."""
-    searcher = PostgresSearcher(
-        global_storage.engine,
-        openai_embed_client=global_storage.openai_embed_client,
-        embed_deployment=global_storage.openai_embed_deployment,
-        embed_model=global_storage.openai_embed_model,
-        embed_dimensions=global_storage.openai_embed_dimensions,
-    )
-    results = await searcher.search_and_embed(
-        query, top=top, enable_vector_search=enable_vector_search, enable_text_search=enable_text_search
-    )
-    return [item.to_dict() for item in results]
+async def search_handler(
+    request: fastapi.Request,
+    query: str,
+    top: int = 5,
+    enable_vector_search: bool = True,
+    enable_text_search: bool = True,
+    enable_fuzzy_search: bool | None = None,
+    enable_adaptive_retrieval: bool | None = None,
+):
+    """
+    A search API to find events based on a query. enable_fuzzy_search matches misspelled names and categories
+    (defaults to SEARCH_FUZZY_ENABLED). enable_adaptive_retrieval skips the embedding when full text results are
+    decisive (defaults to SEARCH_ADAPTIVE_ENABLED).
+    """
+    searcher = create_searcher()
+    with request_timings("search"), request_deadline(deadline_from_headers(request.headers)):
+        results = await searcher.search_and_embed(
+            query,
+            top=top,
+            enable_vector_search=enable_vector_search,
+            enable_text_search=enable_text_search,
+            enable_fuzzy_search=enable_fuzzy_search,
+            enable_adaptive_retrieval=enable_adaptive_retrieval,
+        )
+        if global_storage.suggest_index is not None:
+            global_storage.suggest_index.record_hits([item.id for item in results])
+        with stage("serialization"):
+            return [item.to_dict() for item in results]
 
 
-@router.post("/chat")
-async def chat_handler(chat_request: ChatRequest):
-    messages = [message.model_dump() for message in chat_request.messages]
-    overrides = chat_request.context.get("overrides", {})
+@router.get("/suggest")
+async def suggest_handler(prefix: str, limit: int = 5):
+    """Typeahead suggestions (event names and categories) for a prefix, answered from memory."""
+    suggest_index = global_storage.suggest_index
+    if suggest_index is None:
+        raise fastapi.HTTPException(status_code=404, detail="Suggestions are disabled")
+    if not suggest_index.ready:
+        raise fastapi.HTTPException(status_code=503, detail="Suggestions are still loading")
+    limit = min(max(limit, 1), suggest_index.max_suggestions)
+    return [suggestion.to_dict() for suggestion in suggest_index.suggest(prefix, limit)]
 
-    searcher = PostgresSearcher(
-        global_storage.engine,
-        openai_embed_client=global_storage.openai_embed_client,
-        embed_deployment=global_storage.openai_embed_deployment,
-        embed_model=global_storage.openai_embed_model,
-        embed_dimensions=global_storage.openai_embed_dimensions,
-    )
+
+@router.post("/sessions")
+async def create_session_handler():
+    """Start a server-side conversation. Send its session_id in the chat context to only send each new message."""
+    if global_storage.chat_session_store is None:
+        raise fastapi.HTTPException(status_code=404, detail="Chat sessions are disabled")
+    return {"session_id": await global_storage.chat_session_store.create()}
+
+
+@router.delete("/sessions/{session_id}")
+async def delete_session_handler(session_id: str):
+    if global_storage.chat_session_store is None or not await global_storage.chat_session_store.delete(session_id):
+        raise fastapi.HTTPException(status_code=404, detail="Unknown chat session")
+    return {"status": "deleted"}
+
+
+def create_ragchat(overrides: dict) -> SimpleRAGChat | AdvancedRAGChat:
+    searcher = create_searcher()
     if overrides.get("use_advanced_flow"):
-        ragchat = AdvancedRAGChat(
-            searcher=searcher,
-            openai_chat_client=global_storage.openai_chat_client,
-            chat_model=global_storage.openai_chat_model,
-            chat_deployment=global_storage.openai_chat_deployment,
-        )
-    else:
-        ragchat = SimpleRAGChat(
+        return AdvancedRAGChat(
             searcher=searcher,
             openai_chat_client=global_storage.openai_chat_client,
             chat_model=global_storage.openai_chat_model,
             chat_deployment=global_storage.openai_chat_deployment,
+            model_router=global_storage.model_router,
         )
+    return SimpleRAGChat(
+        searcher=searcher,
+        openai_chat_client=global_storage.openai_chat_client,
+        chat_model=global_storage.openai_chat_model,
+        chat_deployment=global_storage.openai_chat_deployment,
+        model_router=global_storage.model_router,
+    )
+
+
+async def run_chat(
+    chat_request: ChatRequest,
+    deadline: Deadline,
+    schedule: Callable[..., Any],
+    request: fastapi.Request | None = None,
+) -> dict | None:
+    """
+    Run the chat pipeline for a request, by the /chat handler or a chat job worker. schedule(func, *args) runs work
+    that the response doesn't wait for. With request, the run is cancelled (returning None) if the client disconnects.
+    """
+    messages = [message.model_dump() for message in chat_request.messages]
+    overrides = chat_request.context.get("overrides", {})
+
+    # With a session, the request only carries the new message and the history is loaded from the server
+    session_id = chat_request.context.get("session_id")
+    session_store = global_storage.chat_session_store
+    new_messages = messages
+    if session_id is not None:
+        if session_store is None:
+            raise fastapi.HTTPException(status_code=404, detail="Chat sessions are disabled")
+        try:
+            messages = await session_store.get_history(session_id) + new_messages
+        except ChatSessionNotFoundError:
+            raise fastapi.HTTPException(status_code=404, detail="Unknown chat session")
 
-    response = await ragchat.run(messages, overrides=overrides)
+    ragchat = create_ragchat(overrides)
+    # Each stage runs within its own budget and the request's deadline, and degrades when out of time (see deadlines)
+    with request_timings("chat"), request_deadline(deadline):
+        # Backstop for anything outside the stage budgets, answered with a 504 like an exhausted stage
+        async with asyncio.timeout(deadline.remaining() + 1):
+            if request is None:
+                response = await ragchat.run(messages, overrides=overrides)
+            else:
+                response, disconnected = await cancel_on_disconnect(request, ragchat.run(messages, overrides=overrides))
+                if disconnected:
+                    return None
+    if deadline.degraded:
+        response["context"]["degraded"] = deadline.degraded
+
+    if session_id is not None:
+        answer = {"role": "assistant", "content": response["message"].get("content") or ""}
+        try:
+            history_tokens = await session_store.append(session_id, new_messages + [answer])
+        except ChatSessionNotFoundError:
+            raise fastapi.HTTPException(status_code=404, detail="Unknown chat session")
+        if history_tokens > session_store.history_token_limit:
+            schedule(session_store.summarize_if_needed, session_id)
+        response["context"]["session_id"] = session_id
+    return response
+
+
+@router.post("/chat")
+async def chat_handler(chat_request: ChatRequest, request: fastapi.Request, background_tasks: fastapi.BackgroundTasks):
+    # The deadline starts when the request arrives, so loading the session counts against it too
+    deadline = deadline_from_headers(request.headers)
+    # Session summaries run after the response is sent, so the turn doesn't wait for them
+    response = await run_chat(chat_request, deadline, background_tasks.add_task, request)
+    if response is None:
+        # The client is gone, so nothing reads this and the turn is not stored
+        return fastapi.Response(status_code=499)
     return response
+
+
+@router.post("/chat/jobs", status_code=202)
+async def create_chat_job_handler(chat_request: ChatRequest, idempotency_key: str | None = fastapi.Header(None)):
+    """
+    Run a chat request in the background and return its job_id right away. Retries with the same Idempotency-Key
+    header return the same job rather than running the request again.
+    """
+    if global_storage.chat_job_runner is None:
+        raise fastapi.HTTPException(status_code=404, detail="Chat jobs are disabled")
+    try:
+        job = await global_storage.chat_job_runner.submit(chat_request, idempotency_key)
+    except IdempotencyConflictError:
+        raise fastapi.HTTPException(status_code=409, detail="Idempotency-Key was already used for another request")
+    return job.to_dict()
+
+
+@router.get("/chat/jobs/{job_id}")
+async def chat_job_handler(job_id: str, wait: float = 0):
+    """The job's status, and its result once it has finished. Waits up to `wait` seconds (at most 30) for it."""
+    if global_storage.chat_job_runner is None:
+        raise fastapi.HTTPException(status_code=404, detail="Chat jobs are disabled")
+    job = await global_storage.chat_job_runner.wait(job_id, timeout=min(max(wait, 0), 30))
+    if job is None:
+        raise fastapi.HTTPException(status_code=404, detail="Unknown or expired chat job")
+    return job.to_dict()
+
+
+@router.get("/healthz")
+async def liveness_handler():
+    """Liveness probe: the worker process is up and serving requests."""
+    return {"status": "ok"}
+
+
+@router.get("/readyz")
+async def readiness_handler():
+    """
+    Readiness probe: the worker is not shutting down. Requests are only served once the lifespan startup, including
+    the warm-up, has finished, so there is no "starting" state to report; the probe gets no answer until then.
+    """
+    if not global_storage.ready:
+        return fastapi.responses.JSONResponse({"status": "draining"}, status_code=503)
+    return {"status": "ready"}
+
+
+@router.get("/metrics")
+async def metrics_handler():
+    """Prometheus metrics, aggregated across gunicorn workers when running in multiprocess mode."""
+    data, content_type = render_latest()
+    return fastapi.Response(content=data, media_type=content_type)
@@ -0,0 +1,181 @@
+"""
+Cross-worker invalidation of cached kefi_events data.
+
+Triggers keep a version and updated_at on every event row and send a NOTIFY with the changed ids after each
+statement that inserts, updates or deletes events, whichever process made the change (the API, update_embeddings,
+the seeders or psql). Each worker listens on the channel and passes the ids to the caches registered with its
+CatalogChanges, which also counts a catalog epoch for caches that can't tell which entries a change affects.
+"""
+
+import asyncio
+import logging
+from collections.abc import Callable
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from .metrics import CATALOG_INVALIDATIONS
+
+logger = logging.getLogger("ragapp")
+
+CHANNEL = "kefi_events_changed"
+# NOTIFY payloads are limited to 8000 bytes, so statements changing more ids than fit invalidate everything
+ALL_EVENTS = "*"
+
+CHANGE_NOTIFICATION_DDL = [
+    "ALTER TABLE kefi_events ADD COLUMN IF NOT EXISTS version integer NOT NULL DEFAULT 1",
+    "ALTER TABLE kefi_events ADD COLUMN IF NOT EXISTS updated_at timestamptz NOT NULL DEFAULT now()",
+    """
+    CREATE OR REPLACE FUNCTION kefi_events_bump_version() RETURNS trigger LANGUAGE plpgsql AS $$
+    BEGIN
+        NEW.version := OLD.version + 1;
+        NEW.updated_at := now();
+        RETURN NEW;
+    END $$
+    """,
+    f"""
+    CREATE OR REPLACE FUNCTION kefi_events_notify_change() RETURNS trigger LANGUAGE plpgsql AS $$
+    DECLARE
+        ids text;
+    BEGIN
+        SELECT string_agg(DISTINCT id::text, ',') INTO ids FROM changed;
+        IF ids IS NOT NULL THEN
+            PERFORM pg_notify('{CHANNEL}', CASE WHEN length(ids) > 7900 THEN '{ALL_EVENTS}' ELSE ids END);
+        END IF;
+        RETURN NULL;
+    END $$
+    """,
+    "DROP TRIGGER IF EXISTS kefi_events_bump_version ON kefi_events",
+    """
+    CREATE TRIGGER kefi_events_bump_version BEFORE UPDATE ON kefi_events
+    FOR EACH ROW WHEN (OLD.* IS DISTINCT FROM NEW.*) EXECUTE FUNCTION kefi_events_bump_version()
+    """,
+    "DROP TRIGGER IF EXISTS kefi_events_notify_insert ON kefi_events",
+    """
+    CREATE TRIGGER kefi_events_notify_insert AFTER INSERT ON kefi_events
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE FUNCTION kefi_events_notify_change()
+    """,
+    "DROP TRIGGER IF EXISTS kefi_events_notify_update ON kefi_events",
+    """
+    CREATE TRIGGER kefi_events_notify_update AFTER UPDATE ON kefi_events
+    REFERENCING NEW TABLE AS changed FOR EACH STATEMENT EXECUTE FUNCTION kefi_events_notify_change()
+    """,
+    "DROP TRIGGER IF EXISTS kefi_events_notify_delete ON kefi_events",
+    """
+    CREATE TRIGGER kefi_events_notify_delete AFTER DELETE ON kefi_events
+    REFERENCING OLD TABLE AS changed FOR EACH STATEMENT EXECUTE FUNCTION kefi_events_notify_change()
+    """,
+]
+
+
+async def install_change_notifications(conn: AsyncConnection):
+    """Add the version columns and the triggers to kefi_events. Safe to run again, and from several workers at once."""
+    # Concurrent CREATE OR REPLACE FUNCTION statements can fail, so workers starting together take turns
+    await conn.execute(text("SELECT pg_advisory_xact_lock(hashtext(:name))"), {"name": CHANNEL})
+    for statement in CHANGE_NOTIFICATION_DDL:
+        await conn.execute(text(statement))
+
+
+async def ensure_change_notifications(conn: AsyncConnection):
+    """
+    Install the change notifications on a database set up before they existed, whose kefi_events has no version
+    columns yet. Kefi_Event maps those columns, so every query of the model needs them.
+    """
+    columns = await conn.scalar(
+        text(
+            """
+            SELECT count(*) FROM pg_attribute
+            WHERE attrelid = 'kefi_events'::regclass AND attname IN ('version', 'updated_at') AND NOT attisdropped
+            """
+        )
+    )
+    if columns < 2:
+        logger.info("Installing the kefi_events change notification triggers...")
+        await install_change_notifications(conn)
+
+
+class CatalogChanges:
+    """The catalog epoch, and the caches to evict from when events change."""
+
+    def __init__(self):
+        self.epoch = 0
+        self.evictors: list[Callable[[set[int] | None], None]] = []
+
+    def register(self, evict: Callable[[set[int] | None], None]):
+        """evict is called with the changed event ids, or None when any event may have changed."""
+        self.evictors.append(evict)
+
+    def invalidate(self, ids: set[int] | None):
+        self.epoch += 1
+        CATALOG_INVALIDATIONS.labels("all" if ids is None else "rows").inc()
+        for evict in self.evictors:
+            evict(ids)
+
+
+def parse_payload(payload: str) -> set[int] | None:
+    if payload == ALL_EVENTS:
+        return None
+    return {int(id) for id in payload.split(",") if id}
+
+
+class CatalogChangeListener:
+    """
+    Holds a connection that LISTENs for event changes and applies them to the worker's CatalogChanges.
+    While the connection is down, changes are missed, so everything is invalidated whenever it reconnects.
+    """
+
+    def __init__(
+        self, engine: AsyncEngine, catalog: CatalogChanges, reconnect_delay: float = 5, check_interval: float = 30
+    ):
+        self.engine = engine
+        self.catalog = catalog
+        self.reconnect_delay = reconnect_delay
+        self.check_interval = check_interval
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def on_notification(self, connection, pid, channel, payload):
+        self.catalog.invalidate(parse_payload(payload))
+
+    async def run(self):
+        while True:
+            try:
+                await self.listen()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                logger.warning("Catalog change listener disconnected (%s), reconnecting", e)
+            await asyncio.sleep(self.reconnect_delay)
+
+    async def listen(self):
+        async with self.engine.connect() as conn:
+            raw_connection = await conn.get_raw_connection()
+            asyncpg_connection = raw_connection.driver_connection
+            closed = asyncio.Event()
+            asyncpg_connection.add_termination_listener(lambda connection: closed.set())
+            try:
+                await asyncpg_connection.add_listener(CHANNEL, self.on_notification)
+                # Changes made while nothing was listening were missed
+                self.catalog.invalidate(None)
+                logger.info("Listening for catalog changes on %s", CHANNEL)
+                while not closed.is_set():
+                    try:
+                        await asyncio.wait_for(closed.wait(), self.check_interval)
+                    except TimeoutError:
+                        # An idle connection can be dropped silently, so check it is still alive
+                        await asyncpg_connection.fetchval("SELECT 1")
+            finally:
+                # Never hand a connection with a listener back to the pool
+                await conn.invalidate()
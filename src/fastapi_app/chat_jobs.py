@@ -0,0 +1,262 @@
+import asyncio
+import datetime
+import hashlib
+import json
+import logging
+import time
+import uuid
+from collections.abc import Awaitable, Callable
+
+import fastapi
+from fastapi.encoders import jsonable_encoder
+from sqlalchemy import delete, func, select, update
+from sqlalchemy.dialects.postgresql import insert
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+from .api_models import ChatRequest
+from .concurrency import UpstreamOverloadedError
+from .deadlines import Deadline, stage_budgets_from_env
+from .metrics import CHAT_JOBS
+from .postgres_models import ChatJob
+
+logger = logging.getLogger("ragapp")
+
+TERMINAL_STATUSES = {"succeeded", "failed"}
+
+
+class IdempotencyConflictError(Exception):
+    """The idempotency key was already used for a different request."""
+
+
+def request_hash(chat_request: ChatRequest) -> str:
+    return hashlib.sha256(json.dumps(chat_request.model_dump(), sort_keys=True).encode()).hexdigest()
+
+
+def utcnow() -> datetime.datetime:
+    return datetime.datetime.now(datetime.UTC)
+
+
+class MemoryJobStore:
+    """
+    Jobs kept in this process. Polls have to reach the process that accepted the job, so this is only for
+    single-node deployments with one worker; otherwise use PostgresJobStore.
+    """
+
+    def __init__(self):
+        self.jobs: dict[str, ChatJob] = {}
+        self.job_ids_by_key: dict[str, str] = {}
+
+    async def create(self, job: ChatJob) -> tuple[ChatJob, bool]:
+        """Store a new job, or return the unexpired job that already holds its idempotency key."""
+        await self.purge_expired()
+        if job.idempotency_key and (existing_id := self.job_ids_by_key.get(job.idempotency_key)):
+            return self.jobs[existing_id], False
+        job.updated_at = utcnow()
+        self.jobs[job.id] = job
+        if job.idempotency_key:
+            self.job_ids_by_key[job.idempotency_key] = job.id
+        return job, True
+
+    async def get(self, job_id: str) -> ChatJob | None:
+        job = self.jobs.get(job_id)
+        return job if job is not None and job.expires_at > utcnow() else None
+
+    async def update(self, job_id: str, **values):
+        if (job := self.jobs.get(job_id)) is not None:
+            for name, value in values.items():
+                setattr(job, name, value)
+            job.updated_at = utcnow()
+
+    async def purge_expired(self) -> int:
+        now = utcnow()
+        expired = [job for job in self.jobs.values() if job.expires_at <= now]
+        for job in expired:
+            del self.jobs[job.id]
+            if job.idempotency_key:
+                self.job_ids_by_key.pop(job.idempotency_key, None)
+        return len(expired)
+
+
+class PostgresJobStore:
+    """Jobs in the chat_jobs table, so any worker can answer a poll for a job that another worker runs."""
+
+    def __init__(self, engine: AsyncEngine):
+        self.async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
+
+    async def create(self, job: ChatJob) -> tuple[ChatJob, bool]:
+        """Store a new job, or return the unexpired job that already holds its idempotency key."""
+        # The job that holds the key can expire or be purged between the conflict and the lookup, and then the
+        # insert is tried again
+        for _ in range(2):
+            async with self.async_session_maker() as session, session.begin():
+                if job.idempotency_key:
+                    # An expired job no longer holds its key
+                    await session.execute(
+                        delete(ChatJob).where(
+                            ChatJob.idempotency_key == job.idempotency_key, ChatJob.expires_at <= func.now()
+                        )
+                    )
+                # A concurrent retry with the same key waits for this insert's transaction and then conflicts with it
+                inserted_id = await session.scalar(
+                    insert(ChatJob)
+                    .values(
+                        id=job.id,
+                        request_hash=job.request_hash,
+                        expires_at=job.expires_at,
+                        idempotency_key=job.idempotency_key,
+                        status=job.status,
+                    )
+                    .on_conflict_do_nothing(index_elements=[ChatJob.idempotency_key])
+                    .returning(ChatJob.id)
+                )
+                if inserted_id is not None:
+                    return job, True
+                existing = await session.scalar(
+                    select(ChatJob).where(
+                        ChatJob.idempotency_key == job.idempotency_key, ChatJob.expires_at > func.now()
+                    )
+                )
+                if existing is not None:
+                    return existing, False
+        raise UpstreamOverloadedError("chat_jobs", 1)
+
+    async def get(self, job_id: str) -> ChatJob | None:
+        async with self.async_session_maker() as session:
+            return await session.scalar(select(ChatJob).where(ChatJob.id == job_id, ChatJob.expires_at > func.now()))
+
+    async def update(self, job_id: str, **values):
+        async with self.async_session_maker() as session, session.begin():
+            await session.execute(update(ChatJob).where(ChatJob.id == job_id).values(**values, updated_at=func.now()))
+
+    async def purge_expired(self) -> int:
+        async with self.async_session_maker() as session, session.begin():
+            return (await session.execute(delete(ChatJob).where(ChatJob.expires_at <= func.now()))).rowcount
+
+
+class ChatJobRunner:
+    """
+    Runs chat requests in the background for POST /chat/jobs, so long runs don't hold HTTP connections open.
+
+    Accepted jobs wait in a bounded queue for one of a fixed number of worker tasks, and their results are kept in
+    the store for ttl seconds. Submitting again with the same idempotency key returns the existing job instead of
+    running the request twice.
+    """
+
+    def __init__(
+        self,
+        store: MemoryJobStore | PostgresJobStore,
+        run_chat: Callable[..., Awaitable[dict]],
+        *,
+        workers: int = 4,
+        max_queue: int = 100,
+        ttl: float = 3600,
+        deadline_seconds: float = 120,
+        retry_after: int = 5,
+        purge_interval: float = 60,
+    ):
+        self.store = store
+        self.run_chat = run_chat
+        self.workers = workers
+        self.queue: asyncio.Queue[tuple[str, ChatRequest]] = asyncio.Queue(maxsize=max_queue)
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.deadline_seconds = deadline_seconds
+        # A job still running well past its deadline was on a worker that stopped. A queued job waits at most for
+        # the jobs ahead of it to run to their deadlines, so one queued for longer was in a worker that stopped
+        self.lost_after = datetime.timedelta(seconds=deadline_seconds + 60)
+        self.lost_queued_after = datetime.timedelta(seconds=-(-max_queue // workers) * deadline_seconds + 60)
+        self.retry_after = retry_after
+        self.purge_interval = purge_interval
+        self.tasks: list[asyncio.Task] = []
+        self.background_tasks: set[asyncio.Task] = set()
+
+    def start(self):
+        if not self.tasks:
+            self.tasks = [asyncio.create_task(self.work()) for _ in range(self.workers)]
+            self.tasks.append(asyncio.create_task(self.purge()))
+
+    async def stop(self):
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, *self.background_tasks, return_exceptions=True)
+        self.tasks = []
+        # The queue only lives in this process, so the jobs still in it will never run
+        while not self.queue.empty():
+            job_id, _ = self.queue.get_nowait()
+            try:
+                await self.store.update(job_id, status="failed", error="The server stopped before running this job")
+                CHAT_JOBS.labels("failed").inc()
+            except Exception as e:
+                logger.warning("Could not fail queued chat job %s: %s", job_id, e)
+
+    async def submit(self, chat_request: ChatRequest, idempotency_key: str | None = None) -> ChatJob:
+        job = ChatJob(
+            id=uuid.uuid4().hex,
+            request_hash=request_hash(chat_request),
+            expires_at=utcnow() + self.ttl,
+            idempotency_key=idempotency_key,
+        )
+        job, created = await self.store.create(job)
+        if not created:
+            if job.request_hash != request_hash(chat_request):
+                raise IdempotencyConflictError(idempotency_key)
+            return job
+        try:
+            self.queue.put_nowait((job.id, chat_request))
+        except asyncio.QueueFull:
+            # Expire the job at once, so a retry with the same idempotency key is accepted
+            await self.store.update(job.id, status="failed", error="Too many queued chat jobs", expires_at=utcnow())
+            CHAT_JOBS.labels("rejected").inc()
+            raise UpstreamOverloadedError("chat_jobs", self.retry_after)
+        return job
+
+    async def wait(self, job_id: str, timeout: float = 0, poll_interval: float = 0.5) -> ChatJob | None:
+        """Get a job, waiting up to timeout seconds for it to finish (long polling)."""
+        give_up_at = time.monotonic() + timeout
+        while True:
+            job = await self.store.get(job_id)
+            if job is not None and job.status == "running" and utcnow() - job.updated_at > self.lost_after:
+                job.status, job.error = "failed", "The worker running this job stopped"
+            elif job is not None and job.status == "queued" and utcnow() - job.updated_at > self.lost_queued_after:
+                job.status, job.error = "failed", "The worker holding this job stopped"
+            if job is None or job.status in TERMINAL_STATUSES or time.monotonic() >= give_up_at:
+                return job
+            await asyncio.sleep(min(poll_interval, give_up_at - time.monotonic()))
+
+    def schedule(self, func, *args):
+        """Run work that the job's result doesn't wait for, such as summarizing a chat session."""
+        task = asyncio.create_task(func(*args))
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+
+    async def work(self):
+        while True:
+            job_id, chat_request = await self.queue.get()
+            try:
+                await self.run_job(job_id, chat_request)
+            except Exception:
+                logger.exception("Could not record the outcome of chat job %s", job_id)
+
+    async def run_job(self, job_id: str, chat_request: ChatRequest):
+        await self.store.update(job_id, status="running")
+        deadline = Deadline(time.monotonic() + self.deadline_seconds, stage_budgets_from_env())
+        try:
+            response = await self.run_chat(chat_request, deadline, self.schedule)
+        except fastapi.HTTPException as e:
+            await self.store.update(job_id, status="failed", error=str(e.detail))
+            CHAT_JOBS.labels("failed").inc()
+        except Exception as e:
+            logger.exception("Chat job %s failed", job_id)
+            await self.store.update(job_id, status="failed", error=str(e) or type(e).__name__)
+            CHAT_JOBS.labels("failed").inc()
+        else:
+            await self.store.update(job_id, status="succeeded", result=jsonable_encoder(response))
+            CHAT_JOBS.labels("succeeded").inc()
+
+    async def purge(self):
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            try:
+                if purged := await self.store.purge_expired():
+                    logger.info("Purged %d expired chat jobs", purged)
+            except Exception as e:
+                logger.warning("Could not purge expired chat jobs: %s", e)
@@ -0,0 +1,184 @@
+import asyncio
+import collections
+import logging
+import os
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+
+import numpy as np
+import openai
+
+from .concurrency import UpstreamOverloadedError, retry_after_seconds
+from .metrics import CHAT_BACKEND_ATTEMPTS, CHAT_BACKEND_LATENCY_EWMA, CHAT_HEDGES
+
+logger = logging.getLogger("ragapp")
+
+# Errors after which the same request is worth sending to another backend
+FAILOVER_ERRORS = (
+    openai.RateLimitError,
+    openai.APIConnectionError,  # Includes APITimeoutError
+    openai.InternalServerError,
+    UpstreamOverloadedError,
+)
+
+
+@dataclass
+class ChatBackend:
+    name: str
+    client: object
+    model: str  # Sent as the model of every request to this backend (the deployment name for Azure OpenAI)
+    latency_ewma: float | None = None
+    latencies: collections.deque = field(default_factory=lambda: collections.deque(maxlen=200))
+    unhealthy_until: float = 0.0
+
+    def observe(self, seconds: float, alpha: float):
+        """Record the time to first token (or to the full response, when not streaming)."""
+        self.latencies.append(seconds)
+        if self.latency_ewma is None:
+            self.latency_ewma = seconds
+        else:
+            self.latency_ewma = alpha * seconds + (1 - alpha) * self.latency_ewma
+        CHAT_BACKEND_LATENCY_EWMA.labels(self.name).set(self.latency_ewma)
+
+
+async def prepend_chunk(first_chunk, stream) -> AsyncIterator:
+    yield first_chunk
+    async for chunk in stream:
+        yield chunk
+
+
+class RoutingCompletions:
+    def __init__(self, router: "RoutingChatClient"):
+        self.router = router
+
+    async def create(self, **kwargs):
+        return await self.router.create(**kwargs)
+
+
+class RoutingChat:
+    def __init__(self, router: "RoutingChatClient"):
+        self.completions = RoutingCompletions(router)
+
+
+class RoutingChatClient:
+    """
+    A drop-in chat client that routes chat.completions.create across several backends.
+
+    Requests go to the first healthy backend in configured order. If it hasn't returned its first token (or, when
+    not streaming, its response) within the hedge_percentile of its recent latencies, the same request is also
+    sent to the healthy backend with the lowest latency EWMA, the first answer wins and the other call is cancelled.
+    A backend that errors or is rate limited is skipped for a cooldown and the request fails over to the next one.
+    Everything other than chat is passed through to the first backend's client.
+    """
+
+    def __init__(
+        self,
+        backends: list[ChatBackend],
+        *,
+        hedge_percentile: float = 95,
+        default_hedge_delay: float = 3.0,
+        min_samples: int = 20,
+        ewma_alpha: float = 0.2,
+        cooldown: float = 30,
+    ):
+        if not backends:
+            raise ValueError("At least one chat backend is required")
+        self.backends = backends
+        self.hedge_percentile = hedge_percentile
+        self.default_hedge_delay = default_hedge_delay
+        self.min_samples = min_samples
+        self.ewma_alpha = ewma_alpha
+        self.cooldown = cooldown
+        self.chat = RoutingChat(self)
+
+    def __getattr__(self, name):
+        return getattr(self.backends[0].client, name)
+
+    def hedge_delay(self, backend: ChatBackend) -> float:
+        if len(backend.latencies) < self.min_samples:
+            return self.default_hedge_delay
+        return float(np.percentile(backend.latencies, self.hedge_percentile))
+
+    def ordered_backends(self) -> list[ChatBackend]:
+        """The primary backend first, then the rest by latency. Unhealthy backends go last, as a last resort."""
+        now = asyncio.get_running_loop().time()
+        healthy = [backend for backend in self.backends if backend.unhealthy_until <= now]
+        unhealthy = [backend for backend in self.backends if backend.unhealthy_until > now]
+        if not healthy:
+            return unhealthy
+        primary, others = healthy[0], healthy[1:]
+        others.sort(key=lambda backend: backend.latency_ewma if backend.latency_ewma is not None else 0.0)
+        return [primary, *others, *unhealthy]
+
+    def mark_failed(self, backend: ChatBackend, error: Exception):
+        cooldown = retry_after_seconds(error) or self.cooldown
+        backend.unhealthy_until = asyncio.get_running_loop().time() + cooldown
+        CHAT_BACKEND_ATTEMPTS.labels(backend.name, "failed").inc()
+        logger.warning("Chat backend %s failed (%s), skipping it for %.0fs", backend.name, error, cooldown)
+
+    async def attempt(self, backend: ChatBackend, kwargs: dict):
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            response = await backend.client.chat.completions.create(**(kwargs | {"model": backend.model}))
+            if kwargs.get("stream"):
+                first_chunk = await response.__anext__()
+                response = prepend_chunk(first_chunk, response)
+        except asyncio.CancelledError:
+            # Lost the race: the backend took at least this long, which its latency stats should reflect
+            backend.observe(loop.time() - start, self.ewma_alpha)
+            CHAT_BACKEND_ATTEMPTS.labels(backend.name, "cancelled").inc()
+            raise
+        backend.observe(loop.time() - start, self.ewma_alpha)
+        return response
+
+    async def create(self, **kwargs):
+        candidates = self.ordered_backends()
+        next_candidate = 0
+        pending: dict[asyncio.Task, ChatBackend] = {}
+        errors: list[Exception] = []
+
+        def launch():
+            nonlocal next_candidate
+            backend = candidates[next_candidate]
+            next_candidate += 1
+            pending[asyncio.create_task(self.attempt(backend, kwargs))] = backend
+
+        launch()
+        hedged = False
+        try:
+            while pending:
+                timeout = None
+                if not hedged and next_candidate < len(candidates):
+                    timeout = self.hedge_delay(next(iter(pending.values())))
+                done, _ = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    CHAT_HEDGES.labels(candidates[next_candidate].name).inc()
+                    launch()
+                    hedged = True
+                    continue
+                for task in done:
+                    backend = pending.pop(task)
+                    try:
+                        response = task.result()
+                    except FAILOVER_ERRORS as e:
+                        self.mark_failed(backend, e)
+                        errors.append(e)
+                        if not pending and next_candidate < len(candidates):
+                            launch()
+                        continue
+                    CHAT_BACKEND_ATTEMPTS.labels(backend.name, "won").inc()
+                    return response
+            raise errors[-1]
+        finally:
+            for task in pending:
+                task.cancel()
+
+
+def create_routing_client_from_env(backends: list[ChatBackend]) -> RoutingChatClient:
+    return RoutingChatClient(
+        backends,
+        hedge_percentile=float(os.getenv("OPENAI_CHAT_HEDGE_PERCENTILE", "95")),
+        default_hedge_delay=float(os.getenv("OPENAI_CHAT_HEDGE_DEFAULT_DELAY_MS", "3000")) / 1000,
+        cooldown=float(os.getenv("OPENAI_CHAT_FAILOVER_COOLDOWN_SECONDS", "30")),
+    )
@@ -0,0 +1,237 @@
+import asyncio
+import datetime
+import logging
+import pathlib
+import time
+import uuid
+
+from openai_messages_token_helper import count_tokens_for_message
+from sqlalchemy import delete, func, select, text, update
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine, async_sessionmaker
+
+from .deadlines import Deadline, request_deadline, stage_budgets_from_env, within_budget
+from .metrics import record_token_usage
+from .postgres_models import ChatSession, ChatSessionMessage
+
+logger = logging.getLogger("ragapp")
+
+SUMMARY_PREFIX = "Summary of the conversation so far: "
+
+
+class ChatSessionNotFoundError(KeyError):
+    pass
+
+
+async def install_session_expiry(conn: AsyncConnection, ttl: float):
+    """
+    Add expires_at to a chat_sessions table created before sessions expired, expiring its sessions ttl seconds
+    after their last turn. Safe to run again.
+    """
+    await conn.execute(text("ALTER TABLE chat_sessions ADD COLUMN IF NOT EXISTS expires_at timestamptz"))
+    await conn.execute(
+        text("UPDATE chat_sessions SET expires_at = updated_at + make_interval(secs => :ttl) WHERE expires_at IS NULL"),
+        {"ttl": ttl},
+    )
+    await conn.execute(text("ALTER TABLE chat_sessions ALTER COLUMN expires_at SET NOT NULL"))
+
+
+class ChatSessionStore:
+    """
+    Conversation history kept in Postgres, so clients only send the new message of each turn.
+
+    Every message is tokenized once, when it is stored. When the unsummarized messages and the summary exceed
+    history_token_limit, all but the newest keep_recent_messages are folded into a rolling summary by the chat model,
+    so the history that the RAG flows fit into their prompts (and re-tokenize) stays bounded however long the
+    conversation gets.
+
+    A session expires ttl seconds after its last turn. Expired sessions are no longer found, and are deleted with
+    their messages every purge_interval seconds.
+    """
+
+    def __init__(
+        self,
+        engine: AsyncEngine,
+        *,
+        token_model: str,
+        summary_client,
+        summary_model: str,
+        history_token_limit: int = 2000,
+        keep_recent_messages: int = 4,
+        summary_token_limit: int = 300,
+        ttl: float = 7 * 24 * 3600,
+        purge_interval: float = 3600,
+    ):
+        self.async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
+        self.token_model = token_model
+        self.summary_client = summary_client
+        self.summary_model = summary_model
+        self.history_token_limit = history_token_limit
+        self.keep_recent_messages = keep_recent_messages
+        self.summary_token_limit = summary_token_limit
+        self.ttl = datetime.timedelta(seconds=ttl)
+        self.purge_interval = purge_interval
+        self.purge_task: asyncio.Task | None = None
+        current_dir = pathlib.Path(__file__).parent
+        self.summary_prompt_template = open(current_dir / "prompts/summarize.txt").read()
+
+    def start(self):
+        if self.purge_task is None:
+            self.purge_task = asyncio.create_task(self.purge())
+
+    async def stop(self):
+        if self.purge_task is not None:
+            self.purge_task.cancel()
+            await asyncio.gather(self.purge_task, return_exceptions=True)
+            self.purge_task = None
+
+    def count_tokens(self, message: dict) -> int:
+        return count_tokens_for_message(self.token_model, message, default_to_cl100k=True)
+
+    async def create(self) -> str:
+        session_id = uuid.uuid4().hex
+        async with self.async_session_maker() as session, session.begin():
+            session.add(ChatSession(session_id, datetime.datetime.now(datetime.UTC) + self.ttl))
+        return session_id
+
+    async def delete(self, session_id: str) -> bool:
+        async with self.async_session_maker() as session, session.begin():
+            chat_session = await session.get(ChatSession, session_id)
+            if chat_session is None:
+                return False
+            await session.delete(chat_session)
+        return True
+
+    async def get_history(self, session_id: str) -> list[dict]:
+        """The summary (as an assistant message) followed by the unsummarized messages, oldest first."""
+        async with self.async_session_maker() as session:
+            chat_session = await session.scalar(
+                select(ChatSession).where(ChatSession.id == session_id, ChatSession.expires_at > func.now())
+            )
+            if chat_session is None:
+                raise ChatSessionNotFoundError(session_id)
+            messages = (
+                await session.scalars(
+                    select(ChatSessionMessage)
+                    .where(ChatSessionMessage.session_id == session_id, ChatSessionMessage.summarized.is_(False))
+                    .order_by(ChatSessionMessage.id)
+                )
+            ).all()
+
+        # Trim by the stored counts, in case a summary is still pending, rather than re-tokenizing the history
+        history, budget = [], self.history_token_limit - chat_session.summary_tokens
+        for message in reversed(messages):
+            budget -= message.tokens
+            if budget < 0:
+                break
+            history.append({"role": message.role, "content": message.content})
+        history.reverse()
+        if chat_session.summary:
+            history.insert(0, {"role": "assistant", "content": SUMMARY_PREFIX + chat_session.summary})
+        return history
+
+    async def append(self, session_id: str, messages: list[dict]) -> int:
+        """Store the messages of a turn with their token counts, returning the unsummarized history's tokens."""
+        async with self.async_session_maker() as session, session.begin():
+            summary_tokens = await session.scalar(
+                update(ChatSession)
+                .where(ChatSession.id == session_id, ChatSession.expires_at > func.now())
+                .values(updated_at=func.now(), expires_at=func.now() + self.ttl)
+                .returning(ChatSession.summary_tokens)
+            )
+            if summary_tokens is None:
+                # The session was deleted, or expired, during the turn
+                raise ChatSessionNotFoundError(session_id)
+            for message in messages:
+                session.add(
+                    ChatSessionMessage(session_id, message["role"], message["content"], self.count_tokens(message))
+                )
+            history_tokens = await session.scalar(
+                select(func.coalesce(func.sum(ChatSessionMessage.tokens), 0)).where(
+                    ChatSessionMessage.session_id == session_id, ChatSessionMessage.summarized.is_(False)
+                )
+            )
+        return history_tokens + summary_tokens
+
+    async def summarize_if_needed(self, session_id: str):
+        """Fold the older messages into the summary if the history is over its token budget."""
+        async with self.async_session_maker() as session:
+            chat_session = await session.get(ChatSession, session_id)
+            if chat_session is None:
+                return
+            messages = (
+                await session.scalars(
+                    select(ChatSessionMessage)
+                    .where(ChatSessionMessage.session_id == session_id, ChatSessionMessage.summarized.is_(False))
+                    .order_by(ChatSessionMessage.id)
+                )
+            ).all()
+        total_tokens = chat_session.summary_tokens + sum(message.tokens for message in messages)
+        old_messages = messages[: -self.keep_recent_messages] if self.keep_recent_messages else messages
+        if total_tokens <= self.history_token_limit or not old_messages:
+            return
+
+        # The chat call runs outside any transaction, so it holds no connection or lock while it waits
+        transcript = "\n".join(f"{message.role}: {message.content}" for message in old_messages)
+        user_content = f"Existing summary:\n{chat_session.summary or '(none)'}\n\nNew messages:\n{transcript}"
+        budgets = stage_budgets_from_env()
+        try:
+            with request_deadline(Deadline(time.monotonic() + budgets["summarize"], budgets)):
+                async with within_budget("summarize"):
+                    chat_completion = await self.summary_client.chat.completions.create(
+                        model=self.summary_model,
+                        messages=[
+                            {"role": "system", "content": self.summary_prompt_template},
+                            {"role": "user", "content": user_content},
+                        ],
+                        temperature=0.0,
+                        max_tokens=self.summary_token_limit,
+                        n=1,
+                    )
+        except TimeoutError:
+            # The history is trimmed to its budget meanwhile, and the next turn over the limit tries again
+            logger.warning("Summarizing session %s ran out of time", session_id)
+            return
+        record_token_usage("summarize", self.summary_model, chat_completion.usage)
+        summary = (chat_completion.choices[0].message.content or "").strip()
+        summary_tokens = self.count_tokens({"role": "assistant", "content": SUMMARY_PREFIX + summary})
+
+        old_ids = [message.id for message in old_messages]
+        async with self.async_session_maker() as session, session.begin():
+            # Only write the summary if the summary and messages it was made from are unchanged. Another worker
+            # summarizing the same session concurrently changes both, and the later of the two is dropped
+            locked_session = (
+                await session.scalars(select(ChatSession).where(ChatSession.id == session_id).with_for_update())
+            ).first()
+            if locked_session is None or locked_session.summary != chat_session.summary:
+                return
+            still_unsummarized = await session.scalar(
+                select(func.count()).where(ChatSessionMessage.id.in_(old_ids), ChatSessionMessage.summarized.is_(False))
+            )
+            if still_unsummarized != len(old_ids):
+                return
+            locked_session.summary = summary
+            locked_session.summary_tokens = summary_tokens
+            await session.execute(
+                update(ChatSessionMessage).where(ChatSessionMessage.id.in_(old_ids)).values(summarized=True)
+            )
+        logger.info(
+            "Summarized %d messages of session %s (%d tokens) into %d tokens",
+            len(old_messages),
+            session_id,
+            sum(message.tokens for message in old_messages),
+            summary_tokens,
+        )
+
+    async def purge_expired(self) -> int:
+        async with self.async_session_maker() as session, session.begin():
+            # The messages go with their session (ON DELETE CASCADE)
+            return (await session.execute(delete(ChatSession).where(ChatSession.expires_at <= func.now()))).rowcount
+
+    async def purge(self):
+        while True:
+            await asyncio.sleep(self.purge_interval)
+            try:
+                if purged := await self.purge_expired():
+                    logger.info("Purged %d expired chat sessions", purged)
+            except Exception as e:
+                logger.warning("Could not purge expired chat sessions: %s", e)
@@ -0,0 +1,202 @@
+import asyncio
+import collections
+import contextlib
+import logging
+import os
+import random
+
+import openai
+
+from .metrics import UPSTREAM_CONCURRENCY_LIMIT, UPSTREAM_IN_FLIGHT, UPSTREAM_QUEUE_DEPTH, UPSTREAM_SHED
+
+logger = logging.getLogger("ragapp")
+
+# Errors worth retrying after a backoff, as the OpenAI SDK does when it retries itself
+RETRYABLE_ERRORS = (openai.RateLimitError, openai.APIConnectionError, openai.InternalServerError)
+
+
+class UpstreamOverloadedError(Exception):
+    """Raised when an upstream call is shed because the wait queue is full."""
+
+    def __init__(self, upstream: str, retry_after: int):
+        super().__init__(f"Too many pending {upstream} requests")
+        self.upstream = upstream
+        self.retry_after = retry_after
+
+
+def retry_after_seconds(error: Exception) -> float | None:
+    if isinstance(error, UpstreamOverloadedError):
+        return float(error.retry_after)
+    response = getattr(error, "response", None)
+    if response is not None and (retry_after := response.headers.get("retry-after")):
+        try:
+            return float(retry_after)
+        except ValueError:
+            return None
+    return None
+
+
+class AdaptiveConcurrencyLimiter:
+    """
+    Per-worker AIMD concurrency limit for one upstream.
+
+    Each successful call raises the limit by 1/limit, so it grows by about one per round trip at full load.
+    Each rate-limited or timed-out call halves it. Callers that do not get a slot wait in a bounded FIFO queue;
+    once that queue is full, new callers are shed immediately with UpstreamOverloadedError.
+
+    Clients behind a limiter are built with the SDK's retries off, so every 429 reaches the limiter. call() retries
+    instead, up to max_retries times, taking a new slot for each attempt.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        *,
+        initial_limit: float = 8,
+        min_limit: float = 1,
+        max_limit: float = 64,
+        max_queue: int = 64,
+        backoff_ratio: float = 0.5,
+        retry_after: int = 1,
+        max_retries: int = 2,
+        max_retry_delay: float = 8,
+    ):
+        self.name = name
+        self.limit = initial_limit
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_queue = max_queue
+        self.backoff_ratio = backoff_ratio
+        self.retry_after = retry_after
+        self.max_retries = max_retries
+        self.max_retry_delay = max_retry_delay
+        self.in_flight = 0
+        self.waiters: collections.deque[asyncio.Future] = collections.deque()
+        UPSTREAM_CONCURRENCY_LIMIT.labels(name).set(self.limit)
+
+    async def acquire(self):
+        if self.in_flight < int(self.limit) and not self.waiters:
+            self.in_flight += 1
+            UPSTREAM_IN_FLIGHT.labels(self.name).inc()
+            return
+        if len(self.waiters) >= self.max_queue:
+            UPSTREAM_SHED.labels(self.name).inc()
+            raise UpstreamOverloadedError(self.name, self.retry_after)
+
+        waiter = asyncio.get_running_loop().create_future()
+        self.waiters.append(waiter)
+        UPSTREAM_QUEUE_DEPTH.labels(self.name).inc()
+        try:
+            await waiter
+        except asyncio.CancelledError:
+            if waiter.done() and not waiter.cancelled():
+                # The slot was handed over just as we were cancelled, so give it back
+                self.release_slot()
+            elif waiter in self.waiters:
+                self.waiters.remove(waiter)
+                UPSTREAM_QUEUE_DEPTH.labels(self.name).dec()
+            raise
+
+    def release(self, dropped: bool):
+        if dropped:
+            self.limit = max(self.min_limit, self.limit * self.backoff_ratio)
+            logger.info("Lowering %s concurrency limit to %.1f", self.name, self.limit)
+        else:
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        UPSTREAM_CONCURRENCY_LIMIT.labels(self.name).set(self.limit)
+        self.release_slot()
+
+    def release_slot(self):
+        self.in_flight -= 1
+        UPSTREAM_IN_FLIGHT.labels(self.name).dec()
+        while self.waiters and self.in_flight < int(self.limit):
+            waiter = self.waiters.popleft()
+            UPSTREAM_QUEUE_DEPTH.labels(self.name).dec()
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            UPSTREAM_IN_FLIGHT.labels(self.name).inc()
+            waiter.set_result(None)
+
+    @contextlib.asynccontextmanager
+    async def slot(self):
+        await self.acquire()
+        try:
+            yield
+        except (openai.RateLimitError, openai.APITimeoutError):
+            self.release(dropped=True)
+            raise
+        except BaseException:
+            # Cancelled calls and other errors say nothing about the upstream's capacity, so the limit stays put
+            self.release_slot()
+            raise
+        else:
+            self.release(dropped=False)
+
+    async def call(self, create, **kwargs):
+        """Call create in a slot, retrying retryable errors with exponential backoff (or the Retry-After delay)."""
+        for attempt in range(self.max_retries + 1):
+            try:
+                async with self.slot():
+                    return await create(**kwargs)
+            except RETRYABLE_ERRORS as e:
+                if attempt == self.max_retries:
+                    raise
+                delay = retry_after_seconds(e) or 0.5 * 2**attempt * random.uniform(0.75, 1.25)
+                logger.info("Retrying %s call in %.1fs after %s", self.name, delay, type(e).__name__)
+                await asyncio.sleep(min(delay, self.max_retry_delay))
+
+
+class LimitedCompletions:
+    def __init__(self, completions, limiter: AdaptiveConcurrencyLimiter):
+        self.completions = completions
+        self.limiter = limiter
+
+    async def create(self, **kwargs):
+        return await self.limiter.call(self.completions.create, **kwargs)
+
+
+class LimitedChat:
+    def __init__(self, chat, limiter: AdaptiveConcurrencyLimiter):
+        self.completions = LimitedCompletions(chat.completions, limiter)
+
+
+class LimitedEmbeddings:
+    def __init__(self, embeddings, limiter: AdaptiveConcurrencyLimiter):
+        self.embeddings = embeddings
+        self.limiter = limiter
+
+    async def create(self, **kwargs):
+        return await self.limiter.call(self.embeddings.create, **kwargs)
+
+
+class LimitedOpenAIClient:
+    """
+    Wraps an AsyncOpenAI client so that chat.completions.create and embeddings.create go through a limiter.
+    Everything else is passed through to the wrapped client.
+    """
+
+    def __init__(
+        self,
+        client,
+        *,
+        chat_limiter: AdaptiveConcurrencyLimiter | None = None,
+        embed_limiter: AdaptiveConcurrencyLimiter | None = None,
+    ):
+        self.client = client
+        self.chat = LimitedChat(client.chat, chat_limiter) if chat_limiter else client.chat
+        self.embeddings = LimitedEmbeddings(client.embeddings, embed_limiter) if embed_limiter else client.embeddings
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+
+def create_limiter_from_env(name: str, prefix: str, max_retries: int | None = None) -> AdaptiveConcurrencyLimiter:
+    max_limit = int(os.getenv(f"{prefix}_MAX_CONCURRENCY", "32"))
+    return AdaptiveConcurrencyLimiter(
+        name,
+        initial_limit=max(1, max_limit // 4),
+        max_limit=max_limit,
+        max_queue=int(os.getenv(f"{prefix}_MAX_QUEUE", "64")),
+        max_retries=max_retries if max_retries is not None else int(os.getenv(f"{prefix}_MAX_RETRIES", "2")),
+    )
@@ -0,0 +1,126 @@
+import asyncio
+import contextlib
+import contextvars
+import logging
+import os
+import time
+from dataclasses import dataclass, field
+
+from .metrics import DEADLINE_DEGRADATIONS
+
+logger = logging.getLogger("ragapp")
+
+# Clients can ask for a shorter (or, up to DEADLINE_MAX_MS, longer) deadline than the default
+DEADLINE_HEADER = "x-request-timeout-ms"
+
+# The longest each stage may take. A stage also never runs past the request's deadline.
+STAGE_BUDGET_DEFAULTS_MS = {
+    "query_rewrite": 5000,
+    "embedding": 2000,
+    "sql": 3000,
+    "answer": 30000,
+    # Session summaries run after the response, under a deadline of their own
+    "summarize": 15000,
+}
+
+
+@dataclass
+class Deadline:
+    expires_at: float  # time.monotonic() value
+    stage_budgets: dict[str, float] = field(default_factory=dict)  # Seconds per stage
+    degraded: list[str] = field(default_factory=list)  # Stages that fell back, reported in the response context
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires_at - time.monotonic())
+
+    def budget(self, stage: str) -> float:
+        return min(self.stage_budgets.get(stage, float("inf")), self.remaining())
+
+
+current_deadline: contextvars.ContextVar[Deadline | None] = contextvars.ContextVar("current_deadline", default=None)
+
+
+def stage_budgets_from_env() -> dict[str, float]:
+    return {
+        stage: float(os.getenv(f"DEADLINE_{stage.upper()}_BUDGET_MS", default_ms)) / 1000
+        for stage, default_ms in STAGE_BUDGET_DEFAULTS_MS.items()
+    }
+
+
+def deadline_from_headers(headers) -> Deadline:
+    """The request's deadline, from the X-Request-Timeout-Ms header or DEADLINE_DEFAULT_MS."""
+    default_ms = float(os.getenv("DEADLINE_DEFAULT_MS", "45000"))
+    max_ms = float(os.getenv("DEADLINE_MAX_MS", "120000"))
+    try:
+        timeout_ms = float(headers.get(DEADLINE_HEADER, default_ms))
+    except ValueError:
+        timeout_ms = default_ms
+    timeout_ms = min(max(timeout_ms, 0.0), max_ms)
+    return Deadline(time.monotonic() + timeout_ms / 1000, stage_budgets_from_env())
+
+
+@contextlib.contextmanager
+def request_deadline(deadline: Deadline):
+    token = current_deadline.set(deadline)
+    try:
+        yield deadline
+    finally:
+        current_deadline.reset(token)
+
+
+def stage_budget(stage: str) -> float | None:
+    """Seconds left for a stage of the current request, or None when it has no deadline."""
+    deadline = current_deadline.get()
+    return deadline.budget(stage) if deadline is not None else None
+
+
+@contextlib.asynccontextmanager
+async def within_budget(stage: str):
+    """Cancel the block with TimeoutError once the stage's budget runs out."""
+    budget = stage_budget(stage)
+    if budget is None:
+        yield
+        return
+    if budget <= 0:
+        raise TimeoutError(f"No time left for {stage}")
+    async with asyncio.timeout(budget):
+        yield
+
+
+def record_degradation(stage: str, fallback: str):
+    DEADLINE_DEGRADATIONS.labels(stage, fallback).inc()
+    if (deadline := current_deadline.get()) is not None:
+        deadline.degraded.append(f"{stage}: {fallback}")
+    logger.warning("%s ran out of time, falling back to %s", stage, fallback)
+
+
+async def cancel_on_disconnect(request, awaitable, poll_interval: float = 0.5):
+    """
+    Run awaitable, cancelling it if the client disconnects first. Returns (result, disconnected).
+    Cancellation reaches in-flight OpenAI calls and SQL queries, so abandoned requests stop using upstream capacity.
+    """
+    task = asyncio.ensure_future(awaitable)
+    try:
+        while True:
+            done, _ = await asyncio.wait({task}, timeout=poll_interval)
+            if done:
+                return task.result(), False
+            if await request.is_disconnected():
+                task.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await task
+                return None, True
+    finally:
+        if not task.done():
+            task.cancel()
+
+
+def sources_only_message(kefi_events) -> dict:
+    """The reply when there is no time left to generate an answer: the matching events, cited like an answer."""
+    if not kefi_events:
+        return {"role": "assistant", "content": "Sorry, I couldn't find an answer in time. Please try again."}
+    sources = "\n".join(f"- {kefi_event.name} [{kefi_event.id}]" for kefi_event in kefi_events)
+    return {
+        "role": "assistant",
+        "content": f"Sorry, I couldn't write an answer in time. These events matched your question:\n{sources}",
+    }
@@ -0,0 +1,110 @@
+import asyncio
+import logging
+
+import numpy as np
+
+from .embeddings import compute_text_embeddings
+
+logger = logging.getLogger("ragapp")
+
+
+class EmbeddingBatcher:
+    """
+    Collects embedding requests from concurrent handlers and sends them to the provider as one batched call.
+
+    A batch is dispatched once it holds max_batch_size inputs or once max_wait_ms has passed since its first input,
+    whichever comes first. Each caller gets back only its own vector.
+    """
+
+    def __init__(
+        self,
+        openai_client,
+        embed_model: str,
+        embed_deployment: str | None = None,
+        embedding_dimensions: int = 1536,
+        max_batch_size: int = 16,
+        max_wait_ms: float = 5.0,
+        normalize: bool = False,
+    ):
+        self.openai_client = openai_client
+        self.embed_model = embed_model
+        self.embed_deployment = embed_deployment
+        self.embedding_dimensions = embedding_dimensions
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.normalize = normalize
+        self.queue: asyncio.Queue[tuple[str, asyncio.Future]] = asyncio.Queue()
+        self.collector_task: asyncio.Task | None = None
+        self.dispatch_tasks: set[asyncio.Task] = set()
+
+    def start(self):
+        if self.collector_task is None:
+            self.collector_task = asyncio.create_task(self.collect())
+
+    async def stop(self):
+        if self.collector_task is not None:
+            self.collector_task.cancel()
+            try:
+                await self.collector_task
+            except asyncio.CancelledError:
+                pass
+            self.collector_task = None
+        if self.dispatch_tasks:
+            await asyncio.gather(*self.dispatch_tasks, return_exceptions=True)
+        while not self.queue.empty():
+            _, future = self.queue.get_nowait()
+            if not future.done():
+                future.set_exception(RuntimeError("Embedding batcher was stopped"))
+
+    async def embed(self, text: str) -> np.ndarray:
+        if self.collector_task is None:
+            raise RuntimeError("Embedding batcher is not running")
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future))
+        return await future
+
+    async def collect(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.max_wait
+            while len(batch) < self.max_batch_size:
+                # Inputs already waiting join the batch even when the loop was busy past the window
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except TimeoutError:
+                    break
+            # Dispatch in the background so a slow provider call does not hold up the next window
+            task = asyncio.create_task(self.dispatch(batch))
+            self.dispatch_tasks.add(task)
+            task.add_done_callback(self.dispatch_tasks.discard)
+
+    async def dispatch(self, batch: list[tuple[str, asyncio.Future]]):
+        # Callers that gave up (e.g. client disconnected) do not need an embedding
+        batch = [(text, future) for text, future in batch if not future.done()]
+        if not batch:
+            return
+        try:
+            embeddings = await compute_text_embeddings(
+                [text for text, _ in batch],
+                self.openai_client,
+                self.embed_model,
+                self.embed_deployment,
+                self.embedding_dimensions,
+                self.normalize,
+            )
+        except Exception as e:
+            logger.warning("Batched embedding call for %d inputs failed: %s", len(batch), e)
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(e)
+            return
+        for (_, future), embedding in zip(batch, embeddings):
+            if not future.done():
+                future.set_result(embedding)
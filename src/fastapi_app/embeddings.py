@@ -1,26 +1,70 @@
+import base64
 from typing import (
     TypedDict,
 )
 
+import numpy as np
+
+SUPPORTED_DIMENSIONS_MODEL = {
+    "text-embedding-ada-002": False,
+    "text-embedding-3-small": True,
+    "text-embedding-3-large": True,
+}
+
+
+class ExtraArgs(TypedDict, total=False):
+    dimensions: int
+
+
+def decode_embedding(embedding: str | list[float]) -> np.ndarray:
+    # Embeddings are either base64 little-endian float32, as requested from the API, or a JSON float list from
+    # providers that ignore encoding_format
+    if isinstance(embedding, str):
+        return np.frombuffer(base64.b64decode(embedding), dtype="<f4")
+    return np.asarray(embedding, dtype=np.float32)
 
-async def compute_text_embedding(
-    q: str, openai_client, embed_model: str, embed_deployment: str = None, embedding_dimensions: int = 1536
-):
-    SUPPORTED_DIMENSIONS_MODEL = {
-        "text-embedding-ada-002": False,
-        "text-embedding-3-small": True,
-        "text-embedding-3-large": True,
-    }
 
-    class ExtraArgs(TypedDict, total=False):
-        dimensions: int
+def l2_normalize(embeddings: np.ndarray) -> np.ndarray:
+    """Scale vectors (one per row) to unit length, so that inner product ranks the same as cosine similarity."""
+    norms = np.linalg.norm(embeddings, axis=-1, keepdims=True)
+    return embeddings / np.where(norms == 0, 1, norms)
 
+
+async def compute_text_embeddings(
+    texts: list[str],
+    openai_client,
+    embed_model: str,
+    embed_deployment: str = None,
+    embedding_dimensions: int = 1536,
+    normalize: bool = False,
+) -> np.ndarray:
+    """Embed texts in one call, returning a float32 matrix with one row per text."""
     dimensions_args: ExtraArgs = {"dimensions": embedding_dimensions} if SUPPORTED_DIMENSIONS_MODEL[embed_model] else {}
 
     embedding = await openai_client.embeddings.create(
         # Azure OpenAI takes the deployment name as the model name
         model=embed_deployment if embed_deployment else embed_model,
-        input=q,
+        input=texts,
+        # Asking for base64 explicitly keeps the SDK from decoding it into Python float lists
+        encoding_format="base64",
         **dimensions_args,
     )
-    return embedding.data[0].embedding
+    # The API does not guarantee that results come back in input order
+    embeddings = np.stack(
+        [decode_embedding(data.embedding) for data in sorted(embedding.data, key=lambda data: data.index)]
+    )
+    return l2_normalize(embeddings) if normalize else embeddings
+
+
+async def compute_text_embedding(
+    q: str,
+    openai_client,
+    embed_model: str,
+    embed_deployment: str = None,
+    embedding_dimensions: int = 1536,
+    normalize: bool = False,
+) -> np.ndarray:
+    embeddings = await compute_text_embeddings(
+        [q], openai_client, embed_model, embed_deployment, embedding_dimensions, normalize
+    )
+    return embeddings[0]
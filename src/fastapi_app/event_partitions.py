@@ -0,0 +1,211 @@
+"""
+Optional monthly range partitioning of kefi_events by start_date_typed.
+
+Searches are almost always about upcoming events, so with one partition per month (each with its own HNSW and
+B-tree indexes) Postgres prunes past months and the indexes it scans only cover the active window.
+Convert an existing table once, then run the maintenance command daily, e.g. from cron:
+
+    python -m fastapi_app.event_partitions partition
+    python -m fastapi_app.event_partitions maintain --months-ahead 3 --retain-months 1
+
+Maintenance creates the partitions for the coming months and detaches the ones older than the retention window,
+moving them to the kefi_events_archive schema (or dropping them with --drop).
+"""
+
+import argparse
+import asyncio
+import datetime
+import logging
+import re
+
+from dotenv import load_dotenv
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncEngine
+
+from fastapi_app.catalog_changes import install_change_notifications
+from fastapi_app.postgres_engine import create_postgres_engine_from_args, create_postgres_engine_from_env
+from fastapi_app.postgres_models import Kefi_Event
+
+logger = logging.getLogger("ragapp")
+
+TABLE = Kefi_Event.__tablename__
+DEFAULT_PARTITION = f"{TABLE}_default"
+ARCHIVE_SCHEMA = f"{TABLE}_archive"
+PARTITION_NAME = re.compile(rf"^{TABLE}_y(\d{{4}})m(\d{{2}})$")
+
+
+def month_start(day: datetime.date, months: int = 0) -> datetime.date:
+    """The first day of the month `months` months after the month of `day`."""
+    month_index = day.year * 12 + day.month - 1 + months
+    return datetime.date(month_index // 12, month_index % 12 + 1, 1)
+
+
+def partition_name(month: datetime.date) -> str:
+    return f"{TABLE}_y{month.year:04d}m{month.month:02d}"
+
+
+async def is_partitioned(conn: AsyncConnection) -> bool:
+    relkind = (
+        await conn.execute(text("SELECT relkind FROM pg_class WHERE oid = to_regclass(:table)"), {"table": TABLE})
+    ).scalar()
+    return relkind == "p"
+
+
+async def existing_partitions(conn: AsyncConnection) -> dict[datetime.date, str]:
+    names = (
+        await conn.execute(
+            text(
+                """
+                SELECT child.relname FROM pg_inherits
+                JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+                WHERE pg_inherits.inhparent = CAST(:table AS regclass)
+                """
+            ),
+            {"table": TABLE},
+        )
+    ).scalars()
+    partitions = {}
+    for name in names:
+        if match := PARTITION_NAME.match(name):
+            partitions[datetime.date(int(match[1]), int(match[2]), 1)] = name
+    return partitions
+
+
+async def create_month_partition(conn: AsyncConnection, month: datetime.date):
+    """
+    Create the partition for a month. Events of that month that landed in the default partition are moved into it,
+    since Postgres refuses to attach a partition whose range overlaps rows in the default partition.
+    """
+    name, low, high = partition_name(month), month, month_start(month, 1)
+    await conn.execute(text(f"CREATE TABLE {name} (LIKE {TABLE} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)"))
+    moved = await conn.execute(
+        text(
+            f"""
+            WITH moved AS (
+                DELETE FROM {DEFAULT_PARTITION} WHERE start_date_typed >= :low AND start_date_typed < :high RETURNING *
+            )
+            INSERT INTO {name} SELECT * FROM moved
+            """
+        ),
+        {"low": low, "high": high},
+    )
+    # Attaching builds the parent's indexes (HNSW included) on the new partition
+    await conn.execute(text(f"ALTER TABLE {TABLE} ATTACH PARTITION {name} FOR VALUES FROM ('{low}') TO ('{high}')"))
+    logger.info("Created partition %s (%d events moved from the default partition)", name, moved.rowcount)
+
+
+async def partition_events_table(engine: AsyncEngine, months_ahead: int = 3):
+    """Convert kefi_events to a table partitioned by month, with a partition for every month that has events."""
+    async with engine.begin() as conn:
+        if await is_partitioned(conn):
+            logger.info("%s is already partitioned", TABLE)
+            return
+
+        legacy = f"{TABLE}_unpartitioned"
+        sequence = (await conn.execute(text(f"SELECT pg_get_serial_sequence('{TABLE}', 'id')"))).scalar()
+        await conn.execute(text(f"ALTER TABLE {TABLE} RENAME TO {legacy}"))
+        await conn.execute(text(f"ALTER TABLE {legacy} RENAME CONSTRAINT {TABLE}_pkey TO {legacy}_pkey"))
+        for index in Kefi_Event.__table__.indexes:
+            await conn.execute(text(f"DROP INDEX IF EXISTS {index.name}"))
+        if sequence:
+            await conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+
+        # The partition key has to be part of the primary key
+        await conn.execute(
+            text(
+                f"""
+                CREATE TABLE {TABLE} (LIKE {legacy} INCLUDING DEFAULTS, PRIMARY KEY (id, start_date_typed))
+                PARTITION BY RANGE (start_date_typed)
+                """
+            )
+        )
+        await conn.execute(text(f"CREATE TABLE {DEFAULT_PARTITION} PARTITION OF {TABLE} DEFAULT"))
+        months = set(
+            (
+                await conn.execute(text(f"SELECT DISTINCT date_trunc('month', start_date_typed)::date FROM {legacy}"))
+            ).scalars()
+        )
+        months.update(month_start(datetime.date.today(), offset) for offset in range(months_ahead + 1))
+        for month in sorted(months):
+            await conn.execute(
+                text(
+                    f"CREATE TABLE {partition_name(month)} PARTITION OF {TABLE} "
+                    f"FOR VALUES FROM ('{month}') TO ('{month_start(month, 1)}')"
+                )
+            )
+
+        copied = await conn.execute(text(f"INSERT INTO {TABLE} SELECT * FROM {legacy}"))
+        # Indexes are built after the copy, which is much faster than inserting into HNSW graphs row by row
+        for index in Kefi_Event.__table__.indexes:
+            await conn.run_sync(lambda sync_conn, index=index: index.create(sync_conn))
+        await conn.execute(text(f"DROP TABLE {legacy}"))
+        # The triggers were dropped with the legacy table
+        await install_change_notifications(conn)
+        if sequence:
+            await conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id"))
+        logger.info("Partitioned %s into %d months with %d events", TABLE, len(months), copied.rowcount)
+
+    async with engine.begin() as conn:
+        await conn.execute(text(f"ANALYZE {TABLE}"))
+
+
+async def maintain_partitions(engine: AsyncEngine, months_ahead: int = 3, retain_months: int = 1, drop: bool = False):
+    """Create partitions for the coming months and detach the ones that ended more than retain_months ago."""
+    today = datetime.date.today()
+    async with engine.begin() as conn:
+        if not await is_partitioned(conn):
+            logger.error("%s is not partitioned. Run the partition command first.", TABLE)
+            return
+        partitions = await existing_partitions(conn)
+
+        for offset in range(months_ahead + 1):
+            month = month_start(today, offset)
+            if month not in partitions:
+                await create_month_partition(conn, month)
+
+        cutoff = month_start(today, -retain_months)
+        for month, name in sorted(partitions.items()):
+            if month >= cutoff:
+                continue
+            await conn.execute(text(f"ALTER TABLE {TABLE} DETACH PARTITION {name}"))
+            if drop:
+                await conn.execute(text(f"DROP TABLE {name}"))
+                logger.info("Dropped partition %s", name)
+            else:
+                await conn.execute(text(f"CREATE SCHEMA IF NOT EXISTS {ARCHIVE_SCHEMA}"))
+                await conn.execute(text(f"ALTER TABLE {name} SET SCHEMA {ARCHIVE_SCHEMA}"))
+                logger.info("Archived partition %s to the %s schema", name, ARCHIVE_SCHEMA)
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Partition kefi_events by month and maintain its partitions")
+    parser.add_argument("command", choices=["partition", "maintain"])
+    parser.add_argument("--months-ahead", type=int, default=3, help="Months of future partitions to keep ready")
+    parser.add_argument("--retain-months", type=int, default=1, help="Past months to keep attached")
+    parser.add_argument("--drop", action="store_true", help="Drop old partitions instead of archiving them")
+    parser.add_argument("--host", type=str, help="Postgres host")
+    parser.add_argument("--username", type=str, help="Postgres username")
+    parser.add_argument("--password", type=str, help="Postgres password")
+    parser.add_argument("--database", type=str, help="Postgres database")
+    parser.add_argument("--sslmode", type=str, help="Postgres sslmode")
+
+    # if no args are specified, use environment variables
+    args = parser.parse_args()
+    if args.host is None:
+        engine = await create_postgres_engine_from_env()
+    else:
+        engine = await create_postgres_engine_from_args(args)
+
+    if args.command == "partition":
+        await partition_events_table(engine, args.months_ahead)
+    else:
+        await maintain_partitions(engine, args.months_ahead, args.retain_months, args.drop)
+
+    await engine.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    load_dotenv(override=True)
+    asyncio.run(main())
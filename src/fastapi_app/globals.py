@@ -1,6 +1,11 @@
 class Global:
     def __init__(self):
         self.engine = None
+        self.read_replicas = None
+        self.search_shards = []
+        self.search_shard_candidates = 20
+        self.search_shard_timeout = 2.0
+        self.shard_change_listeners = []
         self.openai_chat_client = None
         self.openai_embed_client = None
         self.openai_chat_model = None
@@ -8,6 +13,23 @@ class Global:
         self.openai_embed_dimensions = None
         self.openai_chat_deployment = None
         self.openai_embed_deployment = None
+        self.openai_embed_normalize = False
+        self.embedding_batcher = None
+        self.model_router = None
+        self.chat_session_store = None
+        self.chat_job_runner = None
+        self.catalog_changes = None
+        self.catalog_change_listener = None
+        self.search_result_cache = None
+        self.event_row_cache = None
+        self.search_planner = None
+        self.fuzzy_search = False
+        self.fuzzy_threshold = 0.5
+        self.adaptive_retrieval = False
+        self.adaptive_min_margin = 2.0
+        self.suggest_index = None
+        self.events_partitioned = False
+        self.ready = False
 
 
 global_storage = Global()
@@ -0,0 +1,75 @@
+import logging
+import os
+
+import httpx
+
+from .metrics import UPSTREAM_HTTP_REQUESTS
+
+logger = logging.getLogger("ragapp")
+
+# One client (and so one connection pool) per endpoint origin, shared by the chat and embedding clients
+shared_clients: dict[str, httpx.AsyncClient] = {}
+
+
+class InstrumentedTransport(httpx.AsyncHTTPTransport):
+    """Counts requests per endpoint by HTTP version and by whether they opened a connection or reused one."""
+
+    def __init__(self, endpoint: str, **kwargs):
+        super().__init__(**kwargs)
+        self.endpoint = endpoint
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        opened_connection = False
+        previous_trace = request.extensions.get("trace")
+
+        async def trace(event_name: str, info: dict):
+            nonlocal opened_connection
+            if event_name == "connection.connect_tcp.complete":
+                opened_connection = True
+            if previous_trace is not None:
+                await previous_trace(event_name, info)
+
+        request.extensions["trace"] = trace
+        response = await super().handle_async_request(request)
+        http_version = response.extensions.get("http_version", b"unknown").decode()
+        UPSTREAM_HTTP_REQUESTS.labels(self.endpoint, http_version, "new" if opened_connection else "reused").inc()
+        return response
+
+
+def endpoint_origin(base_url: str) -> str:
+    url = httpx.URL(base_url)
+    return f"{url.scheme}://{url.netloc.decode()}"
+
+
+def get_shared_http_client(base_url: str) -> httpx.AsyncClient:
+    """Return the pooled HTTP client for the endpoint of base_url, creating it on first use."""
+    origin = endpoint_origin(base_url)
+    if (client := shared_clients.get(origin)) is None:
+        http2 = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+        limits = httpx.Limits(
+            max_connections=int(os.getenv("OPENAI_HTTP_MAX_CONNECTIONS", "100")),
+            max_keepalive_connections=int(os.getenv("OPENAI_HTTP_MAX_KEEPALIVE_CONNECTIONS", "20")),
+            keepalive_expiry=float(os.getenv("OPENAI_HTTP_KEEPALIVE_EXPIRY_SECONDS", "30")),
+        )
+        # HTTP/2 is negotiated over TLS, so plain http endpoints (such as a local Ollama) stay on HTTP/1.1
+        transport = InstrumentedTransport(origin, http2=http2, limits=limits)
+        client = httpx.AsyncClient(transport=transport, follow_redirects=True)
+        shared_clients[origin] = client
+        logger.info("Created shared HTTP client for %s (HTTP/2 %s)", origin, "on" if http2 else "off")
+    return client
+
+
+def openai_timeout(read_timeout_env: str, default_read_timeout: str) -> httpx.Timeout:
+    """Timeouts for one type of call. The read timeout is the longest wait for the next bytes of a response."""
+    return httpx.Timeout(
+        connect=float(os.getenv("OPENAI_CONNECT_TIMEOUT_SECONDS", "5")),
+        read=float(os.getenv(read_timeout_env, default_read_timeout)),
+        write=10,
+        pool=10,
+    )
+
+
+async def close_shared_http_clients():
+    for client in shared_clients.values():
+        await client.aclose()
+    shared_clients.clear()
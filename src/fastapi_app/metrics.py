@@ -0,0 +1,186 @@
+import contextlib
+import contextvars
+import os
+import time
+
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+
+# Under gunicorn, PROMETHEUS_MULTIPROC_DIR is set by gunicorn.conf.py so that each worker writes its samples to
+# shared files and /metrics can aggregate them across workers.
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+STAGE_DURATION = Histogram(
+    "ragapp_stage_duration_seconds",
+    "Latency of each stage of the request path",
+    ["route", "stage"],
+    buckets=(0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30),
+)
+TOKENS = Counter(
+    "ragapp_tokens",
+    "Tokens reported by the chat completion API",
+    ["stage", "model", "kind"],
+)
+CACHE_LOOKUPS = Counter(
+    "ragapp_cache_lookups",
+    "Cache lookups by cache name and result",
+    ["cache", "result"],
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "ragapp_upstream_in_flight",
+    "Upstream calls currently in flight",
+    ["upstream"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_QUEUE_DEPTH = Gauge(
+    "ragapp_upstream_queue_depth",
+    "Upstream calls waiting for a concurrency slot",
+    ["upstream"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    "ragapp_upstream_concurrency_limit",
+    "Current adaptive concurrency limit per worker",
+    ["upstream"],
+    multiprocess_mode="liveall",
+)
+UPSTREAM_SHED = Counter(
+    "ragapp_upstream_shed",
+    "Upstream calls rejected because the wait queue was full",
+    ["upstream"],
+)
+
+UPSTREAM_HTTP_REQUESTS = Counter(
+    "ragapp_upstream_http_requests",
+    "HTTP requests to upstream endpoints by HTTP version and whether they opened a new connection or reused one",
+    ["endpoint", "http_version", "connection"],
+)
+
+CHAT_BACKEND_ATTEMPTS = Counter(
+    "ragapp_chat_backend_attempts",
+    "Chat requests sent to each backend by the routing client, by outcome (won, failed or cancelled)",
+    ["backend", "outcome"],
+)
+CHAT_HEDGES = Counter(
+    "ragapp_chat_hedges",
+    "Hedged duplicate chat requests, by the backend they were sent to",
+    ["backend"],
+)
+CHAT_BACKEND_LATENCY_EWMA = Gauge(
+    "ragapp_chat_backend_latency_ewma_seconds",
+    "Moving average of the time to first token of each chat backend",
+    ["backend"],
+    multiprocess_mode="liveall",
+)
+
+MODEL_ROUTES = Counter(
+    "ragapp_model_routes",
+    "Chat steps routed to the small or large model, by whether the small model's output was escalated",
+    ["step", "tier", "outcome"],
+)
+DEADLINE_DEGRADATIONS = Counter(
+    "ragapp_deadline_degradations",
+    "Stages that ran out of their deadline budget, by the fallback used instead",
+    ["stage", "fallback"],
+)
+CHAT_JOBS = Counter(
+    "ragapp_chat_jobs",
+    "Background chat jobs by outcome (succeeded, failed, or rejected because the queue was full)",
+    ["status"],
+)
+CATALOG_INVALIDATIONS = Counter(
+    "ragapp_catalog_invalidations",
+    "Event change notifications applied to the worker's caches, for some rows or for all of them",
+    ["scope"],
+)
+POSTGRES_READS = Counter(
+    "ragapp_postgres_reads",
+    "Read-only sessions by where they ran: a replica, or the primary and why",
+    ["target"],
+)
+POSTGRES_REPLICA_LAG = Gauge(
+    "ragapp_postgres_replica_lag_seconds",
+    "Replay lag of each read replica at its last health check (-1 when it could not be checked)",
+    ["replica"],
+    multiprocess_mode="liveall",
+)
+SHARD_SEARCHES = Counter(
+    "ragapp_shard_searches",
+    "Searches sent to each shard, by outcome (ok, timeout or error). Results omit shards that timed out or failed.",
+    ["shard", "outcome"],
+)
+ADAPTIVE_RETRIEVALS = Counter(
+    "ragapp_adaptive_retrievals",
+    'Adaptive searches by the legs that ranked them (mode="text" skipped the embedding call), and why',
+    ["mode", "reason"],
+)
+
+current_timings: contextvars.ContextVar["RequestTimings | None"] = contextvars.ContextVar(
+    "current_timings", default=None
+)
+
+
+class RequestTimings:
+    """Per-request stage timings, in milliseconds, for attaching to ThoughtStep props."""
+
+    def __init__(self, route: str):
+        self.route = route
+        self.stages: dict[str, float] = {}
+
+    def pick(self, *stages: str) -> dict[str, float]:
+        return {stage: self.stages[stage] for stage in stages if stage in self.stages}
+
+
+@contextlib.contextmanager
+def request_timings(route: str):
+    timings = RequestTimings(route)
+    token = current_timings.set(timings)
+    try:
+        yield timings
+    finally:
+        current_timings.reset(token)
+
+
+@contextlib.contextmanager
+def stage(name: str):
+    """Time a stage of the current request and record it in the stage latency histogram."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        timings = current_timings.get()
+        STAGE_DURATION.labels(timings.route if timings else "none", name).observe(elapsed)
+        if timings is not None:
+            timings.stages[name] = round(timings.stages.get(name, 0.0) + elapsed * 1000, 2)
+
+
+def current_stage_timings(*stages: str) -> dict[str, float]:
+    timings = current_timings.get()
+    return timings.pick(*stages) if timings else {}
+
+
+def record_token_usage(stage: str, model: str, usage) -> None:
+    if usage is None:
+        return
+    TOKENS.labels(stage, model, "prompt").inc(usage.prompt_tokens)
+    TOKENS.labels(stage, model, "completion").inc(usage.completion_tokens)
+
+
+def record_cache_lookup(cache: str, hit: bool) -> None:
+    CACHE_LOOKUPS.labels(cache, "hit" if hit else "miss").inc()
+
+
+def render_latest() -> tuple[bytes, str]:
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return generate_latest(registry), CONTENT_TYPE_LATEST
+    return generate_latest(), CONTENT_TYPE_LATEST
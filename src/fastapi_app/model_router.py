@@ -0,0 +1,242 @@
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+from dataclasses import dataclass, field
+
+from openai.types.chat import ChatCompletion
+
+from .metrics import MODEL_ROUTES, record_token_usage
+from .query_rewriter import extract_search_arguments
+
+logger = logging.getLogger("ragapp")
+
+# Questions with these words usually need reasoning across several events rather than a lookup
+COMPLEX_QUERY_PATTERN = re.compile(
+    r"\b(compare|comparison|difference|versus|vs\.?|why|explain|plan|itinerary|schedule|best|recommend|both|either)\b",
+    re.IGNORECASE,
+)
+CITATION_PATTERN = re.compile(r"\[(\d+)\]")
+DONT_KNOW_PATTERN = re.compile(r"\b(i don'?t know|not enough information|no (matching )?events)\b", re.IGNORECASE)
+
+
+@dataclass
+class ChatModel:
+    client: object
+    model: str  # Azure OpenAI clients are bound to their deployment, so this is only sent to other hosts
+
+
+@dataclass
+class RouteDecision:
+    step: str
+    tier: str  # "small" or "large"
+    reasons: list[str] = field(default_factory=list)
+    escalated_because: str | None = None
+
+    def to_dict(self):
+        return {
+            "tier": self.tier,
+            "reasons": self.reasons,
+            "escalated_because": self.escalated_because,
+        }
+
+
+class KeywordClassifier:
+    """
+    A logistic model over the words of the query, predicting whether the question needs the large model.
+    Loaded from a JSON file: {"bias": -1.5, "threshold": 0.5, "weights": {"compare": 2.0, "tonight": -1.0}}
+    """
+
+    def __init__(self, bias: float, weights: dict[str, float], threshold: float = 0.5):
+        self.bias = bias
+        self.weights = {word.lower(): weight for word, weight in weights.items()}
+        self.threshold = threshold
+
+    @classmethod
+    def from_file(cls, path: str) -> "KeywordClassifier":
+        with open(path) as f:
+            config = json.load(f)
+        return cls(config.get("bias", 0.0), config["weights"], config.get("threshold", 0.5))
+
+    def probability_hard(self, query: str) -> float:
+        words = set(re.findall(r"[a-z']+", query.lower()))
+        score = self.bias + sum(self.weights.get(word, 0.0) for word in words)
+        return 1 / (1 + math.exp(-score))
+
+
+class ModelRouter:
+    """
+    Picks the small or large chat model for the query rewrite and answer steps, and escalates to the large
+    model when the small model's output fails validation.
+
+    The answer goes to the large model when the query looks complex (long, several questions or comparison
+    words), the conversation is long, retrieval confidence is low (the top hybrid RRF score is far from the
+    maximum, or barely above the next result), or the optional classifier predicts a hard question.
+    Decisions, escalations and an estimate of the latency and large model tokens saved are logged, and counted
+    in ragapp_model_routes.
+    """
+
+    def __init__(
+        self,
+        *,
+        small: ChatModel,
+        large: ChatModel,
+        max_query_words: int = 25,
+        max_past_messages: int = 6,
+        min_top_score_ratio: float = 0.5,
+        min_score_spread_ratio: float = 0.05,
+        classifier: KeywordClassifier | None = None,
+        route_query_rewrite: bool = True,
+        ewma_alpha: float = 0.1,
+    ):
+        self.small = small
+        self.large = large
+        self.max_query_words = max_query_words
+        self.max_past_messages = max_past_messages
+        self.min_top_score_ratio = min_top_score_ratio
+        self.min_score_spread_ratio = min_score_spread_ratio
+        self.classifier = classifier
+        self.route_query_rewrite = route_query_rewrite
+        self.ewma_alpha = ewma_alpha
+        # Moving average of latency (seconds) and total tokens per (step, tier), to estimate what routing saves
+        self.latency_ewma: dict[tuple[str, str], float] = {}
+        self.tokens_ewma: dict[tuple[str, str], float] = {}
+
+    def model_for(self, decision: RouteDecision) -> ChatModel:
+        return self.small if decision.tier == "small" else self.large
+
+    def query_reasons(self, query: str, past_messages: list[dict]) -> list[str]:
+        reasons = []
+        if len(query.split()) > self.max_query_words:
+            reasons.append("long query")
+        if query.count("?") > 1:
+            reasons.append("several questions")
+        if COMPLEX_QUERY_PATTERN.search(query):
+            reasons.append("complex wording")
+        if len(past_messages) > self.max_past_messages:
+            reasons.append("long conversation")
+        if self.classifier is not None and self.classifier.probability_hard(query) >= self.classifier.threshold:
+            reasons.append("classifier")
+        return reasons
+
+    def choose_query_rewrite(self, query: str, past_messages: list[dict]) -> RouteDecision:
+        if not self.route_query_rewrite:
+            return RouteDecision("query_rewrite", "large", ["rewrite routing disabled"])
+        # Rewriting into a search query is a simple task, unless there is a long history to resolve
+        if len(past_messages) > self.max_past_messages:
+            return RouteDecision("query_rewrite", "large", ["long conversation"])
+        return RouteDecision("query_rewrite", "small")
+
+    def choose_answer(
+        self, query: str, past_messages: list[dict], scores: list[float] | None, rrf_k: int = 60
+    ) -> RouteDecision:
+        reasons = self.query_reasons(query, past_messages)
+        if scores:
+            # A result ranked first by both the vector and full text searches scores 2 / (k + 1)
+            max_score = 2 / (rrf_k + 1)
+            if scores[0] < self.min_top_score_ratio * max_score:
+                reasons.append("low retrieval score")
+            elif len(scores) > 1 and scores[0] - scores[1] < self.min_score_spread_ratio * max_score:
+                reasons.append("no clear top result")
+        elif scores is not None:
+            reasons.append("no results")
+        return RouteDecision("answer", "large" if reasons else "small", reasons)
+
+    def validate_query_rewrite(self, chat_completion: ChatCompletion, original_user_query: str) -> str | None:
+        """Return why the search arguments can't be used, or None."""
+        try:
+            search_query, _ = extract_search_arguments(original_user_query, chat_completion)
+        except (ValueError, KeyError, TypeError) as e:  # json.JSONDecodeError is a ValueError
+            return f"invalid search arguments: {e}"
+        if not search_query:
+            return "no search query"
+        return None
+
+    def validate_answer(self, chat_completion: ChatCompletion, source_ids: set[int]) -> str | None:
+        """Return why the answer should be regenerated by the large model, or None."""
+        choice = chat_completion.choices[0]
+        content = choice.message.content or ""
+        if choice.finish_reason == "length":
+            return "truncated"
+        if not content.strip():
+            return "empty"
+        if not source_ids:
+            return None
+        cited = {int(citation) for citation in CITATION_PATTERN.findall(content)}
+        if cited - source_ids:
+            return "cited unknown sources"
+        if not cited:
+            return "declined to answer" if DONT_KNOW_PATTERN.search(content) else "no citations"
+        return None
+
+    def observe(self, step: str, tier: str, seconds: float, usage) -> None:
+        """Track the moving average latency and token use of each tier, to estimate what routing saves."""
+        samples = ((self.latency_ewma, seconds), (self.tokens_ewma, usage.total_tokens if usage else None))
+        for averages, value in samples:
+            if value is None:
+                continue
+            previous = averages.get((step, tier), value)
+            averages[(step, tier)] = self.ewma_alpha * value + (1 - self.ewma_alpha) * previous
+
+    async def complete(self, decision: RouteDecision, validate, **create_args) -> tuple[ChatCompletion, ChatModel]:
+        """
+        Run a chat completion with the decided model. Output of the small model that fails validate (which returns
+        the reason, or None) is discarded and the step is rerun with the large model.
+        """
+        model = self.model_for(decision)
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        chat_completion = await model.client.chat.completions.create(model=model.model, **create_args)
+        seconds = loop.time() - start
+        self.observe(decision.step, decision.tier, seconds, chat_completion.usage)
+
+        if decision.tier == "small" and (problem := validate(chat_completion)):
+            decision.escalated_because = problem
+            MODEL_ROUTES.labels(decision.step, "small", "escalated").inc()
+            record_token_usage(decision.step, model.model, chat_completion.usage)
+            logger.info("Escalating %s to the large model after %.0fms: %s", decision.step, seconds * 1000, problem)
+            model = self.large
+            start = loop.time()
+            chat_completion = await model.client.chat.completions.create(model=model.model, **create_args)
+            self.observe(decision.step, "large", loop.time() - start, chat_completion.usage)
+            MODEL_ROUTES.labels(decision.step, "large", "escalated").inc()
+        else:
+            MODEL_ROUTES.labels(decision.step, decision.tier, "accepted").inc()
+            self.log_decision(decision, seconds, chat_completion.usage)
+        return chat_completion, model
+
+    def log_decision(self, decision: RouteDecision, seconds: float, usage) -> None:
+        if decision.tier == "large":
+            logger.info("Routed %s to the large model: %s", decision.step, ", ".join(decision.reasons))
+            return
+        tokens = usage.total_tokens if usage else 0
+        large_latency = self.latency_ewma.get((decision.step, "large"))
+        if large_latency is None:
+            logger.info("Routed %s to the small model (%.0fms, %d tokens)", decision.step, seconds * 1000, tokens)
+            return
+        logger.info(
+            "Routed %s to the small model (%.0fms, %d tokens), the large model averages %.0fms and %.0f tokens",
+            decision.step,
+            seconds * 1000,
+            tokens,
+            large_latency * 1000,
+            self.tokens_ewma.get((decision.step, "large"), 0.0),
+        )
+
+
+def create_model_router_from_env(small: ChatModel, large: ChatModel) -> ModelRouter:
+    classifier = None
+    if classifier_path := os.getenv("MODEL_ROUTER_CLASSIFIER_PATH"):
+        classifier = KeywordClassifier.from_file(classifier_path)
+    return ModelRouter(
+        small=small,
+        large=large,
+        max_query_words=int(os.getenv("MODEL_ROUTER_MAX_QUERY_WORDS", "25")),
+        max_past_messages=int(os.getenv("MODEL_ROUTER_MAX_PAST_MESSAGES", "6")),
+        min_top_score_ratio=float(os.getenv("MODEL_ROUTER_MIN_TOP_SCORE_RATIO", "0.5")),
+        min_score_spread_ratio=float(os.getenv("MODEL_ROUTER_MIN_SCORE_SPREAD_RATIO", "0.05")),
+        classifier=classifier,
+        route_query_rewrite=os.getenv("MODEL_ROUTER_ROUTE_QUERY_REWRITE", "true").lower() == "true",
+    )
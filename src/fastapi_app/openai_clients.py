@@ -1,14 +1,36 @@
 import logging
 import os
 
-import azure.identity
 import openai
 
+from .http_clients import get_shared_http_client, openai_timeout
+
 logger = logging.getLogger("ragapp")
 
 
-async def create_openai_chat_client(azure_credential):
-    OPENAI_CHAT_HOST = os.getenv("OPENAI_CHAT_HOST")
+def openai_base_url() -> str:
+    return os.getenv("OPENAI_BASE_URL") or "https://api.openai.com/v1"
+
+
+def chat_model_name(host: str | None, small: bool = False) -> str | None:
+    prefix = {"azure": "AZURE_OPENAI", "ollama": "OLLAMA"}.get(host, "OPENAICOM")
+    return os.getenv(f"{prefix}_{'CHAT_SMALL' if small else 'CHAT'}_MODEL")
+
+
+async def create_openai_chat_client(
+    azure_credential, host: str | None = None, small: bool = False, max_retries: int = openai.DEFAULT_MAX_RETRIES
+):
+    """
+    Create the chat client for a host. With small=True, the client is for the host's cheaper, faster model
+    (the *_CHAT_SMALL_* variables), and (None, None) is returned when no small model is configured.
+    Clients behind an AdaptiveConcurrencyLimiter take max_retries=0, so the limiter sees every 429.
+    """
+    OPENAI_CHAT_HOST = host or os.getenv("OPENAI_CHAT_HOST")
+    openai_chat_model = chat_model_name(OPENAI_CHAT_HOST, small)
+    if small and not openai_chat_model:
+        return None, None
+    # Streamed answers can pause between chunks, so chat calls get a longer read timeout than embeddings
+    timeout = openai_timeout("OPENAI_CHAT_READ_TIMEOUT_SECONDS", "60")
     if OPENAI_CHAT_HOST == "azure":
         client_args = {}
         if api_key := os.getenv("AZURE_OPENAI_KEY"):
@@ -16,6 +38,8 @@ async def create_openai_chat_client(azure_credential):
             client_args["api_key"] = api_key
         else:
             logger.info("Authenticating to Azure OpenAI using Azure Identity...")
+            import azure.identity
+
             token_provider = azure.identity.get_bearer_token_provider(
                 azure_credential, "https://cognitiveservices.azure.com/.default"
             )
@@ -23,29 +47,39 @@ async def create_openai_chat_client(azure_credential):
         openai_chat_client = openai.AsyncAzureOpenAI(
             api_version=os.getenv("AZURE_OPENAI_VERSION"),
             azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
-            azure_deployment=os.getenv("AZURE_OPENAI_CHAT_DEPLOYMENT"),
+            # Azure OpenAI routes requests by the deployment in the URL
+            azure_deployment=os.getenv(f"AZURE_OPENAI_{'CHAT_SMALL' if small else 'CHAT'}_DEPLOYMENT"),
+            http_client=get_shared_http_client(os.getenv("AZURE_OPENAI_ENDPOINT")),
+            timeout=timeout,
+            max_retries=max_retries,
             **client_args,
         )
-        openai_chat_model = os.getenv("AZURE_OPENAI_CHAT_MODEL")
     elif OPENAI_CHAT_HOST == "ollama":
         logger.info("Authenticating to OpenAI using Ollama...")
         openai_chat_client = openai.AsyncOpenAI(
             base_url=os.getenv("OLLAMA_ENDPOINT"),
             api_key="nokeyneeded",
+            http_client=get_shared_http_client(os.getenv("OLLAMA_ENDPOINT")),
+            timeout=timeout,
+            max_retries=max_retries,
         )
-        openai_chat_model = os.getenv("OLLAMA_CHAT_MODEL")
     else:
         logger.info("Authenticating to OpenAI using OpenAI.com API key...")
         openai.api_base = "http://165.22.90.175"
         openai.verify_ssl_certs = False
-        openai_chat_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAICOM_KEY"))
-        openai_chat_model = os.getenv("OPENAICOM_CHAT_MODEL")
+        openai_chat_client = openai.AsyncOpenAI(
+            api_key=os.getenv("OPENAICOM_KEY"),
+            http_client=get_shared_http_client(openai_base_url()),
+            timeout=timeout,
+            max_retries=max_retries,
+        )
 
     return openai_chat_client, openai_chat_model
 
 
-async def create_openai_embed_client(azure_credential):
+async def create_openai_embed_client(azure_credential, max_retries: int = openai.DEFAULT_MAX_RETRIES):
     OPENAI_EMBED_HOST = os.getenv("OPENAI_EMBED_HOST")
+    timeout = openai_timeout("OPENAI_EMBED_READ_TIMEOUT_SECONDS", "10")
     if OPENAI_EMBED_HOST == "azure":
         client_args = {}
         if api_key := os.getenv("AZURE_OPENAI_KEY"):
@@ -53,6 +87,8 @@ async def create_openai_embed_client(azure_credential):
             client_args["api_key"] = api_key
         else:
             logger.info("Authenticating to Azure OpenAI using Azure Identity...")
+            import azure.identity
+
             token_provider = azure.identity.get_bearer_token_provider(
                 azure_credential, "https://cognitiveservices.azure.com/.default"
             )
@@ -61,6 +97,9 @@ async def create_openai_embed_client(azure_credential):
             api_version=os.getenv("AZURE_OPENAI_VERSION"),
             azure_endpoint=os.getenv("AZURE_OPENAI_ENDPOINT"),
             azure_deployment=os.getenv("AZURE_OPENAI_EMBED_DEPLOYMENT"),
+            http_client=get_shared_http_client(os.getenv("AZURE_OPENAI_ENDPOINT")),
+            timeout=timeout,
+            max_retries=max_retries,
             **client_args,
         )
         openai_embed_model = os.getenv("AZURE_OPENAI_EMBED_MODEL")
@@ -68,7 +107,12 @@ async def create_openai_embed_client(azure_credential):
     else:
         openai.api_base = "http://165.22.90.175"
         openai.verify_ssl_certs = False
-        openai_embed_client = openai.AsyncOpenAI(api_key=os.getenv("OPENAICOM_KEY"))
+        openai_embed_client = openai.AsyncOpenAI(
+            api_key=os.getenv("OPENAICOM_KEY"),
+            http_client=get_shared_http_client(openai_base_url()),
+            timeout=timeout,
+            max_retries=max_retries,
+        )
         openai_embed_model = os.getenv("OPENAICOM_EMBED_MODEL")
         openai_embed_dimensions = os.getenv("OPENAICOM_EMBED_DIMENSIONS")
     return openai_embed_client, openai_embed_model, openai_embed_dimensions
@@ -1,7 +1,7 @@
 import logging
 import os
 
-from azure.identity import DefaultAzureCredential
+from pgvector.asyncpg import register_vector
 from sqlalchemy import event
 from sqlalchemy.ext.asyncio import AsyncEngine, create_async_engine
 
@@ -39,11 +39,26 @@ async def create_postgres_engine(*, host, username, database, password, sslmode,
             logger.info("Updating password token for Azure Database for PostgreSQL")
             cparams["password"] = get_password_from_azure_credential()
 
+    @event.listens_for(engine.sync_engine, "connect")
+    def register_vector_codec(dbapi_connection, connection_record):
+        # Send and receive vectors as raw float32 instead of formatting and parsing their text form
+        dbapi_connection.run_async(register_vector_codec_if_available)
+
     return engine
 
 
+async def register_vector_codec_if_available(connection):
+    try:
+        await register_vector(connection)
+    except ValueError:
+        # The vector extension doesn't exist until setup_postgres_database has created it
+        logger.info("The vector type does not exist yet, so its binary codec is not registered")
+
+
 async def create_postgres_engine_from_env(azure_credential=None) -> AsyncEngine:
     if azure_credential is None and os.environ["POSTGRES_HOST"].endswith(".database.azure.com"):
+        from azure.identity import DefaultAzureCredential
+
         azure_credential = DefaultAzureCredential()
 
     return await create_postgres_engine(
@@ -58,6 +73,8 @@ async def create_postgres_engine_from_env(azure_credential=None) -> AsyncEngine:
 
 async def create_postgres_engine_from_args(args, azure_credential=None) -> AsyncEngine:
     if azure_credential is None and args.host.endswith(".database.azure.com"):
+        from azure.identity import DefaultAzureCredential
+
         azure_credential = DefaultAzureCredential()
 
     return await create_postgres_engine(
@@ -68,3 +85,48 @@ async def create_postgres_engine_from_args(args, azure_credential=None) -> Async
         sslmode=args.sslmode,
         azure_credential=azure_credential,
     )
+
+
+async def create_secondary_postgres_engines(targets: list[tuple[str, str]], azure_credential=None) -> list[AsyncEngine]:
+    """
+    Engines for other (host, database) pairs, such as read replicas or search shards, with the username, password
+    and SSL mode of the primary, and Azure tokens for Azure hosts like the primary.
+    """
+    if azure_credential is None and any(host.endswith(".database.azure.com") for host, _ in targets):
+        from azure.identity import DefaultAzureCredential
+
+        azure_credential = DefaultAzureCredential()
+
+    return [
+        await create_postgres_engine(
+            host=host,
+            username=os.environ["POSTGRES_USERNAME"],
+            database=database,
+            password=os.environ.get("POSTGRES_PASSWORD"),
+            sslmode=os.environ.get("POSTGRES_SSL"),
+            azure_credential=azure_credential,
+        )
+        for host, database in targets
+    ]
+
+
+async def create_postgres_replica_engines_from_env(azure_credential=None) -> dict[str, AsyncEngine]:
+    """Engines for the read replicas in POSTGRES_REPLICA_HOSTS (comma separated), keyed by host."""
+    hosts = [host.strip() for host in os.getenv("POSTGRES_REPLICA_HOSTS", "").split(",") if host.strip()]
+    targets = [(host, os.environ["POSTGRES_DATABASE"]) for host in hosts]
+    return dict(zip(hosts, await create_secondary_postgres_engines(targets, azure_credential)))
+
+
+async def create_postgres_shard_engines_from_env(azure_credential=None) -> dict[str, AsyncEngine]:
+    """
+    Engines for the search shards in POSTGRES_SHARDS, a comma separated list of host/database (for example
+    "localhost/events_0,localhost/events_1"), keyed by that name. Events belong to shards by id (see sharded_searcher).
+    """
+    names = [name.strip() for name in os.getenv("POSTGRES_SHARDS", "").split(",") if name.strip()]
+    targets = []
+    for name in names:
+        host, _, database = name.partition("/")
+        if not database:
+            raise ValueError(f"POSTGRES_SHARDS entries must be host/database, not {name!r}")
+        targets.append((host, database))
+    return dict(zip(names, await create_secondary_postgres_engines(targets, azure_credential)))
@@ -1,13 +1,35 @@
 from __future__ import annotations
 
 from dataclasses import asdict
-from datetime import date
+from datetime import date, datetime
 
+import numpy as np
 from pgvector.sqlalchemy import Vector
-from sqlalchemy import Date, Index
+from sqlalchemy import Date, DateTime, ForeignKey, Index, func, text
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase, Mapped, MappedAsDataclass, mapped_column
 
 
+class BinaryVector(Vector):
+    """
+    A pgvector column bound as a float32 array, which the binary codec that postgres_engine registers on every
+    asyncpg connection sends as raw floats. Values are read back as float32 arrays by the same codec.
+    """
+
+    cache_ok = True
+
+    def bind_processor(self, dialect):
+        def process(value):
+            if value is None:
+                return None
+            value = np.asarray(value, dtype=np.float32)
+            if self.dim is not None and value.shape != (self.dim,):
+                raise ValueError(f"expected {self.dim} dimensions, not {value.shape}")
+            return value
+
+        return process
+
+
 # Define the models
 class Base(DeclarativeBase, MappedAsDataclass):
     pass
@@ -21,7 +43,7 @@ class Item(Base):
     name: Mapped[str] = mapped_column()
     description: Mapped[str] = mapped_column()
     price: Mapped[float] = mapped_column()
-    embedding: Mapped[Vector] = mapped_column(Vector(1536))  # ada-002
+    embedding: Mapped[Vector] = mapped_column(BinaryVector(1536))  # ada-002
 
     def to_dict(self, include_embedding: bool = False):
         model_dict = asdict(self)
@@ -47,10 +69,15 @@ class Kefi_Event(Base):
     price: Mapped[float] = mapped_column()
     start_date: Mapped[str] = mapped_column()
     start_date_typed: Mapped[date] = mapped_column(Date)
-    embedding: Mapped[Vector] = mapped_column(Vector(1536))  # ada-002
+    embedding: Mapped[Vector] = mapped_column(BinaryVector(1536))  # ada-002
+    # Kept current by the triggers in catalog_changes
+    version: Mapped[int] = mapped_column(server_default=text("1"), init=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), init=False)
 
     def to_dict(self, include_embedding: bool = False):
         model_dict = asdict(self)
+        # The change tracking columns are internal, and not part of the API's event objects
+        del model_dict["version"], model_dict["updated_at"]
         if include_embedding:
             model_dict["embedding"] = model_dict["embedding"].tolist()
         else:
@@ -64,6 +91,48 @@ class Kefi_Event(Base):
         return f"Name: {self.name} Description: {self.description} Category: {self.category}"
 
 
+class ChatSession(Base):
+    """
+    A server-side conversation. Turns older than the history budget are folded into the rolling summary.
+    Each turn pushes expires_at back, and sessions past it are purged with their messages (see chat_sessions).
+    """
+
+    __tablename__ = "chat_sessions"
+    id: Mapped[str] = mapped_column(primary_key=True)
+    expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    summary: Mapped[str] = mapped_column(default="")
+    summary_tokens: Mapped[int] = mapped_column(default=0)
+    created_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), init=False)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), init=False)
+
+
+class ChatSessionMessage(Base):
+    __tablename__ = "chat_session_messages"
+    id: Mapped[int] = mapped_column(primary_key=True, autoincrement=True, init=False)
+    session_id: Mapped[str] = mapped_column(ForeignKey("chat_sessions.id", ondelete="CASCADE"))
+    role: Mapped[str] = mapped_column()
+    content: Mapped[str] = mapped_column()
+    tokens: Mapped[int] = mapped_column()  # Counted once, when the message is stored
+    summarized: Mapped[bool] = mapped_column(default=False)
+
+
+class ChatJob(Base):
+    """A chat request run in the background (see chat_jobs), kept with its result until expires_at."""
+
+    __tablename__ = "chat_jobs"
+    id: Mapped[str] = mapped_column(primary_key=True)
+    request_hash: Mapped[str] = mapped_column()
+    expires_at: Mapped[datetime] = mapped_column(DateTime(timezone=True))
+    idempotency_key: Mapped[str | None] = mapped_column(unique=True, default=None)
+    status: Mapped[str] = mapped_column(default="queued")  # queued, running, succeeded or failed
+    result: Mapped[dict | None] = mapped_column(JSONB, default=None)
+    error: Mapped[str | None] = mapped_column(default=None)
+    updated_at: Mapped[datetime] = mapped_column(DateTime(timezone=True), server_default=func.now(), init=False)
+
+    def to_dict(self):
+        return {"job_id": self.id, "status": self.status, "result": self.result, "error": self.error}
+
+
 # Define HNSW index to support vector similarity search through the vector_cosine_ops access method (cosine distance).
 index = Index(
     "hnsw_index_for_innerproduct_item_embedding",
@@ -80,3 +149,35 @@ event_index = Index(
     postgresql_with={"m": 16, "ef_construction": 64},
     postgresql_ops={"embedding": "vector_ip_ops"},
 )
+
+# Partial HNSW index over free events, used by filtered searches for price = 0 (see search_planner.PARTIAL_INDEXES)
+free_event_index = Index(
+    "hnsw_index_for_innerproduct_free_event_embedding",
+    Kefi_Event.embedding,
+    postgresql_using="hnsw",
+    postgresql_with={"m": 16, "ef_construction": 64},
+    postgresql_ops={"embedding": "vector_ip_ops"},
+    postgresql_where=text("price = 0"),
+)
+
+# B-tree indexes for the price and date filters, used to prefilter rows when a filter is selective
+event_price_index = Index("ix_kefi_events_price", Kefi_Event.price)
+event_start_date_index = Index("ix_kefi_events_start_date_typed", Kefi_Event.start_date_typed)
+# Trigram indexes for the fuzzy retrieval leg, which matches misspelled names and categories (needs pg_trgm)
+event_name_trgm_index = Index(
+    "ix_kefi_events_name_trgm", Kefi_Event.name, postgresql_using="gin", postgresql_ops={"name": "gin_trgm_ops"}
+)
+event_category_trgm_index = Index(
+    "ix_kefi_events_category_trgm",
+    Kefi_Event.category,
+    postgresql_using="gin",
+    postgresql_ops={"category": "gin_trgm_ops"},
+)
+
+# Sessions load their unsummarized messages in order on every turn
+chat_session_message_index = Index(
+    "ix_chat_session_messages_session_id",
+    ChatSessionMessage.session_id,
+    ChatSessionMessage.id,
+    postgresql_where=text("NOT summarized"),
+)
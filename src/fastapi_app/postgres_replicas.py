@@ -0,0 +1,139 @@
+"""
+Routing of read-only sessions (event search, hydration, /items and /similar) to Postgres read replicas, so they
+don't compete with writes and maintenance such as update_embeddings or REINDEX on the primary.
+
+A background task checks every replica's replay lag. Sessions go to a healthy replica within the lag limit, in
+turn, and to the primary when there is none, when connecting to the chosen replica fails, or for a short while after
+the catalog changed, so caches aren't refilled with rows that a replica has not replayed yet.
+"""
+
+import asyncio
+import contextlib
+import logging
+import time
+from collections.abc import AsyncIterator
+from dataclasses import dataclass, field
+
+from sqlalchemy import text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, AsyncSession, async_sessionmaker
+
+from .metrics import POSTGRES_READS, POSTGRES_REPLICA_LAG
+
+logger = logging.getLogger("ragapp")
+
+# Replay lag in seconds, or 0 when the replica has replayed everything it received (an idle primary sends nothing,
+# so the time since the last replayed transaction would keep growing)
+REPLICA_LAG_SQL = """
+SELECT CASE
+    WHEN NOT pg_is_in_recovery() OR pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+    ELSE EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+END
+"""
+
+
+@dataclass
+class Replica:
+    name: str
+    engine: AsyncEngine
+    session_maker: async_sessionmaker = field(init=False)
+    healthy: bool = False  # Not used until its first health check passes
+    lag: float | None = None
+
+    def __post_init__(self):
+        self.session_maker = async_sessionmaker(self.engine, expire_on_commit=False)
+
+
+class ReadReplicas:
+    def __init__(
+        self,
+        primary: AsyncEngine,
+        replicas: list[Replica],
+        max_lag_seconds: float = 5,
+        check_interval: float = 5,
+        check_timeout: float = 2,
+    ):
+        self.primary_session_maker = async_sessionmaker(primary, expire_on_commit=False)
+        self.replicas = replicas
+        self.max_lag_seconds = max_lag_seconds
+        self.check_interval = check_interval
+        self.check_timeout = check_timeout
+        self.next_replica = 0
+        self.primary_until = 0.0
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            with contextlib.suppress(asyncio.CancelledError):
+                await self.task
+            self.task = None
+        for replica in self.replicas:
+            await replica.engine.dispose()
+
+    def on_catalog_change(self, ids: set[int] | None):
+        # Replicas may not have replayed the change yet, so read it from the primary until they should have
+        self.primary_until = time.monotonic() + self.max_lag_seconds
+
+    def choose(self) -> Replica | None:
+        if time.monotonic() < self.primary_until:
+            POSTGRES_READS.labels("primary:recent_change").inc()
+            return None
+        for _ in range(len(self.replicas)):
+            replica = self.replicas[self.next_replica % len(self.replicas)]
+            self.next_replica += 1
+            if replica.healthy and replica.lag is not None and replica.lag <= self.max_lag_seconds:
+                return replica
+        POSTGRES_READS.labels("primary:no_replica").inc()
+        return None
+
+    @contextlib.asynccontextmanager
+    async def session(self) -> AsyncIterator[AsyncSession]:
+        """A read-only session, on a replica when one is usable and on the primary otherwise."""
+        if (replica := self.choose()) is not None:
+            session = replica.session_maker()
+            try:
+                # Connect now, so a replica that is down falls back to the primary before any query runs
+                await session.connection()
+            except (OSError, DBAPIError) as e:
+                await session.close()
+                self.mark_unhealthy(replica, e)
+                POSTGRES_READS.labels("primary:replica_failed").inc()
+            else:
+                POSTGRES_READS.labels("replica").inc()
+                async with session:
+                    yield session
+                return
+        async with self.primary_session_maker() as session:
+            yield session
+
+    def mark_unhealthy(self, replica: Replica, error: Exception):
+        if replica.healthy:
+            logger.warning("Read replica %s is unavailable (%s), reading from the primary", replica.name, error)
+        replica.healthy = False
+        POSTGRES_REPLICA_LAG.labels(replica.name).set(-1)
+
+    async def check(self, replica: Replica):
+        try:
+            async with asyncio.timeout(self.check_timeout), replica.engine.connect() as conn:
+                lag = await conn.scalar(text(REPLICA_LAG_SQL))
+        except (OSError, DBAPIError) as e:
+            self.mark_unhealthy(replica, e)
+            return
+        replica.lag = float(lag) if lag is not None else None
+        if not replica.healthy:
+            logger.info("Read replica %s is available (lag %s seconds)", replica.name, replica.lag)
+        replica.healthy = True
+        POSTGRES_REPLICA_LAG.labels(replica.name).set(-1 if replica.lag is None else replica.lag)
+
+    async def run(self):
+        while True:
+            try:
+                await asyncio.gather(*(self.check(replica) for replica in self.replicas))
+            except Exception as e:
+                logger.warning("Could not check the read replicas: %s", e)
+            await asyncio.sleep(self.check_interval)
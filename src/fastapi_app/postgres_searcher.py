@@ -1,10 +1,216 @@
+import datetime
+import functools
+import logging
+
+import numpy as np
 from openai import AsyncOpenAI
-from pgvector.utils import to_db
-from sqlalchemy import Float, Integer, select, text
+from sqlalchemy import Boolean, Float, Integer, TextualSelect, select, text
+from sqlalchemy.exc import DBAPIError
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
+from fastapi_app.adaptive_retrieval import LexicalHit, RetrievalDecision, decide, record_decision
+from fastapi_app.deadlines import record_degradation, stage_budget, within_budget
+from fastapi_app.embedding_batcher import EmbeddingBatcher
 from fastapi_app.embeddings import compute_text_embedding
+from fastapi_app.metrics import stage
 from fastapi_app.postgres_models import Kefi_Event
+from fastapi_app.postgres_replicas import ReadReplicas
+from fastapi_app.search_cache import EventRowCache, RankedResults, SearchResultCache, normalize_query
+from fastapi_app.search_planner import FilteredSearchPlanner, SearchPlan
+
+logger = logging.getLogger("ragapp")
+
+# Filters are interpolated into cached SQL by column and operator, with values always sent as bind parameters,
+# so only these columns and operators are accepted
+FILTER_COLUMNS = {
+    "price": float,
+    "start_date_typed": datetime.date.fromisoformat,
+    "category": str,
+}
+FILTER_OPERATORS = {">", "<", ">=", "<=", "=", "!=", "BETWEEN"}
+
+QUERY_CANCELED = "57014"  # SQLSTATE of statements cancelled by statement_timeout
+
+
+def filter_shape(filters: list[dict] | None) -> tuple[tuple[str, str], ...]:
+    if not filters:
+        return ()
+    shape = []
+    for filter in filters:
+        column, operator = filter["column"], filter["comparison_operator"].upper()
+        if column not in FILTER_COLUMNS:
+            raise ValueError(f"Unsupported filter column: {column}")
+        if operator not in FILTER_OPERATORS:
+            raise ValueError(f"Unsupported filter operator: {operator}")
+        shape.append((column, operator))
+    return tuple(shape)
+
+
+def filter_params(filters: list[dict] | None) -> dict:
+    params = {}
+    for i, filter in enumerate(filters or []):
+        convert = FILTER_COLUMNS[filter["column"]]
+        if filter["comparison_operator"].upper() == "BETWEEN":
+            low, high = filter["value"]
+            params[f"filter_{i}_low"] = convert(low)
+            params[f"filter_{i}_high"] = convert(high)
+        else:
+            params[f"filter_{i}"] = convert(filter["value"])
+    return params
+
+
+def canonical_filters(filters: list[dict] | None) -> tuple:
+    """Filters as a hashable key: in a fixed order, with operators upper case and values of the column's type."""
+    canonical = []
+    for filter in filters or []:
+        convert = FILTER_COLUMNS[filter["column"]]
+        operator = filter["comparison_operator"].upper()
+        value = tuple(map(convert, filter["value"])) if operator == "BETWEEN" else convert(filter["value"])
+        canonical.append((filter["column"], operator, value))
+    return tuple(sorted(canonical, key=repr))
+
+
+def search_mode(has_text: bool, has_vector: bool) -> str | None:
+    if has_text and has_vector:
+        return "hybrid"
+    elif has_vector:
+        return "vector"
+    elif has_text:
+        return "text"
+    return None
+
+
+def build_filter_clause(shape: tuple[tuple[str, str], ...]) -> tuple[str, str]:
+    filter_clauses = []
+    for i, (column, operator) in enumerate(shape):
+        if operator == "BETWEEN":
+            filter_clauses.append(f"{column} BETWEEN :filter_{i}_low AND :filter_{i}_high")
+        else:
+            filter_clauses.append(f"{column} {operator} :filter_{i}")
+    filter_clause = " AND ".join(filter_clauses)
+    if len(filter_clause) > 0:
+        return f"WHERE {filter_clause}", f"AND {filter_clause}"
+    return "", ""
+
+
+@functools.lru_cache(maxsize=256)
+def build_search_statement(
+    mode: str,
+    shape: tuple[tuple[str, str], ...],
+    vector_strategy: str = "index",
+    index_predicate: str = "",
+    fuzzy: bool = False,
+) -> TextualSelect:
+    """
+    Build the ranking statement for a retrieval mode ("hybrid", "vector" or "text") and filter shape.
+    With vector_strategy="exact", the vector leg ranks the filtered rows exactly instead of scanning the HNSW index.
+    index_predicate is the literal predicate of a partial index to scan (see search_planner.PARTIAL_INDEXES).
+    With fuzzy, modes that search the query text also rank names and categories by trigram word similarity,
+    which matches misspelled words, and fuse that leg into RRF.
+    Statements are cached, so each distinct combination is only built once per worker.
+    """
+    filter_clause_where, filter_clause_and = build_filter_clause(shape)
+
+    # Ordered by negative inner product (<#>), the operator the HNSW index is built for. OpenAI embeddings are
+    # unit length, so this ranks the same as cosine distance.
+    if vector_strategy == "exact":
+        # OFFSET 0 keeps the subquery from being flattened, so the filters run first (on the B-tree indexes)
+        # and the HNSW index can't be used for the ORDER BY
+        vector_query = f"""
+        SELECT id, RANK () OVER (ORDER BY embedding <#> :embedding) AS rank
+            FROM (SELECT id, embedding FROM kefi_events {filter_clause_where} OFFSET 0) AS prefiltered
+            ORDER BY embedding <#> :embedding
+            LIMIT 20
+        """
+    elif vector_strategy == "index":
+        if index_predicate:
+            filter_clause_where = f"{filter_clause_where} AND {index_predicate}"
+        vector_query = f"""
+        SELECT id, RANK () OVER (ORDER BY embedding <#> :embedding) AS rank
+            FROM kefi_events
+            {filter_clause_where}
+            ORDER BY embedding <#> :embedding
+            LIMIT 20
+        """
+    else:
+        raise ValueError(f"Unsupported vector strategy: {vector_strategy}")
+
+    fulltext_query = f"""
+        SELECT id, RANK () OVER (ORDER BY ts_rank_cd(to_tsvector('english', description), query) DESC)
+            FROM kefi_events, plainto_tsquery('english', :query) query
+            WHERE to_tsvector('english', description) @@ query {filter_clause_and}
+            ORDER BY ts_rank_cd(to_tsvector('english', description), query) DESC
+            LIMIT 20
+        """
+
+    hybrid_query = f"""
+    WITH vector_search AS (
+        {vector_query}
+    ),
+    fulltext_search AS (
+        {fulltext_query}
+    )
+    SELECT
+        COALESCE(vector_search.id, fulltext_search.id) AS id,
+        COALESCE(1.0 / (:k + vector_search.rank), 0.0) +
+        COALESCE(1.0 / (:k + fulltext_search.rank), 0.0) AS score
+    FROM vector_search
+    FULL OUTER JOIN fulltext_search ON vector_search.id = fulltext_search.id
+    ORDER BY score DESC
+    LIMIT 20
+    """
+
+    if fuzzy and mode in ("hybrid", "text"):
+        # <% is true when the query closely matches a run of words in the column, and uses the trigram GIN indexes.
+        # Its cutoff is the pg_trgm.word_similarity_threshold setting.
+        similarity = "greatest(word_similarity(:query, name), word_similarity(:query, category))"
+        fuzzy_query = f"""
+        SELECT id, RANK () OVER (ORDER BY {similarity} DESC)
+            FROM kefi_events
+            WHERE (:query <% name OR :query <% category) {filter_clause_and}
+            ORDER BY {similarity} DESC
+            LIMIT 20
+        """
+        legs = {"fulltext_search": fulltext_query, "fuzzy_search": fuzzy_query}
+        if mode == "hybrid":
+            legs = {"vector_search": vector_query} | legs
+        ctes = ",\n".join(f"{name} AS ({query})" for name, query in legs.items())
+        ranks = " UNION ALL ".join(f"SELECT id, rank FROM {name}" for name in legs)
+        fused_query = f"""
+        WITH {ctes}
+        SELECT id, SUM(1.0 / (:k + rank)) AS score
+        FROM ({ranks}) AS ranks
+        GROUP BY id
+        ORDER BY score DESC
+        LIMIT 20
+        """
+        return text(fused_query).columns(id=Integer, score=Float)
+
+    if mode == "hybrid":
+        return text(hybrid_query).columns(id=Integer, score=Float)
+    elif mode == "vector":
+        return text(vector_query).columns(id=Integer, rank=Integer)
+    elif mode == "text":
+        return text(fulltext_query).columns(id=Integer, rank=Integer)
+    raise ValueError(f"Unsupported search mode: {mode}")
+
+
+@functools.lru_cache(maxsize=256)
+def build_lexical_probe_statement(shape: tuple[tuple[str, str], ...]) -> TextualSelect:
+    """
+    The full text leg of build_search_statement with its scores, and whether each event's name has every word of
+    the query, for adaptive retrieval to judge whether the vector leg is needed.
+    """
+    _, filter_clause_and = build_filter_clause(shape)
+    probe_query = f"""
+        SELECT id, ts_rank_cd(to_tsvector('english', description), query) AS score,
+            to_tsvector('english', name) @@ query AS name_match
+            FROM kefi_events, plainto_tsquery('english', :query) query
+            WHERE to_tsvector('english', description) @@ query {filter_clause_and}
+            ORDER BY score DESC
+            LIMIT 20
+        """
+    return text(probe_query).columns(id=Integer, score=Float, name_match=Boolean)
 
 
 class PostgresSearcher:
@@ -15,91 +221,99 @@ class PostgresSearcher:
         embed_deployment: str | None,  # Not needed for non-Azure OpenAI or for retrieval_mode="text"
         embed_model: str,
         embed_dimensions: int,
+        embedding_batcher: EmbeddingBatcher | None = None,
+        search_planner: FilteredSearchPlanner | None = None,
+        upcoming_only: bool = False,
+        embed_normalize: bool = False,
+        result_cache: SearchResultCache | None = None,
+        row_cache: EventRowCache | None = None,
+        read_replicas: ReadReplicas | None = None,
+        fuzzy_search: bool = False,
+        fuzzy_threshold: float = 0.5,
+        adaptive_retrieval: bool = False,
+        adaptive_min_margin: float = 2.0,
     ):
-        self.async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
+        # Searches only read, so they run on a replica when there is one
+        if read_replicas is not None:
+            self.async_session_maker = read_replicas.session
+        else:
+            self.async_session_maker = async_sessionmaker(engine, expire_on_commit=False)
         self.openai_embed_client = openai_embed_client
         self.embed_model = embed_model
         self.embed_deployment = embed_deployment
         self.embed_dimensions = embed_dimensions
-
-    def build_filter_clause(self, filters) -> tuple[str, str]:
-        if filters is None:
-            return "", ""
-        filter_clauses = []
-        for filter in filters:
-            if isinstance(filter["value"], str):
-                filter["value"] = f"'{filter['value']}'"
-            filter_clauses.append(f"{filter['column']} {filter['comparison_operator']} {filter['value']}")
-        filter_clause = " AND ".join(filter_clauses)
-        if len(filter_clause) > 0:
-            return f"WHERE {filter_clause}", f"AND {filter_clause}"
-        return "", ""
+        self.embedding_batcher = embedding_batcher
+        self.search_planner = search_planner
+        self.upcoming_only = upcoming_only
+        self.embed_normalize = embed_normalize
+        self.result_cache = result_cache
+        self.row_cache = row_cache
+        # Whether search_and_embed adds the fuzzy leg when the caller doesn't say
+        self.fuzzy_search = fuzzy_search
+        self.fuzzy_threshold = fuzzy_threshold
+        # Whether search_and_embed tries full text search alone first, when asked for both legs
+        self.adaptive_retrieval = adaptive_retrieval
+        self.adaptive_min_margin = adaptive_min_margin
+        self.last_plan: SearchPlan | None = None
+        # RRF scores of the last hybrid or fuzzy search, best first (None for single leg searches)
+        self.last_scores: list[float] | None = None
+        # How the last adaptive search was ranked (None when it wasn't adaptive)
+        self.last_retrieval: RetrievalDecision | None = None
 
     async def search(
         self,
         query_text: str | None,
-        query_vector: list[float] | list,
+        query_vector: np.ndarray | list[float],
         top: int = 5,
         filters: list[dict] | None = None,
+        cache_key: tuple | None = None,
+        fuzzy: bool = False,
     ):
-        filter_clause_where, filter_clause_and = self.build_filter_clause(filters)
-
-        vector_query = f"""
-            SELECT id, RANK () OVER (ORDER BY embedding <=> :embedding) AS rank
-                FROM kefi_events
-                {filter_clause_where}
-                ORDER BY embedding <=> :embedding
-                LIMIT 20
-            """
-
-        fulltext_query = f"""
-            SELECT id, RANK () OVER (ORDER BY ts_rank_cd(to_tsvector('english', description), query) DESC)
-                FROM kefi_events, plainto_tsquery('english', :query) query
-                WHERE to_tsvector('english', description) @@ query {filter_clause_and}
-                ORDER BY ts_rank_cd(to_tsvector('english', description), query) DESC
-                LIMIT 20
-            """
-
-        hybrid_query = f"""
-        WITH vector_search AS (
-            {vector_query}
-        ),
-        fulltext_search AS (
-            {fulltext_query}
-        )
-        SELECT
-            COALESCE(vector_search.id, fulltext_search.id) AS id,
-            COALESCE(1.0 / (:k + vector_search.rank), 0.0) +
-            COALESCE(1.0 / (:k + fulltext_search.rank), 0.0) AS score
-        FROM vector_search
-        FULL OUTER JOIN fulltext_search ON vector_search.id = fulltext_search.id
-        ORDER BY score DESC
-        LIMIT 20
         """
-
-        if query_text is not None and len(query_vector) > 0:
-            sql = text(hybrid_query).columns(id=Integer, score=Float)
-        elif len(query_vector) > 0:
-            sql = text(vector_query).columns(id=Integer, rank=Integer)
-        elif query_text is not None:
-            sql = text(fulltext_query).columns(id=Integer, rank=Integer)
-        else:
+        Rank events for a query. With fuzzy, the query text is also matched by trigram similarity, so misspelled
+        names and categories are still found. With cache_key, the ranked ids are stored in the result cache under it.
+        """
+        mode = search_mode(query_text is not None, len(query_vector) > 0)
+        if mode is None:
             raise ValueError("Both query text and query vector are empty")
+        fuzzy = fuzzy and query_text is not None
+        filters = self.effective_filters(filters)
+        shape = filter_shape(filters)
+
+        try:
+            async with self.async_session_maker() as session, within_budget("sql"):
+                if (budget := stage_budget("sql")) is not None:
+                    # Postgres cancels the query itself when the budget runs out, so it stops using the server too
+                    await session.execute(
+                        text("SELECT set_config('statement_timeout', :timeout, true)"),
+                        {"timeout": str(max(1, int(budget * 1000)))},
+                    )
+                if fuzzy:
+                    await session.execute(
+                        text("SELECT set_config('pg_trgm.word_similarity_threshold', :threshold, true)"),
+                        {"threshold": str(self.fuzzy_threshold)},
+                    )
+                with stage("sql_ranking"):
+                    plan = SearchPlan(strategy="index")
+                    if self.search_planner is not None and mode != "text" and filters:
+                        plan = await self.search_planner.plan(session, filters)
+                        await self.search_planner.apply(session, plan)
+                    self.last_plan = plan
+                    sql = build_search_statement(mode, shape, plan.vector_strategy, plan.index_predicate, fuzzy)
+                    params = {"embedding": np.asarray(query_vector, dtype=np.float32), "query": query_text, "k": 60}
+                    results = (await session.execute(sql, params | filter_params(filters))).fetchall()
+                    fused = mode == "hybrid" or fuzzy
+                    self.last_scores = [score for _, score in results] if fused else None
+                    if cache_key is not None and self.result_cache is not None:
+                        ranked = RankedResults([id for id, _ in results], self.last_scores, plan, self.last_retrieval)
+                        self.result_cache.put(cache_key, ranked)
 
-        async with self.async_session_maker() as session:
-            results = (
-                await session.execute(
-                    sql,
-                    {"embedding": to_db(query_vector), "query": query_text, "k": 60},
-                )
-            ).fetchall()
-
-            # Convert results to Kefi_Event models
-            kefi_events = []
-            for id, _ in results[:top]:
-                kefi_event = await session.execute(select(Kefi_Event).where(Kefi_Event.id == id))
-                kefi_events.append(kefi_event.scalar())
-            return kefi_events
+                # Convert results to Kefi_Event models
+                return await self.hydrate([id for id, _ in results[:top]], session)
+        except DBAPIError as e:
+            if getattr(e.orig, "sqlstate", None) == QUERY_CANCELED:
+                raise TimeoutError("Search exceeded its SQL budget") from e
+            raise
 
     async def search_and_embed(
         self,
@@ -108,20 +322,133 @@ class PostgresSearcher:
         enable_vector_search: bool = False,
         enable_text_search: bool = False,
         filters: list[dict] | None = None,
+        enable_fuzzy_search: bool | None = None,
+        enable_adaptive_retrieval: bool | None = None,
     ) -> list[Kefi_Event]:
         """
         Search events by query text. Optionally converts the query text to a vector if enable_vector_search is True.
+        enable_fuzzy_search adds the typo tolerant trigram leg to text searches, which needs no embedding.
+        enable_adaptive_retrieval, with both searches enabled, ranks by full text search first and only embeds the
+        query when those results aren't decisive (see adaptive_retrieval).
+        Repeated searches are answered from the result cache, without embedding the query or ranking again.
         """
-        vector: list[float] = []
+        if enable_fuzzy_search is None:
+            enable_fuzzy_search = self.fuzzy_search
+        if enable_adaptive_retrieval is None:
+            enable_adaptive_retrieval = self.adaptive_retrieval
+        adaptive = enable_adaptive_retrieval and enable_vector_search and enable_text_search
+        self.last_retrieval = None
+        # Resolve the date filters now, so the key holds today's date and cached results roll over at midnight
+        filters = self.effective_filters(filters)
+        cache_key = None
+        if self.result_cache is not None and (mode := search_mode(enable_text_search, enable_vector_search)):
+            if adaptive:
+                mode = "adaptive"
+            if enable_fuzzy_search and enable_text_search:
+                mode = f"{mode}+fuzzy"
+            cache_key = self.result_cache.key(mode, normalize_query(query_text), canonical_filters(filters))
+            if (cached := self.result_cache.get(cache_key)) is not None:
+                self.last_scores, self.last_plan, self.last_retrieval = cached.scores, cached.plan, cached.retrieval
+                return await self.hydrate(cached.ids[:top])
+
+        if adaptive:
+            decision, hits = await self.decide_retrieval(query_text, filters)
+            self.last_retrieval = decision
+            if decision.embedding_skipped:
+                ids = [hit.id for hit in hits]
+                self.last_scores, self.last_plan = None, None
+                if cache_key is not None:
+                    self.result_cache.put(cache_key, RankedResults(ids, None, None, decision))
+                return await self.hydrate(ids[:top])
+
+        vector: np.ndarray | list = []
         if enable_vector_search:
-            vector = await compute_text_embedding(
-                query_text,
-                self.openai_embed_client,
-                self.embed_model,
-                self.embed_deployment,
-                self.embed_dimensions,
-            )
+            try:
+                with stage("embedding"):
+                    async with within_budget("embedding"):
+                        vector = await self.embed_query(query_text)
+            except TimeoutError:
+                # Out of time for the embedding, so rank by full text search alone
+                record_degradation("embedding", "text search")
+                enable_text_search = True
+                # Text only results aren't what this key asks for
+                cache_key = None
         if not enable_text_search:
             query_text = None
 
-        return await self.search(query_text, vector, top, filters)
+        try:
+            return await self.search(query_text, vector, top, filters, cache_key, enable_fuzzy_search)
+        except TimeoutError:
+            if len(vector) == 0 or query_text is None:
+                raise
+            record_degradation("sql", "text search")
+            return await self.search(query_text, [], top, filters, fuzzy=enable_fuzzy_search)
+
+    async def decide_retrieval(
+        self, query_text: str, filters: list[dict] | None
+    ) -> tuple[RetrievalDecision, list[LexicalHit]]:
+        """Rank by full text search alone, and decide whether that is enough to skip the vector leg."""
+        hits: list[LexicalHit] = []
+        try:
+            async with within_budget("sql"):
+                hits = await self.lexical_probe(query_text, filters)
+        except (TimeoutError, OSError, DBAPIError) as e:
+            logger.warning("Full text search for adaptive retrieval failed, running the hybrid search: %s", e)
+            decision = RetrievalDecision("hybrid", "text search failed")
+        else:
+            decision = decide(hits, self.adaptive_min_margin)
+        record_decision(decision)
+        return decision, hits
+
+    async def lexical_probe(self, query_text: str, filters: list[dict] | None) -> list[LexicalHit]:
+        sql = build_lexical_probe_statement(filter_shape(filters))
+        with stage("sql_text_probe"):
+            async with self.async_session_maker() as session:
+                rows = (await session.execute(sql, {"query": query_text} | filter_params(filters))).fetchall()
+        return [LexicalHit(row.id, row.score, row.name_match) for row in rows]
+
+    def effective_filters(self, filters: list[dict] | None) -> list[dict] | None:
+        if self.upcoming_only and not any(filter["column"] == "start_date_typed" for filter in filters or []):
+            # Without an explicit date, only search upcoming events, so Postgres prunes past partitions
+            upcoming = {"column": "start_date_typed", "comparison_operator": ">=", "value": str(datetime.date.today())}
+            filters = [*(filters or []), upcoming]
+        return filters
+
+    async def hydrate(self, ids: list[int], session=None) -> list[Kefi_Event]:
+        """Load events in the given order, from the row cache where possible and in one query otherwise."""
+        with stage("row_hydration"):
+            kefi_events = {}
+            if self.row_cache is not None:
+                for id in ids:
+                    if (kefi_event := self.row_cache.get(id)) is not None:
+                        kefi_events[id] = kefi_event
+            if missing := [id for id in ids if id not in kefi_events]:
+                epoch = self.row_cache.catalog.epoch if self.row_cache is not None else None
+                rows = await self.load_events(missing, session)
+                # Rows read while the catalog changed may already be stale, so only cache them if it didn't
+                cache_rows = self.row_cache is not None and self.row_cache.catalog.epoch == epoch
+                for kefi_event in rows:
+                    kefi_events[kefi_event.id] = kefi_event
+                    if cache_rows:
+                        self.row_cache.put(kefi_event)
+            # Events deleted since they were ranked are left out
+            return [kefi_events[id] for id in ids if id in kefi_events]
+
+    async def load_events(self, ids: list[int], session=None) -> list[Kefi_Event]:
+        statement = select(Kefi_Event).where(Kefi_Event.id.in_(ids))
+        if session is None:
+            async with self.async_session_maker() as session:
+                return list((await session.scalars(statement)).all())
+        return list((await session.scalars(statement)).all())
+
+    async def embed_query(self, query_text: str) -> np.ndarray:
+        if self.embedding_batcher is not None:
+            return await self.embedding_batcher.embed(query_text)
+        return await compute_text_embedding(
+            query_text,
+            self.openai_embed_client,
+            self.embed_model,
+            self.embed_deployment,
+            self.embed_dimensions,
+            self.embed_normalize,
+        )
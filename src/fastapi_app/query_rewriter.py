@@ -7,7 +7,31 @@ from openai.types.chat import (
 )
 
 
-def build_search_function() -> list[ChatCompletionToolParam]:
+class FrozenDict(dict):
+    """
+    A dict that can't be changed in place. Unlike MappingProxyType it is still a dict, so the OpenAI SDK sends it
+    as JSON unchanged.
+    """
+
+    def read_only(self, *args, **kwargs):
+        raise TypeError("The search function schema is shared by every request and can't be changed")
+
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = read_only
+
+    def __reduce__(self):
+        return (FrozenDict, (dict(self),))
+
+
+def freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict({key: freeze(item) for key, item in value.items()})
+    if isinstance(value, list):
+        return tuple(freeze(item) for item in value)
+    return value
+
+
+def search_function_schema() -> list[ChatCompletionToolParam]:
+    """The search_database tool schema, built from scratch."""
     return [
         {
             "type": "function",
@@ -27,7 +51,9 @@ def build_search_function() -> list[ChatCompletionToolParam]:
                             "properties": {
                                 "comparison_operator": {
                                     "type": "string",
-                                    "description": "Operator to compare the column value, either '>', '<', '>=', '<=', '='",  # noqa
+                                    "description": (
+                                        "Operator to compare the column value, either '>', '<', '>=', '<=', '='"
+                                    ),
                                 },
                                 "value": {
                                     "type": "number",
@@ -51,12 +77,17 @@ def build_search_function() -> list[ChatCompletionToolParam]:
                         },
                         "date_filter": {
                             "type": "object",
-                            "description": "Filter search results based on the start date of the events. Handles both specific dates and relative date references.",
+                            "description": (
+                                "Filter search results based on the start date of the events. "
+                                "Handles both specific dates and relative date references."
+                            ),
                             "properties": {
                                 "type": {
                                     "type": "string",
                                     "enum": ["specific", "relative"],
-                                    "description": "Indicates whether the date is a specific date or a relative reference.",
+                                    "description": (
+                                        "Indicates whether the date is a specific date or a relative reference."
+                                    ),
                                 },
                                 "specific_date": {
                                     "type": "object",
@@ -78,7 +109,10 @@ def build_search_function() -> list[ChatCompletionToolParam]:
                                     "properties": {
                                         "reference": {
                                             "type": "string",
-                                            "description": "Relative date reference, e.g., 'today', 'tomorrow', 'next week', 'next month'",
+                                            "description": (
+                                                "Relative date reference, e.g., 'today', 'tomorrow', 'next week', "
+                                                "'next month'"
+                                            ),
                                         },
                                         "range": {
                                             "type": "string",
@@ -114,6 +148,15 @@ def build_search_function() -> list[ChatCompletionToolParam]:
     ]
 
 
+# Built once at import: the schema is identical on every request, which also keeps the prompt prefix stable for
+# provider-side prompt caching. Frozen, so a caller can't change it for every later request.
+SEARCH_FUNCTION: tuple[ChatCompletionToolParam, ...] = freeze(search_function_schema())
+
+
+def build_search_function() -> tuple[ChatCompletionToolParam, ...]:
+    return SEARCH_FUNCTION
+
+
 def extract_search_arguments(original_user_query: str, chat_completion: ChatCompletion):
     response_message = chat_completion.choices[0].message
     search_query = None
@@ -202,7 +245,7 @@ def parse_date_filter(date_filter):
                 "column": "start_date_typed",
                 "comparison_operator": ">",
                 "value": date_value.isoformat(),
-            }   
+            }
         elif relative_date["range"] == "between":
             if "duration" not in relative_date:
                 raise ValueError("Duration is required for 'between' range")
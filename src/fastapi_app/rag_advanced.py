@@ -11,6 +11,9 @@ from openai.types.chat import (
 from openai_messages_token_helper import build_messages, get_token_limit
 
 from .api_models import ThoughtStep
+from .deadlines import record_degradation, sources_only_message, within_budget
+from .metrics import current_stage_timings, record_token_usage, stage
+from .model_router import ModelRouter, RouteDecision
 from .postgres_searcher import PostgresSearcher
 from .query_rewriter import build_search_function, extract_search_arguments
 
@@ -23,12 +26,18 @@ class AdvancedRAGChat:
         openai_chat_client: AsyncOpenAI,
         chat_model: str,
         chat_deployment: str | None,  # Not needed for non-Azure OpenAI
+        model_router: ModelRouter | None = None,
     ):
         self.searcher = searcher
         self.openai_chat_client = openai_chat_client
         self.chat_model = chat_model
         self.chat_deployment = chat_deployment
+        self.model_router = model_router
         self.chat_token_limit = get_token_limit(chat_model, default_to_minimum=True)
+        if model_router is not None:
+            # Prompts have to fit whichever model the router picks
+            small_token_limit = get_token_limit(model_router.small.model, default_to_minimum=True)
+            self.chat_token_limit = min(self.chat_token_limit, small_token_limit)
         current_dir = pathlib.Path(__file__).parent
         self.query_prompt_template = open(current_dir / "prompts/query.txt").read()
         self.answer_prompt_template = open(current_dir / "prompts/answer.txt").read()
@@ -36,8 +45,13 @@ class AdvancedRAGChat:
     async def run(
         self, messages: list[dict], overrides: dict[str, Any] = {}
     ) -> dict[str, Any] | AsyncGenerator[dict[str, Any], None]:
-        text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
-        vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
+        retrieval_mode = overrides.get("retrieval_mode")
+        text_search = retrieval_mode in ["text", "hybrid", "adaptive", None]
+        vector_search = retrieval_mode in ["vectors", "hybrid", "adaptive", None]
+        # Full text search first, embedding only when needed: always for "adaptive", per the searcher when unset
+        adaptive_retrieval = True if retrieval_mode == "adaptive" else None if retrieval_mode is None else False
+        # Typo tolerant trigram matching, even in retrieval_mode="text" (None uses the searcher's default)
+        fuzzy_search = overrides.get("fuzzy_search")
         top = overrides.get("top", 3)
 
         original_user_query = messages[-1]["content"]
@@ -45,27 +59,53 @@ class AdvancedRAGChat:
 
         # Generate an optimized keyword search query based on the chat history and the last question
         query_response_token_limit = 500
-        query_messages = build_messages(
-            model=self.chat_model,
-            system_prompt=self.query_prompt_template,
-            new_user_content=original_user_query,
-            past_messages=past_messages,
-            max_tokens=self.chat_token_limit - query_response_token_limit,  # TODO: count functions
-            fallback_to_default=True,
-        )
+        with stage("query_build_messages"):
+            query_messages = build_messages(
+                model=self.chat_model,
+                system_prompt=self.query_prompt_template,
+                new_user_content=original_user_query,
+                past_messages=past_messages,
+                max_tokens=self.chat_token_limit - query_response_token_limit,  # TODO: count functions
+                fallback_to_default=True,
+            )
 
-        chat_completion: ChatCompletion = await self.openai_chat_client.chat.completions.create(
-            messages=query_messages,  # type: ignore
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chat_deployment if self.chat_deployment else self.chat_model,
-            temperature=0.0,  # Minimize creativity for search query generation
-            max_tokens=query_response_token_limit,  # Setting too low risks malformed JSON, too high risks performance
-            n=1,
-            tools=build_search_function(),
-            tool_choice="auto",
-        )
+        query_routing: RouteDecision | None = None
+        query_model = self.chat_model
+        query_args = {
+            "messages": query_messages,
+            "temperature": 0.0,  # Minimize creativity for search query generation
+            # Setting too low risks malformed JSON, too high risks performance
+            "max_tokens": query_response_token_limit,
+            "n": 1,
+            "tools": build_search_function(),
+            "tool_choice": "auto",
+        }
+        try:
+            with stage("query_rewrite"):
+                async with within_budget("query_rewrite"):
+                    if self.model_router is None:
+                        chat_completion: ChatCompletion = await self.openai_chat_client.chat.completions.create(
+                            # Azure OpenAI takes the deployment name as the model name
+                            model=self.chat_deployment if self.chat_deployment else self.chat_model,
+                            **query_args,
+                        )
+                    else:
+                        query_routing = self.model_router.choose_query_rewrite(original_user_query, past_messages)
 
-        query_text, filters = extract_search_arguments(original_user_query, chat_completion)
+                        def validate(completion):
+                            return self.model_router.validate_query_rewrite(completion, original_user_query)
+
+                        chat_completion, routed_model = await self.model_router.complete(
+                            query_routing, validate, **query_args
+                        )
+                        query_model = routed_model.model
+        except TimeoutError:
+            # Out of time for the rewrite, so search with the user's question as it was asked
+            record_degradation("query_rewrite", "original query")
+            query_text, filters = original_user_query, []
+        else:
+            record_token_usage("query_rewrite", query_model, chat_completion.usage)
+            query_text, filters = extract_search_arguments(original_user_query, chat_completion)
 
         # Retrieve relevant events from the database with the GPT optimized query
         results = await self.searcher.search_and_embed(
@@ -74,45 +114,85 @@ class AdvancedRAGChat:
             enable_vector_search=vector_search,
             enable_text_search=text_search,
             filters=filters,
+            enable_fuzzy_search=fuzzy_search,
+            enable_adaptive_retrieval=adaptive_retrieval,
         )
+        retrieval = self.searcher.last_retrieval
 
         sources_content = [f"[{(kefi_event.id)}]:{kefi_event.to_str_for_rag()}\n\n" for kefi_event in results]
         content = "\n".join(sources_content)
 
         # Generate a contextual and content specific answer using the search results and chat history
         response_token_limit = 1024
-        messages = build_messages(
-            model=self.chat_model,
-            system_prompt=overrides.get("prompt_template") or self.answer_prompt_template,
-            new_user_content=original_user_query + "\n\nSources:\n" + content,
-            past_messages=past_messages,
-            max_tokens=self.chat_token_limit - response_token_limit,
-            fallback_to_default=True,
-        )
+        with stage("build_messages"):
+            messages = build_messages(
+                model=self.chat_model,
+                system_prompt=overrides.get("prompt_template") or self.answer_prompt_template,
+                new_user_content=original_user_query + "\n\nSources:\n" + content,
+                past_messages=past_messages,
+                max_tokens=self.chat_token_limit - response_token_limit,
+                fallback_to_default=True,
+            )
+
+        answer_routing: RouteDecision | None = None
+        answer_model = self.chat_model
+        answer_args = {
+            "messages": messages,
+            "temperature": overrides.get("temperature", 0.3),
+            "max_tokens": response_token_limit,
+            "n": 1,
+            "stream": False,
+        }
+        try:
+            with stage("answer"):
+                async with within_budget("answer"):
+                    if self.model_router is None:
+                        chat_completion_response = await self.openai_chat_client.chat.completions.create(
+                            # Azure OpenAI takes the deployment name as the model name
+                            model=self.chat_deployment if self.chat_deployment else self.chat_model,
+                            **answer_args,
+                        )
+                    else:
+                        answer_routing = self.model_router.choose_answer(
+                            original_user_query, past_messages, self.searcher.last_scores
+                        )
+                        source_ids = {kefi_event.id for kefi_event in results}
+                        chat_completion_response, routed_model = await self.model_router.complete(
+                            answer_routing,
+                            lambda completion: self.model_router.validate_answer(completion, source_ids),
+                            **answer_args,
+                        )
+                        answer_model = routed_model.model
+        except TimeoutError:
+            record_degradation("answer", "sources only")
+            chat_completion_response = None
+        if chat_completion_response is not None:
+            record_token_usage("answer", answer_model, chat_completion_response.usage)
+
+        with stage("serialization"):
+            if chat_completion_response is not None:
+                answer_message = chat_completion_response.model_dump()["choices"][0]["message"]
+            else:
+                answer_message = sources_only_message(results)
+            result_dicts = [result.to_dict() for result in results]
+            data_points = {result["id"]: result for result in result_dicts}
+            query_prompt_messages = [str(message) for message in query_messages]
+            answer_messages = [str(message) for message in messages]
+
+        def model_props(model: str, routing: RouteDecision | None) -> dict:
+            props = {"model": model, "deployment": self.chat_deployment} if self.chat_deployment else {"model": model}
+            return props | ({"routing": routing.to_dict()} if routing else {})
 
-        chat_completion_response = await self.openai_chat_client.chat.completions.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chat_deployment if self.chat_deployment else self.chat_model,
-            messages=messages,
-            temperature=overrides.get("temperature", 0.3),
-            max_tokens=response_token_limit,
-            n=1,
-            stream=False,
-        )
-        first_choice = chat_completion_response.model_dump()["choices"][0]
         return {
-            "message": first_choice["message"],
+            "message": answer_message,
             "context": {
-                "data_points": {kefi_event.id: kefi_event.to_dict() for kefi_event in results},
+                "data_points": data_points,
                 "thoughts": [
                     ThoughtStep(
                         title="Prompt to generate search arguments",
-                        description=[str(message) for message in query_messages],
-                        props=(
-                            {"model": self.chat_model, "deployment": self.chat_deployment}
-                            if self.chat_deployment
-                            else {"model": self.chat_model}
-                        ),
+                        description=query_prompt_messages,
+                        props=model_props(query_model, query_routing)
+                        | {"timings_ms": current_stage_timings("query_build_messages", "query_rewrite")},
                     ),
                     ThoughtStep(
                         title="Search using generated search arguments",
@@ -121,21 +201,22 @@ class AdvancedRAGChat:
                             "top": top,
                             "vector_search": vector_search,
                             "text_search": text_search,
+                            "retrieval": retrieval.to_dict() if retrieval else None,
                             "filters": filters,
+                            "search_plan": self.searcher.last_plan.to_dict() if self.searcher.last_plan else None,
+                            "timings_ms": current_stage_timings("sql_text_probe", "embedding", "sql_ranking"),
                         },
                     ),
                     ThoughtStep(
                         title="Search results",
-                        description=[result.to_dict() for result in results],
+                        description=result_dicts,
+                        props={"timings_ms": current_stage_timings("row_hydration", "serialization")},
                     ),
                     ThoughtStep(
                         title="Prompt to generate answer",
-                        description=[str(message) for message in messages],
-                        props=(
-                            {"model": self.chat_model, "deployment": self.chat_deployment}
-                            if self.chat_deployment
-                            else {"model": self.chat_model}
-                        ),
+                        description=answer_messages,
+                        props=model_props(answer_model, answer_routing)
+                        | {"timings_ms": current_stage_timings("build_messages", "answer")},
                     ),
                 ],
             },
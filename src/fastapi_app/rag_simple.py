@@ -8,6 +8,9 @@ from openai import AsyncOpenAI
 from openai_messages_token_helper import build_messages, get_token_limit
 
 from .api_models import ThoughtStep
+from .deadlines import record_degradation, sources_only_message, within_budget
+from .metrics import current_stage_timings, record_token_usage, stage
+from .model_router import ModelRouter, RouteDecision
 from .postgres_searcher import PostgresSearcher
 
 
@@ -19,20 +22,31 @@ class SimpleRAGChat:
         openai_chat_client: AsyncOpenAI,
         chat_model: str,
         chat_deployment: str | None,  # Not needed for non-Azure OpenAI
+        model_router: ModelRouter | None = None,
     ):
         self.searcher = searcher
         self.openai_chat_client = openai_chat_client
         self.chat_model = chat_model
         self.chat_deployment = chat_deployment
+        self.model_router = model_router
         self.chat_token_limit = get_token_limit(chat_model, default_to_minimum=True)
+        if model_router is not None:
+            # Prompts have to fit whichever model the router picks
+            small_token_limit = get_token_limit(model_router.small.model, default_to_minimum=True)
+            self.chat_token_limit = min(self.chat_token_limit, small_token_limit)
         current_dir = pathlib.Path(__file__).parent
         self.answer_prompt_template = open(current_dir / "prompts/answer.txt").read()
 
     async def run(
         self, messages: list[dict], overrides: dict[str, Any] = {}
     ) -> dict[str, Any] | AsyncGenerator[dict[str, Any], None]:
-        text_search = overrides.get("retrieval_mode") in ["text", "hybrid", None]
-        vector_search = overrides.get("retrieval_mode") in ["vectors", "hybrid", None]
+        retrieval_mode = overrides.get("retrieval_mode")
+        text_search = retrieval_mode in ["text", "hybrid", "adaptive", None]
+        vector_search = retrieval_mode in ["vectors", "hybrid", "adaptive", None]
+        # Full text search first, embedding only when needed: always for "adaptive", per the searcher when unset
+        adaptive_retrieval = True if retrieval_mode == "adaptive" else None if retrieval_mode is None else False
+        # Typo tolerant trigram matching, even in retrieval_mode="text" (None uses the searcher's default)
+        fuzzy_search = overrides.get("fuzzy_search")
         top = overrides.get("top", 3)
 
         original_user_query = messages[-1]["content"]
@@ -40,37 +54,78 @@ class SimpleRAGChat:
 
         # Retrieve relevant events from the database
         results = await self.searcher.search_and_embed(
-            original_user_query, top=top, enable_vector_search=vector_search, enable_text_search=text_search
+            original_user_query,
+            top=top,
+            enable_vector_search=vector_search,
+            enable_text_search=text_search,
+            enable_fuzzy_search=fuzzy_search,
+            enable_adaptive_retrieval=adaptive_retrieval,
         )
+        retrieval = self.searcher.last_retrieval
 
         sources_content = [f"[{(kefi_event.id)}]:{kefi_event.to_str_for_rag()}\n\n" for kefi_event in results]
         content = "\n".join(sources_content)
 
         # Generate a contextual and content specific answer using the search results and chat history
         response_token_limit = 1024
-        messages = build_messages(
-            model=self.chat_model,
-            system_prompt=overrides.get("prompt_template") or self.answer_prompt_template,
-            new_user_content=original_user_query + "\n\nSources:\n" + content,
-            past_messages=past_messages,
-            max_tokens=self.chat_token_limit - response_token_limit,
-            fallback_to_default=True,
-        )
+        with stage("build_messages"):
+            messages = build_messages(
+                model=self.chat_model,
+                system_prompt=overrides.get("prompt_template") or self.answer_prompt_template,
+                new_user_content=original_user_query + "\n\nSources:\n" + content,
+                past_messages=past_messages,
+                max_tokens=self.chat_token_limit - response_token_limit,
+                fallback_to_default=True,
+            )
+
+        answer_routing: RouteDecision | None = None
+        answer_model = self.chat_model
+        answer_args = {
+            "messages": messages,
+            "temperature": overrides.get("temperature", 0.3),
+            "max_tokens": response_token_limit,
+            "n": 1,
+            "stream": False,
+        }
+        try:
+            with stage("answer"):
+                async with within_budget("answer"):
+                    if self.model_router is None:
+                        chat_completion_response = await self.openai_chat_client.chat.completions.create(
+                            # Azure OpenAI takes the deployment name as the model name
+                            model=self.chat_deployment if self.chat_deployment else self.chat_model,
+                            **answer_args,
+                        )
+                    else:
+                        answer_routing = self.model_router.choose_answer(
+                            original_user_query, past_messages, self.searcher.last_scores
+                        )
+                        source_ids = {kefi_event.id for kefi_event in results}
+                        chat_completion_response, routed_model = await self.model_router.complete(
+                            answer_routing,
+                            lambda completion: self.model_router.validate_answer(completion, source_ids),
+                            **answer_args,
+                        )
+                        answer_model = routed_model.model
+        except TimeoutError:
+            record_degradation("answer", "sources only")
+            chat_completion_response = None
+        if chat_completion_response is not None:
+            record_token_usage("answer", answer_model, chat_completion_response.usage)
+
+        with stage("serialization"):
+            if chat_completion_response is not None:
+                answer_message = chat_completion_response.model_dump()["choices"][0]["message"]
+            else:
+                answer_message = sources_only_message(results)
+            result_dicts = [result.to_dict() for result in results]
+            data_points = {result["id"]: result for result in result_dicts}
+            answer_messages = [str(message) for message in messages]
 
-        chat_completion_response = await self.openai_chat_client.chat.completions.create(
-            # Azure OpenAI takes the deployment name as the model name
-            model=self.chat_deployment if self.chat_deployment else self.chat_model,
-            messages=messages,
-            temperature=overrides.get("temperature", 0.3),
-            max_tokens=response_token_limit,
-            n=1,
-            stream=False,
-        )
-        first_choice = chat_completion_response.model_dump()["choices"][0]
         return {
-            "message": first_choice["message"],
+            "message": answer_message,
             "context": {
-                "data_points": {kefi_event.id: kefi_event.to_dict() for kefi_event in results},
+                "data_points": data_points,
                 "thoughts": [
                     ThoughtStep(
                         title="Search query for database",
@@ -79,20 +134,25 @@ class SimpleRAGChat:
                             "top": top,
                             "vector_search": vector_search,
                             "text_search": text_search,
+                            "retrieval": retrieval.to_dict() if retrieval else None,
+                            "timings_ms": current_stage_timings("sql_text_probe", "embedding", "sql_ranking"),
                         },
                     ),
                     ThoughtStep(
                         title="Search results",
-                        description=[result.to_dict() for result in results],
+                        description=result_dicts,
+                        props={"timings_ms": current_stage_timings("row_hydration", "serialization")},
                     ),
                     ThoughtStep(
                         title="Prompt to generate answer",
-                        description=[str(message) for message in messages],
+                        description=answer_messages,
                         props=(
-                            {"model": self.chat_model, "deployment": self.chat_deployment}
+                            {"model": answer_model, "deployment": self.chat_deployment}
                             if self.chat_deployment
-                            else {"model": self.chat_model}
-                        ),
+                            else {"model": answer_model}
+                        )
+                        | ({"routing": answer_routing.to_dict()} if answer_routing else {})
+                        | {"timings_ms": current_stage_timings("build_messages", "answer")},
                     ),
                 ],
             },
@@ -0,0 +1,121 @@
+"""
+Per-worker caches that let repeated searches skip the embedding call, the ranking SQL and row hydration.
+
+SearchResultCache keeps the ranked ids of recent searches, not the events themselves, and EventRowCache keeps the
+event rows they are hydrated from. Both are bounded by an approximate size in bytes, evicting the least recently
+used entries, and both are kept current by CatalogChanges: any change to an event can reorder the results of any
+query, so result keys include the catalog epoch and the whole cache is dropped when it moves, while rows are evicted
+by id.
+"""
+
+import logging
+from collections import OrderedDict
+from collections.abc import Hashable
+from dataclasses import dataclass
+from typing import Any
+
+from .adaptive_retrieval import RetrievalDecision
+from .catalog_changes import CatalogChanges
+from .metrics import record_cache_lookup
+from .postgres_models import Kefi_Event
+from .search_planner import SearchPlan
+
+logger = logging.getLogger("ragapp")
+
+# Rough per-entry cost of the Python objects around the payload
+ENTRY_OVERHEAD_BYTES = 200
+
+
+class LRUCache:
+    """An LRU mapping whose entries are evicted once their total size passes max_bytes."""
+
+    def __init__(self, name: str, max_bytes: int):
+        self.name = name
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[Hashable, tuple[Any, int]] = OrderedDict()
+        self.size = 0
+
+    def get(self, key: Hashable) -> Any | None:
+        entry = self.entries.get(key)
+        record_cache_lookup(self.name, entry is not None)
+        if entry is None:
+            return None
+        self.entries.move_to_end(key)
+        return entry[0]
+
+    def put(self, key: Hashable, value: Any, size: int):
+        self.pop(key)
+        if size > self.max_bytes:
+            return
+        self.entries[key] = (value, size)
+        self.size += size
+        while self.size > self.max_bytes:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+
+    def pop(self, key: Hashable):
+        if (entry := self.entries.pop(key, None)) is not None:
+            self.size -= entry[1]
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+
+@dataclass
+class RankedResults:
+    ids: list[int]
+    scores: list[float] | None  # RRF scores of hybrid searches
+    plan: SearchPlan | None
+    retrieval: RetrievalDecision | None = None  # For adaptive searches
+
+
+class SearchResultCache:
+    def __init__(self, catalog: CatalogChanges, max_bytes: int):
+        self.catalog = catalog
+        self.entries = LRUCache("search_results", max_bytes)
+        catalog.register(self.evict)
+
+    def key(self, *parts: Hashable) -> tuple:
+        """
+        The key for a search. Taken before searching, so results ranked while the catalog changed are stored
+        under the old epoch and never served.
+        """
+        return (self.catalog.epoch, *parts)
+
+    def get(self, key: Hashable) -> RankedResults | None:
+        return self.entries.get(key)
+
+    def put(self, key: Hashable, results: RankedResults):
+        size = ENTRY_OVERHEAD_BYTES + 64 * len(results.ids) + sum(len(str(part)) for part in key)
+        self.entries.put(key, results, size)
+
+    def evict(self, ids: set[int] | None):
+        # Entries of the old epoch can no longer be hit, so free their memory now rather than waiting for the LRU
+        self.entries.clear()
+
+
+class EventRowCache:
+    def __init__(self, catalog: CatalogChanges, max_bytes: int):
+        self.catalog = catalog
+        self.entries = LRUCache("event_rows", max_bytes)
+        catalog.register(self.evict)
+
+    def get(self, id: int) -> Kefi_Event | None:
+        return self.entries.get(id)
+
+    def put(self, kefi_event: Kefi_Event):
+        size = ENTRY_OVERHEAD_BYTES + getattr(kefi_event.embedding, "nbytes", 0)
+        size += sum(len(value) for value in (kefi_event.name, kefi_event.description, kefi_event.category) if value)
+        self.entries.put(kefi_event.id, kefi_event, size)
+
+    def evict(self, ids: set[int] | None):
+        if ids is None:
+            self.entries.clear()
+            return
+        for id in ids:
+            self.entries.pop(id)
+
+
+def normalize_query(query_text: str) -> str:
+    return " ".join(query_text.casefold().split())
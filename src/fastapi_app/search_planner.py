@@ -0,0 +1,274 @@
+import bisect
+import datetime
+import logging
+import math
+import time
+from dataclasses import dataclass, field
+
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncSession
+
+logger = logging.getLogger("ragapp")
+
+# How to turn the text form of pg_stats arrays back into comparable values, per filterable column
+STATS_CONVERTERS = {
+    "price": float,
+    "start_date_typed": datetime.date.fromisoformat,
+    "category": str,
+}
+
+# Partial HNSW indexes in postgres_models, by the filter they serve and the predicate they were built with.
+# The predicate is added to the statement as a literal, since Postgres can't match a bind parameter to it.
+PARTIAL_INDEXES = {
+    ("price", "=", 0.0): "price = 0",
+}
+
+
+@dataclass
+class ColumnStats:
+    null_frac: float
+    n_distinct: float
+    most_common_vals: list
+    most_common_freqs: list[float]
+    histogram_bounds: list
+
+
+@dataclass
+class SearchPlan:
+    """How the vector leg of a filtered search should run. Reported in the search ThoughtStep."""
+
+    strategy: str  # "index", "iterative_index", "partial_index" or "exact"
+    selectivity: float = 1.0
+    estimated_rows: int | None = None
+    settings: dict[str, str] = field(default_factory=dict)
+    index_predicate: str = ""
+
+    @property
+    def vector_strategy(self) -> str:
+        return "exact" if self.strategy == "exact" else "index"
+
+    def to_dict(self):
+        return {
+            "strategy": self.strategy,
+            "selectivity": round(self.selectivity, 5),
+            "estimated_rows": self.estimated_rows,
+            "settings": self.settings,
+        }
+
+
+def parse_pg_array(value: str | None, convert) -> list:
+    if not value:
+        return []
+    items, item, quoted, escaped = [], "", False, False
+    for char in value[1:-1]:
+        if escaped:
+            item += char
+            escaped = False
+        elif char == "\\":
+            escaped = True
+        elif char == '"':
+            quoted = not quoted
+        elif char == "," and not quoted:
+            items.append(item)
+            item = ""
+        else:
+            item += char
+    items.append(item)
+    return [convert(item) for item in items]
+
+
+def fraction_below(value, bounds: list) -> float:
+    """Fraction of the histogram below value, interpolating linearly within a bucket as Postgres does."""
+    if not bounds:
+        return 0.5
+    if value <= bounds[0]:
+        return 0.0
+    if value >= bounds[-1]:
+        return 1.0
+    bucket = bisect.bisect_right(bounds, value) - 1
+    low, high = bounds[bucket], bounds[bucket + 1]
+    try:
+        within = (value - low) / (high - low)
+        if isinstance(within, datetime.timedelta):
+            within = within.total_seconds()
+    except (TypeError, ZeroDivisionError):
+        within = 0.5
+    return (bucket + float(within)) / (len(bounds) - 1)
+
+
+def estimate_selectivity(stats: ColumnStats, operator: str, value) -> float:
+    """Estimate the fraction of rows matching `column <operator> value`, from the column's pg_stats row."""
+    mcv_total = sum(stats.most_common_freqs)
+    other_frac = max(0.0, 1.0 - stats.null_frac - mcv_total)
+
+    if operator in ("=", "!="):
+        if value in stats.most_common_vals:
+            equal = stats.most_common_freqs[stats.most_common_vals.index(value)]
+        else:
+            distinct = stats.n_distinct if stats.n_distinct > 0 else 1000
+            equal = other_frac / max(1.0, distinct - len(stats.most_common_vals))
+        return equal if operator == "=" else max(0.0, 1.0 - stats.null_frac - equal)
+
+    if operator == "BETWEEN":
+        low, high = value
+        return max(0.0, estimate_selectivity(stats, "<=", high) - estimate_selectivity(stats, "<", low))
+
+    if operator in ("<", "<="):
+        matches = (lambda v: v < value) if operator == "<" else (lambda v: v <= value)
+        below = fraction_below(value, stats.histogram_bounds)
+    else:
+        matches = (lambda v: v > value) if operator == ">" else (lambda v: v >= value)
+        below = 1.0 - fraction_below(value, stats.histogram_bounds)
+    mcv_part = sum(freq for val, freq in zip(stats.most_common_vals, stats.most_common_freqs) if matches(val))
+    return mcv_part + other_frac * below
+
+
+class FilteredSearchPlanner:
+    """
+    Chooses how to run the vector leg of a filtered search, from the table statistics that Postgres keeps.
+
+    An HNSW scan returns its ef_search nearest candidates and only then applies the WHERE clause, so a
+    selective filter can leave far fewer rows than requested. The planner estimates the filter's selectivity,
+    then either:
+    - scans the index with ef_search scaled up by 1/selectivity ("index"),
+    - uses pgvector's iterative index scan (0.8+), which keeps scanning until enough rows pass ("iterative_index"),
+    - scans a partial HNSW index whose predicate is one of the filters ("partial_index"),
+    - or, when few rows match, ranks the B-tree-prefiltered rows exactly, skipping the HNSW index ("exact").
+    Statistics are cached per worker for stats_ttl seconds.
+    """
+
+    def __init__(
+        self,
+        *,
+        candidates: int = 20,
+        exact_scan_max_rows: int = 5000,
+        max_ef_search: int = 1000,
+        stats_ttl: float = 600,
+    ):
+        self.candidates = candidates
+        self.exact_scan_max_rows = exact_scan_max_rows
+        self.max_ef_search = max_ef_search
+        self.stats_ttl = stats_ttl
+        self.column_stats: dict[str, tuple[float, ColumnStats | None]] = {}
+        self.table_rows: tuple[float, int] | None = None
+        self.supports_iterative_scan: bool | None = None
+
+    async def get_table_rows(self, session: AsyncSession) -> int:
+        if self.table_rows is None or time.monotonic() - self.table_rows[0] > self.stats_ttl:
+            # A partitioned table has no rows of its own, so sum the estimates of the table and its partitions
+            rows = (
+                await session.execute(
+                    text(
+                        """
+                        SELECT sum(greatest(reltuples, 0))::bigint FROM pg_class
+                        WHERE oid = 'kefi_events'::regclass
+                            OR oid IN (SELECT inhrelid FROM pg_inherits WHERE inhparent = 'kefi_events'::regclass)
+                        """
+                    )
+                )
+            ).scalar()
+            self.table_rows = (time.monotonic(), max(0, rows or 0))
+        return self.table_rows[1]
+
+    async def get_column_stats(self, session: AsyncSession, column: str) -> ColumnStats | None:
+        cached = self.column_stats.get(column)
+        if cached is not None and time.monotonic() - cached[0] <= self.stats_ttl:
+            return cached[1]
+        # pg_stats has a row per table for its own rows and, on a parent, one for the rows of the whole hierarchy.
+        # A partitioned table only has the latter, a plain table only the former.
+        row = (
+            await session.execute(
+                text(
+                    """
+                    SELECT s.null_frac, s.n_distinct, s.most_common_vals::text, s.most_common_freqs,
+                        s.histogram_bounds::text
+                    FROM pg_stats s
+                    JOIN pg_class c ON c.relname = s.tablename
+                    JOIN pg_namespace n ON n.oid = c.relnamespace AND n.nspname = s.schemaname
+                    WHERE c.oid = 'kefi_events'::regclass AND s.attname = :column AND s.inherited = (c.relkind = 'p')
+                    """
+                ),
+                {"column": column},
+            )
+        ).first()
+        stats = None
+        if row is not None:
+            convert = STATS_CONVERTERS[column]
+            stats = ColumnStats(
+                null_frac=row.null_frac,
+                n_distinct=row.n_distinct,
+                most_common_vals=parse_pg_array(row.most_common_vals, convert),
+                most_common_freqs=list(row.most_common_freqs or []),
+                histogram_bounds=parse_pg_array(row.histogram_bounds, convert),
+            )
+        self.column_stats[column] = (time.monotonic(), stats)
+        return stats
+
+    async def get_supports_iterative_scan(self, session: AsyncSession) -> bool:
+        if self.supports_iterative_scan is None:
+            version = (
+                await session.execute(text("SELECT extversion FROM pg_extension WHERE extname = 'vector'"))
+            ).scalar()
+            major_minor = tuple(int(part) for part in (version or "0.0").split(".")[:2])
+            self.supports_iterative_scan = major_minor >= (0, 8)
+        return self.supports_iterative_scan
+
+    async def plan(self, session: AsyncSession, filters: list[dict]) -> SearchPlan:
+        if not filters:
+            return SearchPlan(strategy="index")
+
+        selectivity = 1.0
+        # Selectivity of the filters that a matching partial index doesn't already apply
+        residual_selectivity = 1.0
+        index_predicate = ""
+        for filter in filters:
+            convert = STATS_CONVERTERS[filter["column"]]
+            operator = filter["comparison_operator"].upper()
+            value = filter["value"]
+            value = tuple(convert(v) for v in value) if operator == "BETWEEN" else convert(value)
+
+            stats = await self.get_column_stats(session, filter["column"])
+            # Without statistics (not analyzed yet), assume a moderately selective filter like Postgres does
+            filter_selectivity = 0.33 if stats is None else estimate_selectivity(stats, operator, value)
+            selectivity *= filter_selectivity
+            predicate = PARTIAL_INDEXES.get((filter["column"], operator, value))
+            if predicate and not index_predicate:
+                index_predicate = predicate
+            else:
+                residual_selectivity *= filter_selectivity
+        selectivity = min(1.0, max(selectivity, 1e-6))
+        residual_selectivity = min(1.0, max(residual_selectivity, 1e-6))
+
+        table_rows = await self.get_table_rows(session)
+        estimated_rows = math.ceil(table_rows * selectivity)
+        if estimated_rows <= self.exact_scan_max_rows:
+            return SearchPlan(strategy="exact", selectivity=selectivity, estimated_rows=estimated_rows)
+
+        ef_search = min(self.max_ef_search, max(40, math.ceil(self.candidates / residual_selectivity)))
+        if index_predicate:
+            return SearchPlan(
+                strategy="partial_index",
+                selectivity=selectivity,
+                estimated_rows=estimated_rows,
+                settings={"hnsw.ef_search": str(ef_search)},
+                index_predicate=index_predicate,
+            )
+        if await self.get_supports_iterative_scan(session):
+            return SearchPlan(
+                strategy="iterative_index",
+                selectivity=selectivity,
+                estimated_rows=estimated_rows,
+                settings={"hnsw.ef_search": str(ef_search), "hnsw.iterative_scan": "strict_order"},
+            )
+        return SearchPlan(
+            strategy="index",
+            selectivity=selectivity,
+            estimated_rows=estimated_rows,
+            settings={"hnsw.ef_search": str(ef_search)},
+        )
+
+    @staticmethod
+    async def apply(session: AsyncSession, plan: SearchPlan):
+        """Apply the plan's settings to the current transaction only."""
+        for name, value in plan.settings.items():
+            await session.execute(text("SELECT set_config(:name, :value, true)"), {"name": name, "value": value})
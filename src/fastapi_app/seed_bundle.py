@@ -0,0 +1,182 @@
+"""
+Seed bundles: a compact on-disk format for events with embeddings.
+
+A bundle is a directory with three files:
+
+* metadata.jsonl: one JSON object per event, without the embedding
+* embeddings.npy: a float32 matrix with one row per line of metadata.jsonl, in the same order
+* manifest.json: row count, dimensions and a SHA-256 checksum for the other two files
+
+The matrix is memory-mapped when loading, and its rows are streamed to Postgres with a binary COPY, so the
+embedding floats never become Python objects.
+
+Convert an existing seed file with:
+
+    python -m fastapi_app.seed_bundle seed_data_events.json seed_data_events
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+import shutil
+from collections.abc import Iterable, Iterator
+
+import numpy as np
+from sqlalchemy import text
+
+from fastapi_app.embeddings import decode_embedding, l2_normalize
+
+logger = logging.getLogger("ragapp")
+
+METADATA_FILE = "metadata.jsonl"
+EMBEDDINGS_FILE = "embeddings.npy"
+MANIFEST_FILE = "manifest.json"
+FORMAT_VERSION = 1
+
+
+class SeedBundleError(Exception):
+    pass
+
+
+def read_json_events(path: str) -> Iterator[dict]:
+    """Yield events from a seed_data_events.json array or a JSON Lines file, with decoded embeddings."""
+    with open(path, encoding="utf-8") as f:
+        if path.endswith(".jsonl"):
+            events = (json.loads(line) for line in f if line.strip())
+        else:
+            events = iter(json.load(f))
+        for event in events:
+            event["Embedding"] = decode_embedding(event["Embedding"])
+            yield event
+
+
+def sha256_file(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        while chunk := f.read(1024 * 1024):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def write_seed_bundle(bundle_dir: str, events: Iterable[dict], normalize: bool = False) -> dict:
+    """
+    Write events (dicts with an "Embedding" key) as a seed bundle, streaming them to disk.
+    With normalize=True, embeddings are scaled to unit length first.
+    """
+    os.makedirs(bundle_dir, exist_ok=True)
+    metadata_path = os.path.join(bundle_dir, METADATA_FILE)
+    embeddings_path = os.path.join(bundle_dir, EMBEDDINGS_FILE)
+    raw_path = embeddings_path + ".raw"
+
+    rows = 0
+    dimensions = None
+    with open(metadata_path, "w", encoding="utf-8") as metadata, open(raw_path, "wb") as raw:
+        for event in events:
+            embedding = np.asarray(event.pop("Embedding"), dtype="<f4")
+            if normalize:
+                embedding = l2_normalize(embedding).astype("<f4")
+            if dimensions is None:
+                dimensions = embedding.shape[0]
+            elif embedding.shape != (dimensions,):
+                raise SeedBundleError(f"Event {event.get('Id')} has {embedding.shape[0]} dimensions, not {dimensions}")
+            metadata.write(json.dumps(event, separators=(",", ":")) + "\n")
+            raw.write(embedding.tobytes())
+            rows += 1
+
+    # The row count is only known at the end, so write the .npy header and then append the raw matrix
+    with open(embeddings_path, "wb") as npy, open(raw_path, "rb") as raw:
+        header = {"descr": "<f4", "fortran_order": False, "shape": (rows, dimensions or 0)}
+        np.lib.format.write_array_header_1_0(npy, header)
+        shutil.copyfileobj(raw, npy, 1024 * 1024)
+    os.remove(raw_path)
+
+    manifest = {
+        "format_version": FORMAT_VERSION,
+        "rows": rows,
+        "dimensions": dimensions,
+        "dtype": "float32",
+        "files": {
+            name: {"sha256": sha256_file(os.path.join(bundle_dir, name)), "bytes": os.path.getsize(path)}
+            for name, path in ((METADATA_FILE, metadata_path), (EMBEDDINGS_FILE, embeddings_path))
+        },
+    }
+    with open(os.path.join(bundle_dir, MANIFEST_FILE), "w") as f:
+        json.dump(manifest, f, indent=2)
+    logger.info("Wrote %d events with %s dimensions to %s", rows, dimensions, bundle_dir)
+    return manifest
+
+
+def is_seed_bundle(path: str) -> bool:
+    return os.path.isfile(os.path.join(path, MANIFEST_FILE))
+
+
+def read_seed_bundle(bundle_dir: str, verify: bool = True) -> tuple[Iterator[dict], np.ndarray]:
+    """
+    Return an iterator over the event metadata and the memory-mapped embedding matrix.
+    With verify=True, the checksums in the manifest are checked first.
+    """
+    with open(os.path.join(bundle_dir, MANIFEST_FILE)) as f:
+        manifest = json.load(f)
+    if manifest["format_version"] != FORMAT_VERSION:
+        raise SeedBundleError(f"Unsupported seed bundle version {manifest['format_version']}")
+    if verify:
+        for name, expected in manifest["files"].items():
+            if sha256_file(os.path.join(bundle_dir, name)) != expected["sha256"]:
+                raise SeedBundleError(f"Checksum mismatch for {name} in {bundle_dir}")
+
+    embeddings = np.load(os.path.join(bundle_dir, EMBEDDINGS_FILE), mmap_mode="r")
+    if embeddings.shape != (manifest["rows"], manifest["dimensions"]):
+        raise SeedBundleError(f"Embedding matrix has shape {embeddings.shape}, expected {manifest['rows']} rows")
+
+    def metadata() -> Iterator[dict]:
+        with open(os.path.join(bundle_dir, METADATA_FILE), encoding="utf-8") as f:
+            for line in f:
+                yield json.loads(line)
+
+    return metadata(), embeddings
+
+
+async def copy_records(engine, table: str, columns: list[str], records: Iterable[tuple], on_conflict_skip: bool):
+    """
+    Stream records into a table with a binary COPY, sending vectors as raw float32 through the binary codec
+    that postgres_engine registers on every connection.
+    With on_conflict_skip=True, rows whose id already exists are skipped, so seeding can be re-run.
+    """
+    async with engine.connect() as conn:
+        raw_connection = await conn.get_raw_connection()
+        asyncpg_connection = raw_connection.driver_connection
+        async with asyncpg_connection.transaction():
+            if not on_conflict_skip:
+                await asyncpg_connection.copy_records_to_table(table, records=records, columns=columns)
+            else:
+                staging = f"{table}_staging"
+                await asyncpg_connection.execute(
+                    f"CREATE TEMP TABLE {staging} (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DROP"
+                )
+                await asyncpg_connection.copy_records_to_table(staging, records=records, columns=columns)
+                column_list = ", ".join(columns)
+                # Skip by id explicitly: a partitioned table's primary key also includes the partition key
+                await asyncpg_connection.execute(
+                    f"INSERT INTO {table} ({column_list}) SELECT {column_list} FROM {staging} "
+                    f"WHERE NOT EXISTS (SELECT 1 FROM {table} WHERE {table}.id = {staging}.id) "
+                    "ON CONFLICT DO NOTHING"
+                )
+        await conn.execute(text(f"ANALYZE {table}"))
+        await conn.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Convert a seed_data_events JSON or JSON Lines file to a seed bundle")
+    parser.add_argument("input", type=str, help="seed_data_events.json or .jsonl")
+    parser.add_argument("output", type=str, help="Bundle directory to write")
+    parser.add_argument("--normalize", action="store_true", help="Scale embeddings to unit length")
+    args = parser.parse_args()
+    write_seed_bundle(args.output, read_json_events(args.input), args.normalize)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    main()
@@ -5,6 +5,7 @@ import logging
 from dotenv import load_dotenv
 from sqlalchemy import text
 
+from fastapi_app.catalog_changes import install_change_notifications
 from fastapi_app.postgres_engine import create_postgres_engine_from_args, create_postgres_engine_from_env
 from fastapi_app.postgres_models import Base
 
@@ -13,10 +14,17 @@ logger = logging.getLogger("ragapp")
 
 async def create_db_schema(engine):
     async with engine.begin() as conn:
-        logger.info("Enabling the pgvector extension for Postgres...")
+        logger.info("Enabling the pgvector and pg_trgm extensions for Postgres...")
         await conn.execute(text("CREATE EXTENSION IF NOT EXISTS vector"))
+        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
         logger.info("Creating database tables and indexes...")
         await conn.run_sync(Base.metadata.create_all)
+        # create_all skips tables that already exist, so add any indexes that are newer than the table
+        for table in Base.metadata.sorted_tables:
+            for index in table.indexes:
+                await conn.run_sync(lambda sync_conn, index=index: index.create(sync_conn, checkfirst=True))
+        logger.info("Installing the kefi_events change notification triggers...")
+        await install_change_notifications(conn)
 
     await conn.close()
 
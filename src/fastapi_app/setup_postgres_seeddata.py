@@ -15,6 +15,7 @@ from fastapi_app.postgres_engine import (
     create_postgres_engine_from_env,
 )
 from fastapi_app.postgres_models import Item, Kefi_Event
+from fastapi_app.seed_bundle import copy_records, is_seed_bundle, read_json_events, read_seed_bundle
 
 logger = logging.getLogger("ragapp")
 
@@ -35,6 +36,32 @@ def string_to_date(date_string):
     raise ValueError(f"Unable to parse date string: {date_string}")
 
 
+def read_seed_events(current_dir):
+    """
+    Yield seed events from seed_data_events.jsonl if present (as written by scripts/generate_synthetic_data.py),
+    else from seed_data_events.json.
+    """
+    jsonl_path = os.path.join(current_dir, "seed_data_events.jsonl")
+    if os.path.exists(jsonl_path):
+        return read_json_events(jsonl_path)
+    return read_json_events(os.path.join(current_dir, "seed_data_events.json"))
+
+
+def seed_bundle_records(bundle_dir):
+    metadata, embeddings = read_seed_bundle(bundle_dir)
+    for row, miami_event in enumerate(metadata):
+        yield (
+            miami_event["Id"],
+            miami_event["Name"],
+            miami_event["Description"],
+            miami_event["Category"],
+            miami_event["Price"],
+            miami_event["Start Date"],
+            string_to_date(miami_event["Start Date"]),
+            embeddings[row],
+        )
+
+
 async def seed_data_items(engine):
     # Check if Item table exists
     async with engine.begin() as conn:
@@ -86,31 +113,41 @@ async def seed_data_events(engine):
             logger.error("kefi_events table does not exist. Please run the database setup script first.")
             return
 
+    current_dir = os.path.dirname(os.path.realpath(__file__))
+    bundle_dir = os.path.join(current_dir, "seed_data_events")
+    if is_seed_bundle(bundle_dir):
+        # Stream the memory-mapped embeddings straight to COPY
+        await copy_records(
+            engine,
+            Kefi_Event.__tablename__,
+            ["id", "name", "description", "category", "price", "start_date", "start_date_typed", "embedding"],
+            seed_bundle_records(bundle_dir),
+            on_conflict_skip=True,
+        )
+        logger.info("Kefi_Events table seeded successfully from %s.", bundle_dir)
+        return
+
     async with async_sessionmaker(engine, expire_on_commit=False)() as session:
         # Insert the events from the JSON file into the database
-        current_dir = os.path.dirname(os.path.realpath(__file__))
-        with open(os.path.join(current_dir, "seed_data_events.json"), encoding="utf-8") as f:
-            miami_events = json.load(f)
-
-            for miami_event in miami_events:
-                kefi_event = await session.execute(select(Kefi_Event).filter(Kefi_Event.id == miami_event["Id"]))
-                if kefi_event.scalars().first():
-                    continue
-                kefi_event = Kefi_Event(
-                    id=miami_event["Id"],
-                    name=miami_event["Name"],
-                    description=miami_event["Description"],
-                    category=miami_event["Category"],
-                    price=miami_event["Price"],
-                    start_date=miami_event["Start Date"],
-                    start_date_typed=string_to_date(miami_event["Start Date"]),
-                    embedding=miami_event["Embedding"],
-                )
-                session.add(kefi_event)
-            try:
-                await session.commit()
-            except sqlalchemy.exc.IntegrityError:
-                pass
+        for miami_event in read_seed_events(current_dir):
+            kefi_event = await session.execute(select(Kefi_Event).filter(Kefi_Event.id == miami_event["Id"]))
+            if kefi_event.scalars().first():
+                continue
+            kefi_event = Kefi_Event(
+                id=miami_event["Id"],
+                name=miami_event["Name"],
+                description=miami_event["Description"],
+                category=miami_event["Category"],
+                price=miami_event["Price"],
+                start_date=miami_event["Start Date"],
+                start_date_typed=string_to_date(miami_event["Start Date"]),
+                embedding=miami_event["Embedding"],
+            )
+            session.add(kefi_event)
+        try:
+            await session.commit()
+        except sqlalchemy.exc.IntegrityError:
+            pass
 
     logger.info("Kefi_Events table seeded successfully.")
 
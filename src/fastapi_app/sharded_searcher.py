@@ -0,0 +1,356 @@
+"""
+Scatter-gather search over kefi_events split across several Postgres databases (shards), for catalogs whose HNSW
+index no longer fits one server's memory.
+
+Events belong to shard `id % N`. Each search sends one statement to every shard at once, which returns the best
+candidates of each retrieval leg with their raw scores (inner product distance, ts_rank_cd). Raw scores compare
+across shards where per-shard ranks don't, so the legs are ranked globally and merged with RRF in Python. With a
+per-shard candidate depth of at least RESULT_DEPTH, results are the same as searching one database holding every
+event. Shards that are slower than their timeout, or fail, are left out of the results rather than failing the search.
+
+Shards can be separate databases on one server, which is enough to try this locally:
+
+    createdb events_0 && createdb events_1
+    POSTGRES_SHARDS=localhost/events_0,localhost/events_1 python -m fastapi_app.sharded_searcher distribute
+
+distribute creates the schema on every shard and copies the events of the primary database (POSTGRES_HOST and
+POSTGRES_DATABASE) to their shards. Changing the number of shards needs the events to be distributed again.
+"""
+
+import argparse
+import asyncio
+import functools
+import logging
+from collections import defaultdict
+from dataclasses import dataclass, field
+
+import numpy as np
+from dotenv import load_dotenv
+from sqlalchemy import Float, Integer, String, TextualSelect, select, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.ext.asyncio import AsyncEngine, async_sessionmaker
+
+from fastapi_app.adaptive_retrieval import LexicalHit
+from fastapi_app.deadlines import record_degradation, stage_budget
+from fastapi_app.metrics import SHARD_SEARCHES, stage
+from fastapi_app.postgres_engine import create_postgres_engine_from_env, create_postgres_shard_engines_from_env
+from fastapi_app.postgres_models import Kefi_Event
+from fastapi_app.postgres_searcher import (
+    QUERY_CANCELED,
+    PostgresSearcher,
+    build_filter_clause,
+    build_lexical_probe_statement,
+    filter_params,
+    filter_shape,
+    search_mode,
+)
+from fastapi_app.search_cache import RankedResults
+from fastapi_app.search_planner import FilteredSearchPlanner, SearchPlan
+
+logger = logging.getLogger("ragapp")
+
+# Results kept after the merge, like the LIMIT of a search on one database
+RESULT_DEPTH = 20
+RRF_K = 60
+
+
+@dataclass
+class Shard:
+    name: str
+    engine: AsyncEngine
+    # Each shard has its own table statistics, so it needs its own planner
+    search_planner: FilteredSearchPlanner | None = None
+    session_maker: async_sessionmaker = field(init=False)
+
+    def __post_init__(self):
+        self.session_maker = async_sessionmaker(self.engine, expire_on_commit=False)
+
+
+def shard_index(event_id: int, shard_count: int) -> int:
+    return event_id % shard_count
+
+
+@functools.lru_cache(maxsize=256)
+def build_shard_statement(
+    mode: str,
+    shape: tuple[tuple[str, str], ...],
+    vector_strategy: str = "index",
+    index_predicate: str = "",
+    fuzzy: bool = False,
+) -> TextualSelect:
+    """
+    The candidates of one shard: the best :depth rows of each leg of the mode, tagged with their leg and raw score
+    (distance for "vector", lower is better, ts_rank_cd for "text" and trigram word similarity for "fuzzy", higher
+    is better).
+    """
+    filter_clause_where, filter_clause_and = build_filter_clause(shape)
+    if vector_strategy == "exact":
+        # As in build_search_statement, OFFSET 0 makes the filters run first and skips the HNSW index
+        vector_source = f"(SELECT id, embedding FROM kefi_events {filter_clause_where} OFFSET 0) AS prefiltered"
+    elif vector_strategy == "index":
+        if index_predicate:
+            filter_clause_where = f"{filter_clause_where} AND {index_predicate}"
+        vector_source = f"kefi_events {filter_clause_where}"
+    else:
+        raise ValueError(f"Unsupported vector strategy: {vector_strategy}")
+
+    vector_leg = f"""
+        SELECT 'vector' AS leg, id, embedding <#> :embedding AS score
+            FROM {vector_source}
+            ORDER BY embedding <#> :embedding
+            LIMIT :depth
+        """
+    text_leg = f"""
+        SELECT 'text' AS leg, id, ts_rank_cd(to_tsvector('english', description), query) AS score
+            FROM kefi_events, plainto_tsquery('english', :query) query
+            WHERE to_tsvector('english', description) @@ query {filter_clause_and}
+            ORDER BY score DESC
+            LIMIT :depth
+        """
+    similarity = "greatest(word_similarity(:query, name), word_similarity(:query, category))"
+    fuzzy_leg = f"""
+        SELECT 'fuzzy' AS leg, id, {similarity} AS score
+            FROM kefi_events
+            WHERE (:query <% name OR :query <% category) {filter_clause_and}
+            ORDER BY score DESC
+            LIMIT :depth
+        """
+    if mode == "hybrid":
+        legs = [vector_leg, text_leg]
+    elif mode == "vector":
+        legs = [vector_leg]
+    elif mode == "text":
+        legs = [text_leg]
+    else:
+        raise ValueError(f"Unsupported search mode: {mode}")
+    if fuzzy and mode != "vector":
+        legs.append(fuzzy_leg)
+    return text(" UNION ALL ".join(f"({leg})" for leg in legs)).columns(leg=String, id=Integer, score=Float)
+
+
+def global_ranks(hits: list[tuple[int, float]], descending: bool) -> list[tuple[int, int]]:
+    """(id, rank) for the best RESULT_DEPTH hits across shards, with RANK() semantics for ties."""
+    hits = sorted(hits, key=lambda hit: -hit[1] if descending else hit[1])[:RESULT_DEPTH]
+    ranks = []
+    for position, (id, score) in enumerate(hits):
+        rank = ranks[-1][1] if position > 0 and score == hits[position - 1][1] else position + 1
+        ranks.append((id, rank))
+    return ranks
+
+
+def rrf_merge(hits_by_leg: dict[str, list[tuple[int, float]]]) -> list[tuple[int, float]]:
+    """Merge the legs' candidates from every shard into (id, RRF score), best first."""
+    scores: dict[int, float] = defaultdict(float)
+    for leg, hits in hits_by_leg.items():
+        for id, rank in global_ranks(hits, descending=leg != "vector"):
+            scores[id] += 1.0 / (RRF_K + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)[:RESULT_DEPTH]
+
+
+class ShardedSearcher(PostgresSearcher):
+    """
+    A PostgresSearcher over events spread across shards. Embedding, caching and degradation work as for one
+    database; ranking and hydration fan out to the shards.
+    """
+
+    def __init__(
+        self,
+        shards: list[Shard],
+        *,
+        candidate_depth: int = RESULT_DEPTH,
+        shard_timeout: float = 2.0,
+        **searcher_args,
+    ):
+        super().__init__(shards[0].engine, **searcher_args)
+        self.shards = shards
+        self.candidate_depth = candidate_depth
+        self.shard_timeout = shard_timeout
+        # Shards left out of the last search because they timed out or failed
+        self.last_missing_shards: list[str] = []
+
+    async def search(
+        self,
+        query_text: str | None,
+        query_vector: np.ndarray | list[float],
+        top: int = 5,
+        filters: list[dict] | None = None,
+        cache_key: tuple | None = None,
+        fuzzy: bool = False,
+    ):
+        mode = search_mode(query_text is not None, len(query_vector) > 0)
+        if mode is None:
+            raise ValueError("Both query text and query vector are empty")
+        fuzzy = fuzzy and query_text is not None
+        filters = self.effective_filters(filters)
+        params = {
+            "embedding": np.asarray(query_vector, dtype=np.float32),
+            "query": query_text,
+            "depth": self.candidate_depth,
+        } | filter_params(filters)
+
+        with stage("sql_ranking"):
+            outcomes = await asyncio.gather(
+                *(self.search_shard(shard, mode, filters, params, fuzzy) for shard in self.shards),
+                return_exceptions=True,
+            )
+        hits_by_leg: dict[str, list[tuple[int, float]]] = defaultdict(list)
+        errors = []
+        self.last_missing_shards = []
+        for shard, outcome in zip(self.shards, outcomes):
+            if isinstance(outcome, BaseException):
+                if not isinstance(outcome, Exception):
+                    raise outcome
+                errors.append(outcome)
+                self.last_missing_shards.append(shard.name)
+                continue
+            for leg, id, score in outcome:
+                hits_by_leg[leg].append((id, score))
+        if len(errors) == len(self.shards):
+            raise errors[0]
+
+        fused = mode == "hybrid" or fuzzy
+        if fused:
+            results = rrf_merge(hits_by_leg)
+        else:
+            # A single leg keeps its own order, as on one database
+            results = global_ranks(hits_by_leg["vector"] or hits_by_leg["text"], descending=mode == "text")
+        self.last_plan = None
+        self.last_scores = [score for _, score in results] if fused else None
+        # Partial results would be served until the catalog next changes, so only complete ones are cached
+        if cache_key is not None and self.result_cache is not None and not self.last_missing_shards:
+            ranked = RankedResults([id for id, _ in results], self.last_scores, None, self.last_retrieval)
+            self.result_cache.put(cache_key, ranked)
+        return await self.hydrate([id for id, _ in results[:top]])
+
+    async def search_shard(
+        self, shard: Shard, mode: str, filters: list[dict] | None, params: dict, fuzzy: bool = False
+    ) -> list:
+        budget = self.shard_timeout
+        if (sql_budget := stage_budget("sql")) is not None:
+            budget = min(budget, sql_budget)
+        try:
+            async with shard.session_maker() as session, asyncio.timeout(budget):
+                # Postgres cancels the query itself when the budget runs out, so a slow shard stops working on it
+                await session.execute(
+                    text("SELECT set_config('statement_timeout', :timeout, true)"),
+                    {"timeout": str(max(1, int(budget * 1000)))},
+                )
+                if fuzzy:
+                    await session.execute(
+                        text("SELECT set_config('pg_trgm.word_similarity_threshold', :threshold, true)"),
+                        {"threshold": str(self.fuzzy_threshold)},
+                    )
+                plan = SearchPlan(strategy="index")
+                if mode != "text":
+                    if shard.search_planner is not None and filters:
+                        plan = await shard.search_planner.plan(session, filters)
+                    # HNSW scans return at most ef_search rows, so it has to cover the candidate depth
+                    ef_search = max(int(plan.settings.get("hnsw.ef_search", 40)), self.candidate_depth)
+                    plan.settings = plan.settings | {"hnsw.ef_search": str(ef_search)}
+                    await FilteredSearchPlanner.apply(session, plan)
+                shape = filter_shape(filters)
+                sql = build_shard_statement(mode, shape, plan.vector_strategy, plan.index_predicate, fuzzy)
+                rows = (await session.execute(sql, params)).fetchall()
+        except TimeoutError:
+            SHARD_SEARCHES.labels(shard.name, "timeout").inc()
+            record_degradation(f"shard {shard.name}", "partial results")
+            raise
+        except DBAPIError as e:
+            if getattr(e.orig, "sqlstate", None) == QUERY_CANCELED:
+                SHARD_SEARCHES.labels(shard.name, "timeout").inc()
+                record_degradation(f"shard {shard.name}", "partial results")
+                raise TimeoutError(f"Shard {shard.name} exceeded its search budget") from e
+            SHARD_SEARCHES.labels(shard.name, "error").inc()
+            logger.warning("Search on shard %s failed, returning partial results: %s", shard.name, e)
+            raise
+        except OSError as e:
+            SHARD_SEARCHES.labels(shard.name, "error").inc()
+            logger.warning("Search on shard %s failed, returning partial results: %s", shard.name, e)
+            raise
+        SHARD_SEARCHES.labels(shard.name, "ok").inc()
+        return rows
+
+    async def lexical_probe(self, query_text: str, filters: list[dict] | None) -> list[LexicalHit]:
+        # ts_rank_cd scores a row on its own, so the shards' hits compare directly. Adaptive retrieval falls back to
+        # the hybrid search when a shard doesn't answer, rather than skipping the embedding on partial results.
+        sql = build_lexical_probe_statement(filter_shape(filters))
+        params = {"query": query_text} | filter_params(filters)
+
+        async def probe_shard(shard: Shard) -> list:
+            async with shard.session_maker() as session, asyncio.timeout(self.shard_timeout):
+                return (await session.execute(sql, params)).fetchall()
+
+        with stage("sql_text_probe"):
+            shard_rows = await asyncio.gather(*(probe_shard(shard) for shard in self.shards))
+        hits = [LexicalHit(row.id, row.score, row.name_match) for rows in shard_rows for row in rows]
+        return sorted(hits, key=lambda hit: hit.score, reverse=True)[:RESULT_DEPTH]
+
+    async def load_events(self, ids: list[int], session=None) -> list[Kefi_Event]:
+        ids_by_shard: dict[int, list[int]] = defaultdict(list)
+        for id in ids:
+            ids_by_shard[shard_index(id, len(self.shards))].append(id)
+
+        async def load_shard(index: int, shard_ids: list[int]) -> list[Kefi_Event]:
+            async with self.shards[index].session_maker() as session:
+                return list((await session.scalars(select(Kefi_Event).where(Kefi_Event.id.in_(shard_ids)))).all())
+
+        loaded = await asyncio.gather(*(load_shard(index, shard_ids) for index, shard_ids in ids_by_shard.items()))
+        return [kefi_event for shard_events in loaded for kefi_event in shard_events]
+
+
+async def distribute_events(primary: AsyncEngine, shard_engines: list[AsyncEngine], batch_size: int = 1000):
+    """Create the schema on every shard and copy each event of the primary database to its shard."""
+    # Imported here, as the setup scripts aren't needed to serve searches
+    from fastapi_app.seed_bundle import copy_records
+    from fastapi_app.setup_postgres_database import create_db_schema
+
+    for shard_engine in shard_engines:
+        await create_db_schema(shard_engine)
+
+    table = Kefi_Event.__tablename__
+    columns = ["id", "name", "description", "category", "price", "start_date", "start_date_typed", "embedding"]
+    copied = 0
+    last_id = None
+    async with async_sessionmaker(primary, expire_on_commit=False)() as session:
+        while True:
+            batch = select(Kefi_Event).order_by(Kefi_Event.id).limit(batch_size)
+            if last_id is not None:
+                batch = batch.where(Kefi_Event.id > last_id)
+            kefi_events = (await session.scalars(batch)).all()
+            if not kefi_events:
+                break
+            batches: dict[int, list[tuple]] = defaultdict(list)
+            for kefi_event in kefi_events:
+                record = tuple(getattr(kefi_event, column) for column in columns)
+                batches[shard_index(kefi_event.id, len(shard_engines))].append(record)
+            for index, records in batches.items():
+                await copy_records(shard_engines[index], table, columns, records, on_conflict_skip=True)
+            copied += len(kefi_events)
+            last_id = kefi_events[-1].id
+            session.expunge_all()
+    logger.info("Copied %d events to %d shards", copied, len(shard_engines))
+
+
+async def main():
+    parser = argparse.ArgumentParser(description="Manage the search shards listed in POSTGRES_SHARDS")
+    parser.add_argument("command", choices=["distribute"], help="Copy the primary database's events to the shards")
+    parser.add_argument("--batch-size", type=int, default=1000, help="Events read from the primary at a time")
+    args = parser.parse_args()
+
+    primary = await create_postgres_engine_from_env()
+    shard_engines = await create_postgres_shard_engines_from_env()
+    if not shard_engines:
+        raise SystemExit("POSTGRES_SHARDS is not set")
+    try:
+        await distribute_events(primary, list(shard_engines.values()), args.batch_size)
+    finally:
+        for shard_engine in shard_engines.values():
+            await shard_engine.dispose()
+        await primary.dispose()
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.WARNING)
+    logger.setLevel(logging.INFO)
+    load_dotenv(override=True)
+    asyncio.run(main())
@@ -0,0 +1,279 @@
+"""
+In-memory prefix index for GET /suggest, so typeahead needs neither the database nor OpenAI per keystroke.
+
+Every word of an upcoming event's name starts a key (so "jazz" finds "Miami Jazz Festival"), and every category is
+a key too. Keys are kept in one sorted list searched with bisect, and the suggestions for a prefix are ranked by a
+score that favors events found often by /search and events starting soon.
+
+The index is loaded at startup, then refreshed in the background. Changed events (from CatalogChanges) are reloaded
+by id. Search hits only rescore their events. A full rebuild every rebuild_interval seconds drops events that have
+started.
+"""
+
+import asyncio
+import bisect
+import datetime
+import heapq
+import logging
+import math
+import time
+from collections import Counter
+from collections.abc import Callable
+from dataclasses import dataclass
+
+from sqlalchemy import select
+
+from .postgres_models import Kefi_Event
+
+logger = logging.getLogger("ragapp")
+
+
+@dataclass
+class Suggestion:
+    text: str
+    kind: str  # "event" or "category"
+    event_id: int | None = None
+    start_date: datetime.date | None = None
+    score: float = 0.0
+
+    def to_dict(self):
+        return {"text": self.text, "kind": self.kind, "event_id": self.event_id, "start_date": self.start_date}
+
+
+def normalize(text: str) -> str:
+    return " ".join(text.casefold().split())
+
+
+def index_keys(text: str) -> set[str]:
+    """The name from each of its words on, so a prefix can match the start of any word."""
+    words = normalize(text).split()
+    return {" ".join(words[i:]) for i in range(len(words))}
+
+
+def prefix_end(prefix: str) -> str:
+    """The smallest string after every string that starts with prefix."""
+    return prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+class SuggestIndex:
+    def __init__(
+        self,
+        session_makers: list[Callable],
+        *,
+        refresh_interval: float = 5,
+        rebuild_interval: float = 3600,
+        date_half_life_days: float = 14,
+        max_suggestions: int = 10,
+        max_cached_prefixes: int = 10000,
+    ):
+        # Every events table to load from: the primary or a replica, or every shard
+        self.session_makers = session_makers
+        self.refresh_interval = refresh_interval
+        self.rebuild_interval = rebuild_interval
+        self.date_half_life_days = date_half_life_days
+        self.max_suggestions = max_suggestions
+        self.max_cached_prefixes = max_cached_prefixes
+        self.events: dict[int, Suggestion] = {}
+        self.categories: dict[str, Suggestion] = {}
+        self.category_counts: Counter[str] = Counter()
+        self.category_of: dict[int, str] = {}
+        # Sorted keys, and the suggestion that each key belongs to
+        self.keys: list[str] = []
+        self.key_owners: list[Suggestion] = []
+        self.prefix_cache: dict[str, list[Suggestion]] = {}
+        self.hits: Counter[int] = Counter()
+        self.changed_ids: set[int] = set()
+        self.hit_ids: set[int] = set()
+        self.needs_rebuild = True
+        self.ready = False
+        self.task: asyncio.Task | None = None
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+
+    def on_catalog_change(self, ids: set[int] | None):
+        if ids is None:
+            self.needs_rebuild = True
+        else:
+            self.changed_ids |= ids
+
+    def record_hits(self, ids: list[int]):
+        """Count events returned by a search, so popular events are suggested first."""
+        self.hits.update(ids)
+        self.hit_ids.update(ids)
+
+    def suggest(self, prefix: str, limit: int = 5) -> list[Suggestion]:
+        prefix = normalize(prefix)
+        if not prefix:
+            return []
+        suggestions = self.prefix_cache.get(prefix)
+        if suggestions is None:
+            start = bisect.bisect_left(self.keys, prefix)
+            end = bisect.bisect_left(self.keys, prefix_end(prefix), lo=start)
+            owners = {id(owner): owner for owner in self.key_owners[start:end]}
+            suggestions = heapq.nlargest(self.max_suggestions, owners.values(), key=lambda owner: owner.score)
+            if len(self.prefix_cache) >= self.max_cached_prefixes:
+                self.prefix_cache.clear()
+            self.prefix_cache[prefix] = suggestions
+        return suggestions[:limit]
+
+    def score_event(self, suggestion: Suggestion, today: datetime.date) -> float:
+        days_until = max(0, (suggestion.start_date - today).days) if suggestion.start_date else 365
+        return math.log1p(self.hits[suggestion.event_id]) + 0.5 ** (days_until / self.date_half_life_days)
+
+    def score_category(self, category: str) -> float:
+        return math.log1p(self.category_counts[category])
+
+    async def load(self, ids: set[int] | None = None) -> list:
+        statement = select(Kefi_Event.id, Kefi_Event.name, Kefi_Event.category, Kefi_Event.start_date_typed).where(
+            Kefi_Event.start_date_typed >= datetime.date.today()
+        )
+        if ids is not None:
+            statement = statement.where(Kefi_Event.id.in_(ids))
+        rows = []
+        for session_maker in self.session_makers:
+            async with session_maker() as session:
+                rows.extend((await session.execute(statement)).all())
+        return rows
+
+    async def rebuild(self):
+        rows = await self.load()
+        today = datetime.date.today()
+        events = {row.id: Suggestion(row.name, "event", row.id, row.start_date_typed) for row in rows if row.name}
+        for suggestion in events.values():
+            suggestion.score = self.score_event(suggestion, today)
+        category_of = {row.id: row.category for row in rows if row.id in events and row.category}
+        category_counts = Counter(category_of.values())
+        categories = {category: Suggestion(category, "category") for category in category_counts}
+        entries = [
+            (key, suggestion)
+            for suggestion in [*events.values(), *categories.values()]
+            for key in index_keys(suggestion.text)
+        ]
+        entries.sort(key=lambda entry: entry[0])
+
+        # Swapped in together, so suggest() never sees a half-built index
+        self.events, self.categories, self.category_of = events, categories, category_of
+        self.category_counts = category_counts
+        for category, suggestion in categories.items():
+            suggestion.score = self.score_category(category)
+        self.keys = [key for key, _ in entries]
+        self.key_owners = [suggestion for _, suggestion in entries]
+        self.prefix_cache = {}
+        self.hit_ids.clear()
+        # Only events still in the index keep their hits, so the counts don't grow with every event ever found
+        self.hits = Counter({id: count for id, count in self.hits.items() if id in events})
+        # Single letters match the most keys, so rank those ahead of the first keystroke
+        for letter in {key[0] for key in self.keys}:
+            self.suggest(letter)
+        self.ready = True
+        logger.info("Built the suggestion index: %d events, %d categories", len(events), len(categories))
+
+    def add_keys(self, suggestion: Suggestion):
+        for key in index_keys(suggestion.text):
+            position = bisect.bisect_left(self.keys, key)
+            self.keys.insert(position, key)
+            self.key_owners.insert(position, suggestion)
+
+    def remove_keys(self, suggestion: Suggestion):
+        for key in index_keys(suggestion.text):
+            position = bisect.bisect_left(self.keys, key)
+            while position < len(self.keys) and self.keys[position] == key:
+                if self.key_owners[position] is suggestion:
+                    del self.keys[position]
+                    del self.key_owners[position]
+                    break
+                position += 1
+
+    def forget_prefixes(self, suggestions: list[Suggestion]):
+        """Drop the cached suggestions of every prefix that a key of the suggestions starts with, in one pass."""
+        keys = sorted({key for suggestion in suggestions for key in index_keys(suggestion.text)})
+        if not keys:
+            return
+        stale = []
+        for prefix in self.prefix_cache:
+            # The keys starting with the prefix, if any, come first among the keys from the prefix on
+            position = bisect.bisect_left(keys, prefix)
+            if position < len(keys) and keys[position].startswith(prefix):
+                stale.append(prefix)
+        for prefix in stale:
+            del self.prefix_cache[prefix]
+
+    def update_category(self, category: str, change: int) -> Suggestion | None:
+        """Count an event more or less in the category, returning the category's suggestion if it changed."""
+        self.category_counts[category] += change
+        suggestion = self.categories.get(category)
+        if self.category_counts[category] <= 0:
+            del self.category_counts[category]
+            if suggestion is not None:
+                self.remove_keys(suggestion)
+                del self.categories[category]
+        elif suggestion is None:
+            suggestion = Suggestion(category, "category", score=self.score_category(category))
+            self.categories[category] = suggestion
+            self.add_keys(suggestion)
+        else:
+            suggestion.score = self.score_category(category)
+        return suggestion
+
+    async def refresh(self, ids: set[int]):
+        """Reload changed events, moving only their keys."""
+        rows = {row.id: row for row in await self.load(ids)}
+        today = datetime.date.today()
+        changed = []
+        for id in ids:
+            if (old := self.events.pop(id, None)) is not None:
+                self.remove_keys(old)
+                changed.append(old)
+                if (old_category := self.category_of.pop(id, None)) is not None:
+                    changed.append(self.update_category(old_category, -1))
+            if (row := rows.get(id)) is not None and row.name:
+                suggestion = Suggestion(row.name, "event", row.id, row.start_date_typed)
+                suggestion.score = self.score_event(suggestion, today)
+                self.events[id] = suggestion
+                self.add_keys(suggestion)
+                changed.append(suggestion)
+                if row.category:
+                    self.category_of[id] = row.category
+                    changed.append(self.update_category(row.category, 1))
+        self.forget_prefixes([suggestion for suggestion in changed if suggestion is not None])
+
+    def rescore(self, ids: set[int]):
+        today = datetime.date.today()
+        rescored = []
+        for id in ids:
+            if (suggestion := self.events.get(id)) is not None:
+                suggestion.score = self.score_event(suggestion, today)
+                rescored.append(suggestion)
+        self.forget_prefixes(rescored)
+
+    async def run(self):
+        last_rebuild = 0.0
+        while True:
+            try:
+                if self.needs_rebuild or time.monotonic() - last_rebuild > self.rebuild_interval:
+                    # Changes arriving while the rebuild loads are reloaded on the next pass
+                    self.needs_rebuild = False
+                    self.changed_ids.clear()
+                    await self.rebuild()
+                    last_rebuild = time.monotonic()
+                elif self.changed_ids:
+                    changed_ids, self.changed_ids = self.changed_ids, set()
+                    await self.refresh(changed_ids)
+                if self.hit_ids:
+                    hit_ids, self.hit_ids = self.hit_ids, set()
+                    self.rescore(hit_ids)
+            except Exception as e:
+                logger.warning("Could not refresh the suggestion index: %s", e)
+                self.needs_rebuild = True
+            await asyncio.sleep(self.refresh_interval)
@@ -1,14 +1,33 @@
 import asyncio
+import os
 
 from dotenv import load_dotenv
 from sqlalchemy import select
 from sqlalchemy.ext.asyncio import async_sessionmaker
 
-from fastapi_app.embeddings import compute_text_embedding
+from fastapi_app.embeddings import compute_text_embeddings
 from fastapi_app.openai_clients import create_openai_embed_client
 from fastapi_app.postgres_engine import create_postgres_engine
 from fastapi_app.postgres_models import Item, Kefi_Event
 
+EMBED_BATCH_SIZE = 100
+
+
+async def embed_rows(rows: list[Item] | list[Kefi_Event], openai_embed_client, embed_model: str, dimensions: int):
+    """Embed rows in batched calls, assigning each row its float32 embedding."""
+    normalize = os.getenv("OPENAI_EMBED_NORMALIZE", "false").lower() == "true"
+    for start in range(0, len(rows), EMBED_BATCH_SIZE):
+        batch = rows[start : start + EMBED_BATCH_SIZE]
+        embeddings = await compute_text_embeddings(
+            [row.to_str_for_embedding() for row in batch],
+            openai_client=openai_embed_client,
+            embed_model=embed_model,
+            embedding_dimensions=dimensions,
+            normalize=normalize,
+        )
+        for row, embedding in zip(batch, embeddings):
+            row.embedding = embedding
+
 
 async def update_embeddings():
     engine = await create_postgres_engine()
@@ -17,14 +36,7 @@ async def update_embeddings():
     async with async_sessionmaker(engine, expire_on_commit=False)() as session:
         async with session.begin():
             items = (await session.scalars(select(Item))).all()
-
-            for item in items:
-                item.embedding = await compute_text_embedding(
-                    item.to_str_for_embedding(),
-                    openai_client=openai_embed_client,
-                    embed_model=openai_embed_model,
-                    embedding_dimensions=openai_embed_dimensions,
-                )
+            await embed_rows(items, openai_embed_client, openai_embed_model, openai_embed_dimensions)
 
             await session.commit()
 
@@ -43,14 +55,7 @@ async def update_embeddings_events():
     async with async_sessionmaker(engine, expire_on_commit=False)() as session:
         async with session.begin():
             kefi_events = (await session.scalars(select(Kefi_Event))).all()
-
-            for kefi_event in kefi_events:
-                kefi_event.embedding = await compute_text_embedding(
-                    kefi_event.to_str_for_embedding(),
-                    openai_client=openai_embed_client,
-                    embed_model=openai_embed_model,
-                    embedding_dimensions=openai_embed_dimensions,
-                )
+            await embed_rows(kefi_events, openai_embed_client, openai_embed_model, openai_embed_dimensions)
 
             await session.commit()
 
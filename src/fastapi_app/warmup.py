@@ -0,0 +1,102 @@
+import asyncio
+import logging
+import time
+
+from openai_messages_token_helper import build_messages, get_token_limit
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncEngine
+
+from .embeddings import compute_text_embedding
+from .postgres_models import event_index
+
+logger = logging.getLogger("ragapp")
+
+
+async def warm_postgres_pool(engine: AsyncEngine, connections: int):
+    """Open connections concurrently so they are pooled before the first request needs them."""
+    connections = min(connections, engine.pool.size())
+
+    async def open_connection():
+        async with engine.connect() as conn:
+            await conn.execute(text("SELECT 1"))
+
+    await asyncio.gather(*(open_connection() for _ in range(connections)))
+
+
+async def prewarm_postgres_relations(engine: AsyncEngine, relations: list[str]):
+    """Load relations into shared buffers with pg_prewarm, if the extension is installed."""
+    async with engine.begin() as conn:
+        if not (await conn.execute(text("SELECT 1 FROM pg_extension WHERE extname = 'pg_prewarm'"))).scalar():
+            logger.info("Skipping index prewarm, the pg_prewarm extension is not installed")
+            return
+        for relation in relations:
+            # Partitioned tables and indexes have no storage of their own, so prewarm their leaf partitions
+            blocks = (
+                await conn.execute(
+                    text(
+                        """
+                        SELECT sum(pg_prewarm(relid)) FROM pg_partition_tree(CAST(:relation AS regclass))
+                        WHERE isleaf
+                        """
+                    ),
+                    {"relation": relation},
+                )
+            ).scalar()
+            logger.info("Prewarmed %d blocks of %s", blocks or 0, relation)
+
+
+async def warm_openai_clients(openai_chat_client, openai_embed_client, embed_model, embed_dimensions):
+    """Make cheap calls so TLS handshakes and keep-alive connections to the provider exist before the first request."""
+    await asyncio.gather(
+        openai_chat_client.models.list(),
+        compute_text_embedding("warmup", openai_embed_client, embed_model, None, embed_dimensions),
+    )
+
+
+def warm_tokenizer(chat_model: str):
+    """Load the tiktoken encoding that build_messages uses, which is otherwise loaded on the first chat request."""
+    build_messages(
+        model=chat_model,
+        system_prompt="warmup",
+        new_user_content="warmup",
+        max_tokens=get_token_limit(chat_model, default_to_minimum=True),
+        fallback_to_default=True,
+    )
+
+
+async def warm_up(
+    *,
+    engine: AsyncEngine,
+    openai_chat_client,
+    openai_chat_model: str,
+    openai_embed_client,
+    openai_embed_model: str,
+    openai_embed_dimensions,
+    connections: int = 2,
+    prewarm_indexes: bool = False,
+    timeout: float = 30,
+):
+    """
+    Pay the first-request costs of a fresh worker up front. Each step is best effort: a failure is logged
+    and the worker still starts, it just serves its first requests cold.
+    """
+    steps = {
+        "postgres pool": warm_postgres_pool(engine, connections),
+        "openai clients": warm_openai_clients(
+            openai_chat_client, openai_embed_client, openai_embed_model, openai_embed_dimensions
+        ),
+        "tokenizer": asyncio.to_thread(warm_tokenizer, openai_chat_model),
+    }
+    if prewarm_indexes:
+        steps["index prewarm"] = prewarm_postgres_relations(engine, [event_index.name, "kefi_events"])
+
+    start = time.perf_counter()
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*steps.values(), return_exceptions=True), timeout)
+    except TimeoutError:
+        logger.warning("Warm-up did not finish within %ss, starting anyway", timeout)
+        return
+    for name, result in zip(steps, results):
+        if isinstance(result, Exception):
+            logger.warning("Warm-up step %s failed: %s", name, result)
+    logger.info("Warm-up finished in %.2fs", time.perf_counter() - start)
@@ -1,4 +1,7 @@
 import multiprocessing
+import os
+import shutil
+import tempfile
 
 max_requests = 1000
 max_requests_jitter = 50
@@ -8,4 +11,24 @@ workers = (multiprocessing.cpu_count() * 2) + 1
 
 worker_class = "uvicorn.workers.UvicornWorker"
 
+# Import the app once in the master so workers share the imported modules copy-on-write and recycled workers
+# start fast. Event-loop-bound clients (database engine, OpenAI clients) are still created per worker in lifespan.
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() == "true"
+
 timeout = 600
+
+# Each worker writes its Prometheus samples here so that /metrics can aggregate them across workers
+prometheus_multiproc_dir = os.environ.setdefault(
+    "PROMETHEUS_MULTIPROC_DIR", os.path.join(tempfile.gettempdir(), "ragapp_prometheus")
+)
+
+
+def on_starting(server):
+    shutil.rmtree(prometheus_multiproc_dir, ignore_errors=True)
+    os.makedirs(prometheus_multiproc_dir, exist_ok=True)
+
+
+def child_exit(server, worker):
+    from prometheus_client import multiprocess
+
+    multiprocess.mark_process_dead(worker.pid)
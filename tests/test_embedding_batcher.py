@@ -0,0 +1,98 @@
+import asyncio
+
+import httpx
+import numpy as np
+import pytest
+from openai import AsyncOpenAI
+
+from benchmarks.fake_openai import FakeOpenAIConfig, create_fake_openai_app, fake_embedding
+from fastapi_app.embedding_batcher import EmbeddingBatcher
+
+DIMENSIONS = 8
+
+
+def fake_openai(embed_latency_ms: float = 50):
+    """An OpenAI client for the benchmarks' fake server, which waits embed_latency_ms per embeddings call."""
+    app = create_fake_openai_app(FakeOpenAIConfig(embed_latency_ms=embed_latency_ms, jitter=0, dimensions=DIMENSIONS))
+    http_client = httpx.AsyncClient(transport=httpx.ASGITransport(app=app))
+    client = AsyncOpenAI(base_url="http://fake-openai/v1", api_key="fake", http_client=http_client, max_retries=0)
+    return client, app.state.requests
+
+
+def batcher_for(client, **kwargs) -> EmbeddingBatcher:
+    return EmbeddingBatcher(client, "text-embedding-3-small", embedding_dimensions=DIMENSIONS, **kwargs)
+
+
+def test_concurrent_embeds_are_batched():
+    async def run():
+        client, requests = fake_openai()
+        batcher = batcher_for(client, max_batch_size=8, max_wait_ms=100)
+        batcher.start()
+        texts = [f"query {i}" for i in range(20)]
+        try:
+            embeddings = await asyncio.gather(*(batcher.embed(text) for text in texts))
+        finally:
+            await batcher.stop()
+        return texts, embeddings, requests
+
+    texts, embeddings, requests = asyncio.run(run())
+    assert requests["embedding_inputs"] == 20
+    assert requests["embeddings"] == 3
+    for text, embedding in zip(texts, embeddings):
+        np.testing.assert_allclose(embedding, fake_embedding(text, DIMENSIONS), rtol=1e-6)
+
+
+def test_batches_are_sent_without_waiting_for_the_previous_call():
+    async def run():
+        client, requests = fake_openai(embed_latency_ms=200)
+        batcher = batcher_for(client, max_batch_size=4, max_wait_ms=5)
+        batcher.start()
+        # The client's first request is slow to set up, so keep it out of the timing
+        await batcher.embed("warm up")
+        requests["embeddings"] = 0
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        try:
+            await asyncio.gather(*(batcher.embed(f"query {i}") for i in range(12)))
+        finally:
+            await batcher.stop()
+        return loop.time() - start, requests
+
+    elapsed, requests = asyncio.run(run())
+    assert requests["embeddings"] == 3
+    # The three calls overlap, rather than taking 3 x 200ms one after another
+    assert elapsed < 0.4
+
+
+def test_failed_call_fails_every_caller_in_its_batch():
+    class FailingEmbeddings:
+        calls = 0
+
+        async def create(self, **kwargs):
+            FailingEmbeddings.calls += 1
+            await asyncio.sleep(0.01)
+            raise RuntimeError("provider is down")
+
+    class FailingClient:
+        embeddings = FailingEmbeddings()
+
+    async def run():
+        batcher = batcher_for(FailingClient(), max_batch_size=8, max_wait_ms=20)
+        batcher.start()
+        try:
+            return await asyncio.gather(*(batcher.embed(f"query {i}") for i in range(5)), return_exceptions=True)
+        finally:
+            await batcher.stop()
+
+    results = asyncio.run(run())
+    assert FailingEmbeddings.calls == 1
+    assert all(isinstance(result, RuntimeError) for result in results)
+
+
+def test_embed_requires_a_started_batcher():
+    async def run():
+        client, _ = fake_openai()
+        await batcher_for(client).embed("query")
+
+    with pytest.raises(RuntimeError, match="not running"):
+        asyncio.run(run())
@@ -0,0 +1,25 @@
+import json
+
+import pytest
+
+from fastapi_app.query_rewriter import build_search_function, search_function_schema
+
+
+def test_search_function_is_built_once():
+    assert build_search_function() is build_search_function()
+
+
+def test_search_function_matches_the_schema_literal():
+    assert json.dumps(build_search_function()) == json.dumps(search_function_schema())
+
+
+def test_search_function_cannot_be_changed():
+    function = build_search_function()[0]["function"]
+    with pytest.raises(TypeError):
+        function["name"] = "other"
+    with pytest.raises(TypeError):
+        function["parameters"]["properties"].pop("price_filter")
+    # Lists are tuples
+    with pytest.raises(AttributeError):
+        function["parameters"]["required"].append("date_filter")
+    assert json.dumps(build_search_function()) == json.dumps(search_function_schema())
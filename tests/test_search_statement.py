@@ -0,0 +1,21 @@
+from fastapi_app.postgres_searcher import build_search_statement, filter_shape
+from fastapi_app.query_rewriter import SEARCH_FUNCTION, build_search_function
+
+FILTERS = [
+    {"column": "price", "comparison_operator": "<", "value": 30},
+    {"column": "category", "comparison_operator": "=", "value": "Music"},
+]
+
+
+def test_search_statement_is_cached_per_mode_and_shape():
+    statement = build_search_statement("hybrid", filter_shape(FILTERS))
+    # Filters with other values have the same shape, so they share the statement
+    other_values = [filter | {"value": "other"} for filter in FILTERS]
+    assert build_search_statement("hybrid", filter_shape(other_values)) is statement
+    assert build_search_statement("vector", filter_shape(FILTERS)) is not statement
+    assert build_search_statement("hybrid", filter_shape(FILTERS[:1])) is not statement
+
+
+def test_search_function_is_prebuilt():
+    assert build_search_function() is SEARCH_FUNCTION
+    assert isinstance(SEARCH_FUNCTION, tuple)
@@ -0,0 +1,31 @@
+import os
+import subprocess
+import sys
+
+from benchmarks.startup import profile_imports
+
+# Import time of `import fastapi_app` plus create_app(), under -X importtime. About 1.8s on a CI runner today;
+# set STARTUP_IMPORT_BUDGET_MS to tighten it on faster machines.
+IMPORT_BUDGET_MS = float(os.getenv("STARTUP_IMPORT_BUDGET_MS", "3000"))
+
+# Imported only when first needed, by the lifespan or the setup scripts
+LAZY_MODULES = ["azure.identity"]
+
+
+def test_import_time_is_within_budget():
+    report = profile_imports()
+    slowest = ", ".join(f"{m['module']} {m['cumulative_ms']}ms" for m in report["slowest_imports"][:5])
+    assert report["total_import_ms"] <= IMPORT_BUDGET_MS, f"Slowest imports: {slowest}"
+
+
+def test_import_does_not_load_lazy_modules():
+    snippet = "import sys, fastapi_app; fastapi_app.create_app(); print(' '.join(sorted(sys.modules)))"
+    completed = subprocess.run(
+        [sys.executable, "-c", snippet],
+        capture_output=True,
+        text=True,
+        check=True,
+        env=os.environ | {"RUNNING_IN_PRODUCTION": "1"},
+    )
+    imported = set(completed.stdout.split())
+    assert [module for module in LAZY_MODULES if module in imported] == []